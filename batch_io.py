@@ -0,0 +1,354 @@
+import ctypes
+import ctypes.util
+import errno
+import socket
+import struct
+import sys
+
+'''
+Bulk datagram I/O for the daemon.
+--
+Reading: when a socket is readable every waiting datagram is read in one pass into a preallocated ring of buffers.
+On Linux recvmmsg reads up to ring_size datagrams with one system call, elsewhere recvfrom_into is called
+until the socket has nothing more to read.
+Writing: the datagrams sent while the event loop handles a batch are queued, and sent together right after it.
+On Linux sendmmsg sends up to ring_size datagrams with one system call, elsewhere sendto is called for each.
+--
+'''
+
+MSG_DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0x40)
+SOCKADDR_SIZE = 128
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int)
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr), ('msg_len', ctypes.c_uint)]
+
+
+def load_mmsg():
+    # Returns the recvmmsg and sendmmsg functions of the C library, or None if the platform does not have them
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        recvmmsg = libc.recvmmsg
+        sendmmsg = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+    return recvmmsg, sendmmsg
+
+
+MMSG = load_mmsg()
+
+
+def pack_sockaddr(address):
+    # Converts an (ip, port) address to a sockaddr_in structure
+    ip, port = address[:2]
+    return struct.pack('=H', socket.AF_INET) + struct.pack('!H', port) + socket.inet_aton(ip) + bytes(8)
+
+
+def unpack_sockaddr(buffer):
+    # Converts a sockaddr_in or sockaddr_in6 structure to an address tuple like the ones recvfrom returns
+    family = struct.unpack_from('=H', buffer)[0]
+    port = struct.unpack_from('!H', buffer, 2)[0]
+    if family == socket.AF_INET6:
+        flowinfo, = struct.unpack_from('!I', buffer, 4)
+        scope_id, = struct.unpack_from('=I', buffer, 24)
+        return socket.inet_ntop(socket.AF_INET6, bytes(buffer[8:24])), port, flowinfo, scope_id
+    return socket.inet_ntop(socket.AF_INET, bytes(buffer[4:8])), port
+
+
+class IoBatch:
+    '''
+    The endpoints of a daemon share one batch: the datagrams sent while any of them handles received datagrams
+    are sent together when the handling is over, so an ack or a forwarded message does not cost a system call each.
+    '''
+
+    def __init__(self):
+        self.depth = 0
+        self.pending = []
+
+    def begin(self):
+        self.depth += 1
+
+    def end(self):
+        self.depth -= 1
+        if self.depth == 0:
+            while self.pending:
+                endpoint = self.pending.pop()
+                endpoint.flush()
+
+
+class BatchedDatagramEndpoint:
+    '''
+    A datagram transport on a non-blocking socket that reads and writes in batches.
+    The protocol gets every datagram with datagram_received(data, address), like with the asyncio endpoints.
+    The data is a view of the ring buffer, it is only valid during the call, it has to be copied to be kept.
+    '''
+
+    def __init__(self, loop, sock, protocol, batch=None, ring_size=64, buffer_size=65536,
+                 receive_buffer=4 * 1024 * 1024):
+        self.loop = loop
+        self.sock = sock
+        self.protocol = protocol
+        self.batch = batch if batch is not None else IoBatch()
+        self.ring_size = ring_size
+        self.sock.setblocking(False)
+        # A bigger socket buffer lets a burst wait in the kernel until the batch is read
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, receive_buffer)
+        except OSError:
+            pass
+        # The ring of receive buffers, every datagram of a batch is read into its own buffer
+        self.ring = [bytearray(buffer_size) for _ in range(ring_size)]
+        self.views = [memoryview(buffer) for buffer in self.ring]
+        # The datagrams that wait to be sent at the end of the current batch
+        self.outbound = []
+        self.flush_pending = False
+        self.writing = False
+        # Counters of the system calls and the datagrams, to report the system calls per message
+        self.receive_calls = 0
+        self.send_calls = 0
+        self.datagrams_received = 0
+        self.datagrams_sent = 0
+        self.closed = False
+        self.mmsg = MMSG if sock.family == socket.AF_INET else None
+        if self.mmsg is not None:
+            self.setup_mmsg(buffer_size)
+        self.loop.add_reader(self.sock.fileno(), self.read_ready)
+
+    def setup_mmsg(self, buffer_size):
+        # The message headers of recvmmsg point into the ring, they are built once and reused for every batch
+        self.receive_names = [ctypes.create_string_buffer(SOCKADDR_SIZE) for _ in range(self.ring_size)]
+        self.receive_iovecs = (iovec * self.ring_size)()
+        self.receive_headers = (mmsghdr * self.ring_size)()
+        for i in range(self.ring_size):
+            buffer = (ctypes.c_char * buffer_size).from_buffer(self.ring[i])
+            self.receive_iovecs[i].iov_base = ctypes.addressof(buffer)
+            self.receive_iovecs[i].iov_len = buffer_size
+            header = self.receive_headers[i].msg_hdr
+            header.msg_name = ctypes.addressof(self.receive_names[i])
+            header.msg_namelen = SOCKADDR_SIZE
+            header.msg_iov = ctypes.pointer(self.receive_iovecs[i])
+            header.msg_iovlen = 1
+        self.receive_name_addresses = [ctypes.addressof(name) for name in self.receive_names]
+        # The number of headers that were filled by the last recvmmsg, only their name length has to be reset
+        self.receive_used = 0
+        # The address tuples of the raw sockaddr structures, most datagrams come from a few addresses
+        self.addresses = {}
+        self.send_iovecs = (iovec * self.ring_size)()
+        self.send_headers = (mmsghdr * self.ring_size)()
+        for i in range(self.ring_size):
+            header = self.send_headers[i].msg_hdr
+            header.msg_namelen = 16
+            header.msg_iov = ctypes.pointer(self.send_iovecs[i])
+            header.msg_iovlen = 1
+        # The sockaddr structures of the destinations
+        self.sockaddrs = {}
+
+    def read_ready(self):
+        # Every datagram that is waiting is read and handed to the protocol
+        # The datagrams sent by the protocol meanwhile are sent together at the end
+        self.batch.begin()
+        try:
+            if self.mmsg is not None:
+                self.read_mmsg()
+            else:
+                self.read_loop()
+        finally:
+            self.batch.end()
+
+    def read_loop(self):
+        while not self.closed:
+            for view in self.views:
+                try:
+                    nbytes, address = self.sock.recvfrom_into(view)
+                except (BlockingIOError, InterruptedError):
+                    self.receive_calls += 1
+                    return
+                except OSError as error:
+                    self.receive_calls += 1
+                    self.protocol.error_received(error)
+                    return
+                self.receive_calls += 1
+                self.datagrams_received += 1
+                self.deliver(view[:nbytes], address)
+
+    def read_mmsg(self):
+        recvmmsg = self.mmsg[0]
+        while not self.closed:
+            for i in range(self.receive_used):
+                self.receive_headers[i].msg_hdr.msg_namelen = SOCKADDR_SIZE
+            count = recvmmsg(self.sock.fileno(), self.receive_headers, self.ring_size, MSG_DONTWAIT, None)
+            self.receive_calls += 1
+            if count <= 0:
+                self.receive_used = 0
+                return
+            self.receive_used = count
+            self.datagrams_received += count
+            for i in range(count):
+                header = self.receive_headers[i]
+                name = ctypes.string_at(self.receive_name_addresses[i], header.msg_hdr.msg_namelen)
+                address = self.addresses.get(name)
+                if address is None:
+                    address = unpack_sockaddr(name)
+                    if len(self.addresses) < 4096:
+                        self.addresses[name] = address
+                self.deliver(self.views[i][:header.msg_len], address)
+            # If the ring was not filled the socket has nothing more to read
+            if count < self.ring_size:
+                return
+
+    def deliver(self, data, address):
+        # An exception of the protocol is reported like the asyncio endpoints do, the rest of the batch is still handled
+        try:
+            self.protocol.datagram_received(data, address)
+        except Exception as error:
+            self.loop.call_exception_handler({
+                'message': 'Exception in datagram_received of the batched endpoint',
+                'exception': error,
+                'protocol': self.protocol
+            })
+
+    def sendto(self, data, address):
+        # The datagram is queued and sent with the others at the end of the batch
+        # If it is sent from outside a batch (for example by a timer) it is sent in the next loop iteration
+        if self.closed:
+            return
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        self.outbound.append((data, address))
+        if not self.flush_pending and not self.writing:
+            self.flush_pending = True
+            if self.batch.depth > 0:
+                self.batch.pending.append(self)
+            else:
+                self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flush_pending = False
+        if self.closed or self.writing:
+            return
+        if self.mmsg is not None and len(self.outbound) > 1:
+            sent = self.flush_mmsg()
+        else:
+            sent = self.flush_loop()
+        del self.outbound[:sent]
+        # If the socket buffer is full, the rest is sent when the socket is writable again
+        if self.outbound and not self.writing:
+            self.writing = True
+            self.loop.add_writer(self.sock.fileno(), self.write_ready)
+
+    def write_ready(self):
+        self.loop.remove_writer(self.sock.fileno())
+        self.writing = False
+        self.flush()
+
+    def flush_loop(self):
+        sent = 0
+        for data, address in self.outbound:
+            if not self.send_single(data, address):
+                break
+            sent += 1
+        return sent
+
+    def flush_mmsg(self):
+        sendmmsg = self.mmsg[1]
+        sent = 0
+        while sent < len(self.outbound):
+            batch = self.outbound[sent:sent + self.ring_size]
+            ready = 0
+            for data, address in batch:
+                name = self.sockaddr(address)
+                if name is None:
+                    break
+                # The iovec points into the bytes object itself, it is kept alive by the outbound list
+                self.send_iovecs[ready].iov_base = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
+                self.send_iovecs[ready].iov_len = len(data)
+                self.send_headers[ready].msg_hdr.msg_name = ctypes.addressof(name)
+                ready += 1
+            if ready == 0:
+                # The address is not an IPv4 address (for example a host name), this datagram is sent on its own
+                if not self.send_single(*batch[0]):
+                    break
+                sent += 1
+                continue
+            count = sendmmsg(self.sock.fileno(), self.send_headers, ready, MSG_DONTWAIT)
+            self.send_calls += 1
+            if count <= 0:
+                error = ctypes.get_errno()
+                if error in (errno.EAGAIN, errno.EINTR):
+                    # Try again when the socket is writable
+                    break
+                # The first datagram of the batch failed, it is dropped
+                self.protocol.error_received(OSError(error, 'sendmmsg failed'))
+                count = 1
+            else:
+                self.datagrams_sent += count
+            sent += count
+        return sent
+
+    def sockaddr(self, address):
+        # Returns the sockaddr structure of an IPv4 address, or None if the address is something else
+        name = self.sockaddrs.get(address)
+        if name is None:
+            try:
+                name = ctypes.create_string_buffer(pack_sockaddr(address), SOCKADDR_SIZE)
+            except Exception:
+                # Also a port out of range (struct.error), the datagram is sent on its own and dropped there
+                return None
+            if len(self.sockaddrs) < 4096:
+                self.sockaddrs[address] = name
+        return name
+
+    def send_single(self, data, address):
+        # Sends one datagram with sendto, returns False if the socket buffer is full
+        self.send_calls += 1
+        try:
+            self.sock.sendto(data, address)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except Exception as error:
+            # The datagram cannot be sent (for example the address or its port is invalid), it is dropped, so the
+            # datagrams after it are still sent
+            self.protocol.error_received(error)
+            return True
+        self.datagrams_sent += 1
+        return True
+
+    def get_stats(self):
+        return {
+            'receive_calls': self.receive_calls,
+            'send_calls': self.send_calls,
+            'datagrams_received': self.datagrams_received,
+            'datagrams_sent': self.datagrams_sent,
+            'mmsg': self.mmsg is not None
+        }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.sock.fileno())
+        if self.writing:
+            self.loop.remove_writer(self.sock.fileno())
+        self.sock.close()
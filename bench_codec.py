@@ -0,0 +1,117 @@
+import sys
+import time
+
+from sock import SIMP_Socket
+
+
+class LegacySIMP_Socket(SIMP_Socket):
+    # The if/elif implementation of the codec before the struct layouts, kept here to compare against
+
+    def encode(self):
+        if self.type == 'control':
+            type_binary = (0x01).to_bytes(1, 'big')
+        elif self.type == 'chat':
+            type_binary = (0x02).to_bytes(1, 'big')
+        else:
+            raise Exception('Invalid type')
+
+        if self.type == 'control':
+            if self.operation == 'error':
+                operation_binary = (0x01).to_bytes(1, 'big')
+            elif self.operation == 'syn':
+                operation_binary = (0x02).to_bytes(1, 'big')
+            elif self.operation == 'ack':
+                operation_binary = (0x04).to_bytes(1, 'big')
+            elif self.operation == 'fin':
+                operation_binary = (0x08).to_bytes(1, 'big')
+            else:
+                raise Exception('Invalid operation')
+        else:
+            operation_binary = (0x01).to_bytes(1, 'big')
+
+        if self.sequence == 'request':
+            sequence_binary = (0x00).to_bytes(1, 'big')
+        elif self.sequence == 'response':
+            sequence_binary = (0x01).to_bytes(1, 'big')
+        else:
+            raise Exception('Invalid sequence')
+
+        user_binary = self.user.encode('ascii').ljust(32, b'\x00')
+        payload_binary = self.payload.encode('ascii')
+        self.length = len(payload_binary)
+        length_bytes = self.length.to_bytes(4, 'big')
+        number_bytes = self.number.to_bytes(4, 'big')
+        return type_binary + operation_binary + sequence_binary + user_binary + length_bytes + number_bytes + payload_binary
+
+    def decode(self, bytestream):
+        if bytestream[0] == 0x01:
+            self.type = 'control'
+        elif bytestream[0] == 0x02:
+            self.type = 'chat'
+        else:
+            raise Exception('Invalid type')
+
+        if self.type == 'control':
+            if bytestream[1] == 0x01:
+                self.operation = 'error'
+            elif bytestream[1] == 0x02:
+                self.operation = 'syn'
+            elif bytestream[1] == 0x04:
+                self.operation = 'ack'
+            elif bytestream[1] == 0x08:
+                self.operation = 'fin'
+            elif bytestream[1] == 0x06:
+                self.operation = 'synack'
+            else:
+                self.operation = 'unknown'
+        else:
+            self.operation = 'message'
+
+        if bytestream[2] == 0x00:
+            self.sequence = 'request'
+        elif bytestream[2] == 0x01:
+            self.sequence = 'response'
+        else:
+            raise Exception('Invalid sequence')
+
+        self.user = bytestream[3:35].decode('ascii').strip('\x00')
+        self.length = int.from_bytes(bytestream[35:39], 'big')
+        self.number = int.from_bytes(bytestream[39:43], 'big')
+        self.payload = bytestream[43:].decode('ascii')
+
+
+def rate(function, count, rounds=15):
+    # Returns the number of calls per second, the best of a few rounds to filter out the noise of the machine
+    best = 0
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for _ in range(count):
+            function()
+        best = max(best, count / (time.perf_counter() - start))
+    return best
+
+
+def bench(packet_class, packet, count):
+    # Encode and decode the same packet count times
+    packet = packet_class(**packet)
+    data = packet.encode()
+    results = {'encode': rate(lambda: packet.encode(), count)}
+    received = packet_class()
+    results['decode'] = rate(lambda: received.decode(data), count)
+    return results
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    packets = {
+        'ack': dict(type='control', operation='ack', sequence='response', user='alice', payload='', number=7),
+        'chat 64B': dict(type='chat', operation='message', sequence='request', user='alice', payload='x' * 64, number=7),
+        'chat 1KB': dict(type='chat', operation='message', sequence='request', user='alice', payload='x' * 1024, number=7)
+    }
+    print('{:<10} {:<12} {:>14} {:>14} {:>8}'.format('packet', 'operation', 'legacy pkt/s', 'struct pkt/s', 'speedup'))
+    for name, packet in packets.items():
+        legacy = bench(LegacySIMP_Socket, packet, count)
+        current = bench(SIMP_Socket, packet, count)
+        for operation, value in current.items():
+            baseline = legacy[operation]
+            print('{:<10} {:<12} {:>14,.0f} {:>14,.0f} {:>7.2f}x'.format(name, operation, baseline, value, value / baseline))
@@ -0,0 +1,142 @@
+import argparse
+import json
+import os
+import random
+import time
+import zlib
+
+from compression import MEMORY_LEVEL, WINDOW_BITS, Compressor
+from sock import FRAGMENT_SIZE, HEADER_SIZE
+
+'''
+A benchmark of the compression of the chat packets (compression.py): the bytes on the wire with and without
+compression, and the CPU time it costs, for a few kinds of payloads:
+chat - short messages made of the words of the README
+logs - log lines like the ones the daemons print, several in a packet
+text - the README pasted in one message, sent in fragments
+code - the source of the daemon pasted in one message, sent in fragments
+Every payload is compressed without a dictionary and with the preset dictionary, at every level of --levels.
+The break-even is the speed of the link where compression saves as much time on the wire as it costs in CPU on the
+two daemons, on slower links compression makes the messages arrive sooner.
+--
+python3 bench_compression.py --levels 1 6 9
+--
+'''
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+
+def read(name):
+    with open(os.path.join(DIRECTORY, name), 'rb') as file:
+        return file.read().decode('ascii', 'replace').encode('ascii', 'replace')
+
+
+def fragments(data, size):
+    size -= HEADER_SIZE + FRAGMENT_SIZE
+    return [data[offset:offset + size] for offset in range(0, len(data), size)]
+
+
+def corpora(packets, fragment_bytes, seed):
+    randomizer = random.Random(seed)
+    words = read('README.md').split()
+    chat = [b' '.join(randomizer.choice(words) for _ in range(randomizer.randint(3, 40))) for _ in range(packets)]
+    levels = [b'INFO', b'WARNING', b'ERROR', b'DEBUG']
+    lines = [b'2026-10-18 14:%02d:%02d,%03d %s Message %d not acknowledged after %d resends, closing connection\n' % (
+        randomizer.randrange(60), randomizer.randrange(60), randomizer.randrange(1000), randomizer.choice(levels),
+        randomizer.randrange(100000), randomizer.randrange(9)) for _ in range(packets * 4)]
+    logs = [b''.join(lines[index:index + 4]) for index in range(0, len(lines), 4)]
+    return {
+        'chat': chat,
+        'logs': logs,
+        'text': fragments(read('README.md'), fragment_bytes),
+        'code': fragments(read('simp_daemon.py'), fragment_bytes)
+    }
+
+
+def plain_compressor(level):
+    # The compressor without the preset dictionary, with the same window, for the comparison
+    return zlib.compressobj(level, zlib.DEFLATED, WINDOW_BITS, MEMORY_LEVEL)
+
+
+def measure(payloads, level, dictionary, min_bytes):
+    # This function returns the bytes on the wire and the CPU time of compressing and decompressing every payload
+    compressor = Compressor(level, min_bytes)
+    wire = 0
+    compressed = []
+    start = time.process_time()
+    for payload in payloads:
+        if dictionary:
+            data = compressor.compress(payload)
+        elif len(payload) >= min_bytes:
+            plain = plain_compressor(level)
+            data = plain.compress(payload) + plain.flush()
+            data = data if len(data) < len(payload) else None
+        else:
+            data = None
+        compressed.append(data)
+        wire += HEADER_SIZE + len(data if data is not None else payload)
+    compress_time = time.process_time() - start
+    start = time.process_time()
+    for data, payload in zip(compressed, payloads):
+        if data is None:
+            continue
+        if dictionary:
+            result = compressor.decompress(data)
+        else:
+            result = zlib.decompressobj(WINDOW_BITS).decompress(data)
+        if result != payload:
+            raise Exception('The payload changed')
+    decompress_time = time.process_time() - start
+    return wire, compress_time, decompress_time
+
+
+def bench(args):
+    results = []
+    for name, payloads in corpora(args.packets, args.fragment_bytes, args.seed).items():
+        payloads = payloads * max(1, args.packets // len(payloads))
+        raw = sum(HEADER_SIZE + len(payload) for payload in payloads)
+        for level in args.levels:
+            for dictionary in (False, True):
+                wire, compress_time, decompress_time = measure(payloads, level, dictionary, args.min_bytes)
+                cpu = compress_time + decompress_time
+                saved = raw - wire
+                results.append({
+                    'corpus': name,
+                    'level': level,
+                    'dictionary': dictionary,
+                    'packets': len(payloads),
+                    'raw_bytes': raw,
+                    'wire_bytes': wire,
+                    'ratio': wire / raw,
+                    'compress_us': compress_time / len(payloads) * 1e6,
+                    'decompress_us': decompress_time / len(payloads) * 1e6,
+                    # Bytes saved per second of CPU, in megabits/s
+                    'break_even_mbps': saved * 8 / cpu / 1e6 if cpu > 0 else None
+                })
+    return results
+
+
+def report(results):
+    print('{:6} {:>5} {:>4} {:>8} {:>10} {:>10} {:>7} {:>11} {:>13} {:>11}'.format(
+        'corpus', 'level', 'dict', 'packets', 'raw bytes', 'wire bytes', 'ratio', 'compress us', 'decompress us',
+        'break-even'))
+    for result in results:
+        print('{corpus:6} {level:>5} {uses:>4} {packets:>8} {raw_bytes:>10} {wire_bytes:>10} {ratio:>7.3f} '
+              '{compress_us:>11.1f} {decompress_us:>13.1f} {break_even:>6.0f} Mb/s'.format(
+                  uses='yes' if result['dictionary'] else 'no', break_even=result['break_even_mbps'] or 0, **result))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Bytes on the wire and CPU time of the compression of chat packets')
+    parser.add_argument('--packets', type=int, default=2000, help='packets of every kind')
+    parser.add_argument('--levels', type=int, nargs='+', default=[1, 6, 9], help='zlib levels')
+    parser.add_argument('--min-bytes', type=int, default=128, help='shorter payloads are not compressed')
+    parser.add_argument('--fragment-bytes', type=int, default=1472, help='size of the fragment packets')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+    results = bench(args)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        report(results)
@@ -0,0 +1,94 @@
+import asyncio
+import socket
+import sys
+import time
+
+from batch_io import BatchedDatagramEndpoint
+from sock import SIMP_Socket
+
+
+class AckProtocol(asyncio.DatagramProtocol):
+    # Acknowledges every received packet, like the daemon does with the chat messages
+    def __init__(self):
+        self.transport = None
+        self.received = 0
+        self.ack = SIMP_Socket(type='control', operation='ack', sequence='response', user='bench', payload='').encode()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        self.received += 1
+        self.transport.sendto(self.ack, address)
+
+
+def blast(address, count, burst):
+    # Sends count chat packets in bursts, and waits for the acks of every burst
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(2)
+    packet = SIMP_Socket(type='chat', operation='message', sequence='request', user='bench', payload='x' * 64).encode()
+    acked = 0
+    for start in range(0, count, burst):
+        for _ in range(min(burst, count - start)):
+            sock.sendto(packet, address)
+        for _ in range(min(burst, count - start)):
+            try:
+                sock.recvfrom(4096)
+                acked += 1
+            except socket.timeout:
+                break
+    sock.close()
+    return acked
+
+
+async def run(batched, count, burst, port):
+    loop = asyncio.get_running_loop()
+    # The system calls of the event loop itself are counted by wrapping the selector
+    selector = loop._selector
+    select = selector.select
+    selects = [0]
+
+    def counting_select(timeout=None):
+        selects[0] += 1
+        return select(timeout)
+    selector.select = counting_select
+
+    protocol = AckProtocol()
+    if batched:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', port))
+        transport = BatchedDatagramEndpoint(loop, sock, protocol)
+        protocol.connection_made(transport)
+    else:
+        transport, _ = await loop.create_datagram_endpoint(lambda: protocol, local_addr=('127.0.0.1', port))
+    selects[0] = 0
+    start = time.perf_counter()
+    acked = await loop.run_in_executor(None, blast, ('127.0.0.1', port), count, burst)
+    elapsed = time.perf_counter() - start
+    if batched:
+        stats = transport.get_stats()
+        receive_calls, send_calls = stats['receive_calls'], stats['send_calls']
+    else:
+        # The asyncio datagram transport calls recvfrom once for every datagram, and sendto once for every datagram
+        receive_calls, send_calls = protocol.received, protocol.received
+    transport.close()
+    selector.select = select
+    return {
+        'delivered': protocol.received,
+        'acked': acked,
+        'msg/s': protocol.received / elapsed,
+        'syscalls/msg': (selects[0] + receive_calls + send_calls) / max(protocol.received, 1),
+        'selects': selects[0],
+        'receive_calls': receive_calls,
+        'send_calls': send_calls
+    }
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    burst = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    print('{} packets in bursts of {}'.format(count, burst))
+    for name, batched in (('asyncio', False), ('batched', True)):
+        result = asyncio.run(run(batched, count, burst, 47777))
+        print('{:<8} delivered {delivered:>7} msg/s {msg/s:>10,.0f} syscalls/msg {syscalls/msg:5.2f} '
+              '(select {selects}, receive {receive_calls}, send {send_calls})'.format(name, **result))
@@ -0,0 +1,137 @@
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from bench_simp import daemon_process, open_client, percentile, stop_daemon
+
+'''
+A benchmark of the rooms (rooms.py): one daemon hosts the room, the members are clients of --daemons other daemons on
+loopback, and one member sends --messages messages to the room. Every member counts the messages it got.
+It reports the delivered messages/s (one message to one member is one delivery), the end-to-end latency, and the CPU
+time and the datagrams of the hosting daemon per message sent to the room.
+--
+python3 bench_rooms.py --members 300 --daemons 4 --messages 500
+--
+'''
+
+
+class Member:
+    # A client in the room, the messages of the room are "<sender>: <number> <time sent>"
+    def __init__(self, index, messages):
+        self.index = index
+        self.client = None
+        self.received = bytearray(messages)
+        self.delivered = 0
+        self.latencies = []
+
+    async def join(self, daemon, room, local):
+        self.client = await open_client(daemon, local)
+        self.client.on_chat = self.chat_received
+        await self.client.login('m{}'.format(self.index))
+        self.client.send(b'\x05\x00start')
+        await self.client.expect(b'\x05')
+        self.client.send(b'\x05\x00' + '{}@{}:{}'.format(*room).encode())
+        await self.client.expect(b'\x06')
+
+    def chat_received(self, payload):
+        now = time.perf_counter_ns()
+        number, sent_at = payload.partition(b': ')[2].split(b'.', 1)[0].split(b' ')[:2]
+        number = int(number)
+        if not self.received[number]:
+            self.received[number] = 1
+            self.delivered += 1
+            self.latencies.append((now - int(sent_at)) / 1e9)
+
+
+async def bench(args):
+    ip = args.ip
+    host = (ip, args.port, args.port + 1)
+    daemons = [(ip, args.port + 2 + 2 * index, args.port + 3 + 2 * index) for index in range(args.daemons)]
+    options = dict(window_size=args.window)
+    directory = tempfile.mkdtemp()
+    stats_path = os.path.join(directory, 'host.json')
+    processes = [daemon_process(*host, options, stats_path)]
+    processes += [daemon_process(*daemon, options, os.path.join(directory, '{}.json'.format(index)))
+                  for index, daemon in enumerate(daemons)]
+    members = [Member(index, args.messages) for index in range(args.members)]
+    try:
+        await asyncio.sleep(args.startup)
+        room = ('#bench', ip, host[1])
+        for start in range(0, len(members), 50):
+            await asyncio.gather(*(member.join((ip, daemons[member.index % len(daemons)][2]), room, args.local)
+                                   for member in members[start:start + 50]))
+        sender = members[0]
+        receivers = members[1:]
+        start = time.perf_counter()
+        for number in range(args.messages):
+            if not sender.client.can_send.is_set():
+                await sender.client.can_send.wait()
+            payload = '{} {}'.format(number, time.perf_counter_ns()).encode()
+            sender.client.send(b'\x01\x01' + payload.ljust(args.size, b'.'))
+            if args.rate:
+                delay = start + (number + 1) / args.rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        expected = args.messages * len(receivers)
+        deadline = time.perf_counter() + args.timeout
+        while sum(member.delivered for member in receivers) < expected and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        elapsed = time.perf_counter() - start
+    finally:
+        stats, cpu = stop_daemon(processes[0], stats_path)
+        for index, process in enumerate(processes[1:]):
+            stop_daemon(process, os.path.join(directory, '{}.json'.format(index)))
+    delivered = sum(member.delivered for member in receivers)
+    latencies = sorted(latency for member in receivers for latency in member.latencies)
+    return {
+        'members': args.members,
+        'daemons': args.daemons,
+        'messages': args.messages,
+        'delivered': delivered,
+        'expected': expected,
+        'deliveries/s': delivered / elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'room_packets_sent': stats['room_packets_sent'],
+        'host_cpu': cpu,
+        'host_cpu_per_message': cpu / args.messages,
+        'datagrams_per_message': stats['io']['daemon']['datagrams_sent'] / args.messages if stats['io']['daemon']
+        else None,
+        'syscalls_per_message': stats['io']['daemon']['send_calls'] / args.messages if stats['io']['daemon'] else None
+    }
+
+
+def report(result):
+    print('{members} members on {daemons} daemons, delivered {delivered}/{expected} '
+          '{deliveries/s:,.0f} deliveries/s'.format(**result))
+    print('latency p50 {:.3f}ms p99 {:.3f}ms'.format(result['p50'] * 1000, result['p99'] * 1000))
+    print('host cpu {:.2f}s ({:.1f} us per message sent to the room)'.format(result['host_cpu'],
+                                                                             result['host_cpu_per_message'] * 1e6))
+    if result['datagrams_per_message'] is not None:
+        print('host datagrams {:.1f} and send calls {:.2f} per message'.format(result['datagrams_per_message'],
+                                                                               result['syscalls_per_message']))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='A room on loopback with many members, driven by synthetic clients')
+    parser.add_argument('--members', type=int, default=100, help='members of the room')
+    parser.add_argument('--daemons', type=int, default=4, help='daemons of the members')
+    parser.add_argument('--messages', type=int, default=500, help='messages sent to the room by the first member')
+    parser.add_argument('--size', type=int, default=64, help='size of the messages in bytes')
+    parser.add_argument('--rate', type=float, default=500, help='messages/s, 0 is as fast as possible')
+    parser.add_argument('--window', type=int, default=8, help='window size of the daemons')
+    parser.add_argument('--local', action='store_true', help='connect the members on the Unix domain sockets')
+    parser.add_argument('--ip', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18777, help='first of the ports used by the benchmark')
+    parser.add_argument('--startup', type=float, default=1.0, help='seconds to wait for the daemons to start')
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds to wait for the lost messages')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+    result = asyncio.run(bench(args))
+    if args.json:
+        print(json.dumps(result))
+    else:
+        report(result)
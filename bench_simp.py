@@ -0,0 +1,432 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from simp_daemon import SimpDaemon
+from simp_workers import WorkerPool
+from local_io import LocalConnection, local_socket_path
+
+
+class ImpairmentProxy:
+    '''
+    A UDP proxy between two daemons that drops, delays and reorders the datagrams.
+    --
+    The first daemon sends to the front address of the proxy, the proxy forwards the datagrams to the second daemon
+    from its back socket, and the answers of the second daemon go back the same way.
+    Every datagram is dropped with the probability loss, delayed by delay plus a random jitter, and held back for
+    reorder_delay more with the probability reorder, so the datagrams after it overtake it.
+    The random numbers come from a seeded generator, so a run can be repeated.
+    --
+    '''
+
+    def __init__(self, front_address, back_address, loss=0.0, delay=0.0, jitter=0.0, reorder=0.0,
+                 reorder_delay=0.002, seed=0):
+        self.front_address = front_address
+        self.back_address = back_address
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+        self.random = random.Random(seed)
+        self.front_transport = None
+        self.back_transport = None
+        # The address of the first daemon, the answers of the second daemon are sent to it
+        self.front_peer = None
+        self.forwarded = 0
+        self.dropped = 0
+        self.reordered = 0
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.front_transport, _ = await loop.create_datagram_endpoint(
+            lambda: ProxyProtocol(self.from_front), local_addr=self.front_address)
+        self.back_transport, _ = await loop.create_datagram_endpoint(
+            lambda: ProxyProtocol(self.from_back), local_addr=(self.back_address[0], 0))
+
+    def from_front(self, data, address):
+        self.front_peer = address
+        self.forward(self.back_transport, data, self.back_address)
+
+    def from_back(self, data, address):
+        if self.front_peer is not None:
+            self.forward(self.front_transport, data, self.front_peer)
+
+    def forward(self, transport, data, address):
+        if self.loss and self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        delay = self.delay + (self.random.uniform(0, self.jitter) if self.jitter else 0)
+        if self.reorder and self.random.random() < self.reorder:
+            self.reordered += 1
+            delay += self.reorder_delay
+        self.forwarded += 1
+        if delay > 0:
+            asyncio.get_running_loop().call_later(delay, self.send, transport, data, address)
+        else:
+            transport.sendto(data, address)
+
+    def send(self, transport, data, address):
+        # The delayed datagrams that are still held back when the proxy is closed are dropped
+        if not transport.is_closing():
+            transport.sendto(data, address)
+
+    def close(self):
+        self.front_transport.close()
+        self.back_transport.close()
+
+    def get_stats(self):
+        return {'forwarded': self.forwarded, 'dropped': self.dropped, 'reordered': self.reordered}
+
+
+class ProxyProtocol(asyncio.DatagramProtocol):
+    def __init__(self, callback):
+        self.callback = callback
+
+    def datagram_received(self, data, address):
+        self.callback(data, address)
+
+
+class BenchClient(asyncio.DatagramProtocol):
+    # A synthetic client that speaks the client protocol of the daemon without input()
+    def __init__(self, daemon_address):
+        self.daemon_address = daemon_address
+        self.transport = None
+        # The messages that are not chat messages, in the order they arrived
+        self.queue = asyncio.Queue()
+        # Called with the payload of every chat message
+        self.on_chat = None
+        self.parts = []
+        # Cleared while the daemon asks the client to pause
+        self.can_send = asyncio.Event()
+        self.can_send.set()
+        self.pauses = 0
+        self.dropped = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        type = data[:1]
+        if type == b'\x08':
+            self.parts.append(data[2:])
+        elif type == b'\x01':
+            payload = b''.join(self.parts) + data[2:] if self.parts else data[2:]
+            self.parts = []
+            if self.on_chat is not None:
+                self.on_chat(payload)
+        elif type == b'\x0a':
+            if data[2:] == b'pause':
+                self.pauses += 1
+                self.can_send.clear()
+            elif data[2:] == b'resume':
+                self.can_send.set()
+            else:
+                self.dropped += 1
+        elif type != b'\x0b':
+            # The acknowledgements of the sent messages are not needed here
+            self.queue.put_nowait(data)
+
+    def send(self, data):
+        self.transport.sendto(data, self.daemon_address)
+
+    async def expect(self, type, timeout=10):
+        # This function waits for a message of the given types (one byte each), the other messages are skipped
+        while True:
+            data = await asyncio.wait_for(self.queue.get(), timeout)
+            if data[:1] in type:
+                return data[2:]
+            if data[:1] == b'\x02':
+                raise Exception('Error from the daemon: ' + data[2:].decode())
+
+    async def login(self, username):
+        self.send(b'\x00\x01')
+        await self.expect(b'\x00')
+        await self.expect(b'\x00')
+        self.send(b'\x00\x01' + username.encode())
+        await self.expect(b'\x05')
+
+
+async def open_client(daemon_address, local=False):
+    # A local client is connected to the Unix domain socket of the daemon instead of using UDP
+    loop = asyncio.get_running_loop()
+    if local:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sock.connect(local_socket_path(*daemon_address))
+        client = BenchClient(daemon_address)
+        client.connection_made(LocalConnection(loop, sock, client, daemon_address))
+        return client
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+    sock.bind((daemon_address[0], 0))
+    _, client = await loop.create_datagram_endpoint(lambda: BenchClient(daemon_address), sock=sock)
+    return client
+
+
+def percentile(values, fraction):
+    # Nearest rank percentile of the sorted values
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+class Pair:
+    # A sending client on the first daemon connected to a receiving client on the second one
+    def __init__(self, index, messages, size):
+        self.index = index
+        self.messages = messages
+        self.size = size
+        self.sender = None
+        self.receiver = None
+        self.received = bytearray(messages)
+        self.delivered = 0
+        self.duplicates = 0
+        # The messages that arrived after a message that was sent later
+        self.out_of_order = 0
+        self.highest = -1
+        self.latencies = []
+        self.done = asyncio.Event()
+        # The time from sending the address of the other daemon until the chat was established, for every connect
+        self.setup_times = []
+
+    async def connect(self, first, second, target, local=False, answer_delay=0.0):
+        self.receiver = await open_client(second, local)
+        self.receiver.on_chat = self.chat_received
+        await self.receiver.login('r{}'.format(self.index))
+        self.receiver.send(b'\x05\x00wait')
+        self.sender = await open_client(first, local)
+        await self.sender.login('s{}'.format(self.index))
+        self.sender.send(b'\x05\x00start')
+        await self.sender.expect(b'\x05')
+        start = time.perf_counter()
+        self.sender.send(b'\x05\x00' + 'r{}@{}:{}'.format(self.index, *target).encode())
+        await asyncio.gather(self.established(start), self.answer(answer_delay))
+
+    async def established(self, start):
+        # The setup time is measured on the side of the sender, the chat can start when the SYNACK arrived
+        await self.sender.expect(b'\x06')
+        self.setup_times.append(time.perf_counter() - start)
+
+    async def answer(self, answer_delay):
+        # The daemon of the receiver accepts the requests of a known peer without asking
+        # answer_delay is the time the user takes to answer the prompt
+        if not (await self.receiver.expect(b'\x04\x06')).startswith(b'Connection established'):
+            await asyncio.sleep(answer_delay)
+            self.receiver.send(b'\x09\x01y')
+            await self.receiver.expect(b'\x06')
+
+    async def disconnect(self):
+        # The sender quits, the receiver is disconnected by the FIN, then both clients are closed
+        self.sender.send(b'\x03\x00')
+        await self.sender.expect(b'\x03')
+        await self.receiver.expect(b'\x03')
+        for client in (self.sender, self.receiver):
+            client.transport.close()
+
+    async def run(self, rate):
+        # The messages carry their number and the time they were sent, padded to the message size
+        start = time.perf_counter()
+        for number in range(self.messages):
+            if not self.sender.can_send.is_set():
+                await self.sender.can_send.wait()
+            payload = '{} {}'.format(number, time.perf_counter_ns()).encode()
+            self.sender.send(b'\x01\x01' + payload.ljust(self.size, b'.'))
+            if rate:
+                delay = start + (number + 1) / rate - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            elif number % 64 == 63:
+                await asyncio.sleep(0)
+
+    def chat_received(self, payload):
+        now = time.perf_counter_ns()
+        number, sent_at = payload.split(b'.', 1)[0].split(b' ')[:2]
+        number = int(number)
+        if self.received[number]:
+            self.duplicates += 1
+            return
+        self.received[number] = 1
+        if number < self.highest:
+            self.out_of_order += 1
+        self.highest = max(self.highest, number)
+        self.delivered += 1
+        self.latencies.append((now - int(sent_at)) / 1e9)
+        if self.delivered == self.messages:
+            self.done.set()
+
+
+def daemon_process(ip, daemon_port, client_port, options, stats_path, workers=0):
+    # The daemons run in their own processes, so their CPU time can be measured
+    # With workers the daemon is a supervisor with worker processes (simp_workers.py), their CPU time is counted too
+    command = [sys.executable, os.path.abspath(__file__), '--run-daemon', json.dumps(
+        {'ip': ip, 'daemon_port': daemon_port, 'client_port': client_port, 'options': options, 'stats': stats_path,
+         'workers': workers})]
+    return subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=None)
+
+
+async def run_daemon(config):
+    # Runs a daemon until SIGTERM, then writes its statistics to a file
+    daemon = SimpDaemon(config['ip'], config['daemon_port'], config['client_port'], **config['options'])
+    await daemon.start()
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    await stop.wait()
+    with open(config['stats'], 'w') as file:
+        json.dump(daemon.get_stats(), file)
+    daemon.close()
+
+
+async def run_pool(pool, config):
+    # Runs the supervisor of the workers until SIGTERM, then writes the added up statistics of the workers
+    stop = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stop.set)
+    serving = asyncio.ensure_future(pool.serve())
+    await stop.wait()
+    stats = await pool.get_stats()
+    with open(config['stats'], 'w') as file:
+        json.dump(stats, file)
+    pool.close()
+    await serving
+
+
+def stop_daemon(process, stats_path):
+    # Returns the statistics of the daemon and the CPU time it used
+    process.terminate()
+    _, _, usage = os.wait4(process.pid, 0)
+    process.returncode = 0
+    with open(stats_path) as file:
+        stats = json.load(file)
+    return stats, usage.ru_utime + usage.ru_stime
+
+
+async def bench(args):
+    ip = args.ip
+    first = (ip, args.port, args.port + 1)
+    second = (ip, args.port + 2, args.port + 3)
+    options = dict(window_size=args.window, aggregate_bytes=args.aggregate_bytes, aggregate_delay=args.aggregate_delay)
+    for option in args.option:
+        key, _, value = option.partition('=')
+        options[key] = json.loads(value)
+    directory = tempfile.mkdtemp()
+    stats_paths = [os.path.join(directory, 'first.json'), os.path.join(directory, 'second.json')]
+    processes = [daemon_process(*first, options, stats_paths[0], args.workers),
+                 daemon_process(*second, options, stats_paths[1], args.workers)]
+    proxy = None
+    try:
+        await asyncio.sleep(args.startup)
+        target = second[:2]
+        if args.loss or args.delay or args.jitter or args.reorder or args.proxy:
+            proxy = ImpairmentProxy((ip, args.port + 4), second[:2], loss=args.loss, delay=args.delay / 1000,
+                                    jitter=args.jitter / 1000, reorder=args.reorder, seed=args.seed)
+            await proxy.start()
+            target = proxy.front_address
+        pairs = [Pair(index, args.messages, args.size) for index in range(args.pairs)]
+        answer_delay = args.answer_delay / 1000
+        await asyncio.gather(*(pair.connect((ip, first[2]), (ip, second[2]), target, args.local, answer_delay)
+                               for pair in pairs))
+        start = time.perf_counter()
+        await asyncio.gather(*(pair.run(args.rate) for pair in pairs))
+        try:
+            await asyncio.wait_for(asyncio.gather(*(pair.done.wait() for pair in pairs)), args.timeout)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - start
+        if args.reconnect:
+            # The second setup with the same users is accepted by the peer cache of the daemon, without a prompt
+            await asyncio.gather(*(pair.disconnect() for pair in pairs))
+            await asyncio.gather(*(pair.connect((ip, first[2]), (ip, second[2]), target, args.local, answer_delay)
+                                   for pair in pairs))
+    finally:
+        results = [stop_daemon(process, path) for process, path in zip(processes, stats_paths)]
+        if proxy is not None:
+            proxy.close()
+    latencies = sorted(latency for pair in pairs for latency in pair.latencies)
+    delivered = sum(pair.delivered for pair in pairs)
+    return {
+        'pairs': args.pairs,
+        'messages': args.pairs * args.messages,
+        'delivered': delivered,
+        'duplicates': sum(pair.duplicates for pair in pairs),
+        'out_of_order': sum(pair.out_of_order for pair in pairs),
+        'dropped': sum(pair.sender.dropped for pair in pairs),
+        'pauses': sum(pair.sender.pauses for pair in pairs),
+        'msg/s': delivered / elapsed,
+        'p50': percentile(latencies, 0.5),
+        'p99': percentile(latencies, 0.99),
+        'p999': percentile(latencies, 0.999),
+        'max': latencies[-1] if latencies else float('nan'),
+        'setup': [percentile(sorted(pair.setup_times[attempt] for pair in pairs if len(pair.setup_times) > attempt), 0.5)
+                  for attempt in range(2 if args.reconnect else 1)],
+        'retransmits': [sum(peer['retransmits'] for peer in stats['peers'].values()) for stats, _ in results],
+        'expired_sessions': [stats['expired_sessions'] for stats, _ in results],
+        'cpu': [cpu for _, cpu in results],
+        'proxy': proxy.get_stats() if proxy is not None else None
+    }
+
+
+def report(result):
+    print('delivered {delivered}/{messages} (duplicates {duplicates}, out of order {out_of_order}, dropped {dropped}, '
+          'pauses {pauses}) '
+          '{msg/s:,.0f} msg/s'.format(**result))
+    print('latency p50 {:.3f}ms p99 {:.3f}ms p999 {:.3f}ms max {:.3f}ms'.format(
+        *(result[key] * 1000 for key in ('p50', 'p99', 'p999', 'max'))))
+    print('retransmits {} / {}, expired sessions {} / {}'.format(*result['retransmits'], *result['expired_sessions']))
+    print('cpu {:.2f}s / {:.2f}s ({:.1f} us/msg)'.format(
+        *result['cpu'], sum(result['cpu']) / max(result['delivered'], 1) * 1e6))
+    print('setup p50 ' + ' / '.join('{:.3f}ms'.format(setup * 1000) for setup in result['setup'])
+          + (' (first / cached)' if len(result['setup']) > 1 else ''))
+    if result['proxy'] is not None:
+        print('proxy forwarded {forwarded} dropped {dropped} reordered {reordered}'.format(**result['proxy']))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3 and sys.argv[1] == '--run-daemon':
+        config = json.loads(sys.argv[2])
+        if config['workers']:
+            # The workers are forked before the event loop of the supervisor starts
+            pool = WorkerPool(config['ip'], config['workers'], config['daemon_port'], config['client_port'],
+                              **config['options'])
+            pool.start()
+            asyncio.run(run_pool(pool, config))
+        else:
+            asyncio.run(run_daemon(config))
+        sys.exit(0)
+    parser = argparse.ArgumentParser(description='Two daemons on loopback, driven by synthetic clients')
+    parser.add_argument('--pairs', type=int, default=10, help='number of client pairs')
+    parser.add_argument('--messages', type=int, default=2000, help='messages sent by every pair')
+    parser.add_argument('--size', type=int, default=64, help='size of the messages in bytes')
+    parser.add_argument('--rate', type=float, default=1000, help='messages/s of every pair, 0 is as fast as possible')
+    parser.add_argument('--loss', type=float, default=0.0, help='probability that the proxy drops a datagram')
+    parser.add_argument('--reorder', type=float, default=0.0, help='probability that the proxy reorders a datagram')
+    parser.add_argument('--delay', type=float, default=0.0, help='one way delay of the proxy in ms')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random extra delay of the proxy in ms')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random decisions of the proxy')
+    parser.add_argument('--proxy', action='store_true', help='use the proxy even without impairments')
+    parser.add_argument('--window', type=int, default=8, help='window size of the daemons')
+    parser.add_argument('--aggregate-bytes', type=int, default=1472, help='0 turns off the message aggregation')
+    parser.add_argument('--aggregate-delay', type=float, default=0.01)
+    parser.add_argument('--local', action='store_true', help='connect the clients on the Unix domain sockets')
+    parser.add_argument('--reconnect', action='store_true',
+                        help='reconnect the pairs after the run and report the setup time with the peer cache')
+    parser.add_argument('--answer-delay', type=float, default=0.0, help='time the receivers take to accept in ms')
+    parser.add_argument('--workers', type=int, default=0, help='worker processes of every daemon, 0 is one process')
+    parser.add_argument('--option', action='append', default=[], help='other daemon option as key=json_value')
+    parser.add_argument('--ip', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=17777, help='first of the 5 ports used by the benchmark')
+    parser.add_argument('--startup', type=float, default=1.0, help='seconds to wait for the daemons to start')
+    parser.add_argument('--timeout', type=float, default=30.0, help='seconds to wait for the lost messages')
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+    result = asyncio.run(bench(args))
+    if args.json:
+        print(json.dumps(result))
+    else:
+        report(result)
@@ -0,0 +1,123 @@
+import zlib
+
+'''
+The compression of the chat packets between two daemons.
+--
+A daemon with compression offers it in the SYN: the payload of the SYN is the requested user, and the options of the
+daemon are in the next lines. The daemon that accepts the request answers with the options it agreed to in the SYNACK,
+after an empty first line. If both daemons have compression, the chat packets of the connection that are at least
+min_bytes long are compressed, and the COMPRESSED flag is set in their operation byte (sock.py). A packet that would not
+be smaller is sent as it is.
+--
+Every packet is compressed on its own (raw deflate, without the zlib header and checksum), so a lost or reordered packet
+does not stop the rest from being decompressed. The packets are short, so a preset dictionary of the usual words and
+phrases of chat messages and pasted log lines does most of the work: the first occurrence of a word in a packet is
+already a reference into the dictionary. The dictionary is part of the option (zlib-1), a new dictionary is a new option.
+--
+'''
+
+# The option of the handshake, the number is the version of the dictionary
+OPTION = 'zlib-1'
+
+# The preset dictionary, deflate finds the matches closer to the end of it in fewer bits, so the most common strings
+# are at the end
+DICTIONARY = (
+    b'Traceback (most recent call last):\n  File "/usr/lib/python3/dist-packages/", line , in <module>\n'
+    b'Exception: ValueError: TypeError: KeyError: AttributeError: RuntimeError: ConnectionRefusedError: '
+    b'TimeoutError: OSError: [Errno 111] Connection refused No such file or directory Permission denied '
+    b'at java.lang. NullPointerException undefined is not a function segmentation fault core dumped '
+    b'HTTP/1.1" 200 404 500 502 503 GET /api/v1/ POST /index.html Mozilla/5.0 (X11; Linux x86_64) '
+    b'127.0.0.1 localhost:8080 192.168.1. 10.0.0. https://www.github.com/ http://www. .com/ .org/ .html .json '
+    b'2024-01-01T00:00:00.000Z 2025- 2026- 00:00:00,000 UTC [INFO] [WARN] [ERROR] [DEBUG] '
+    b'INFO WARNING ERROR DEBUG CRITICAL level=info level=error msg=" status=ok user_id= request_id= '
+    b'{"id": 1, "name": "", "type": "", "value": null, "status": true, "error": false} '
+    b'def __init__(self, return None import from class if else elif for in while try except finally '
+    b'function const let var => console.log( print( self. this. true false null '
+    b'Monday Tuesday Wednesday Thursday Friday Saturday Sunday morning afternoon evening tonight tomorrow '
+    b'yesterday today minutes hours weekend meeting project deadline lecture assignment exam homework '
+    b'server client daemon connection message network packet socket address port error problem issue '
+    b'please could you would you can you let me know do you want to what do you think I think that '
+    b'thank you very much thanks a lot no problem sounds good see you later talk to you soon good night '
+    b'good morning how are you doing I am fine what about you I don\'t know I\'m not sure it\'s that\'s '
+    b'really actually probably maybe because something anything everything nothing someone everyone '
+    b'about after again also always any back been before being between both but by came come could '
+    b'day did does done down each even first from get give go going good got great had has have he '
+    b'her here him his how just know last like little look made make many more most much must my '
+    b'never new now of off old on one only or other our out over people right said same say see she '
+    b'should since so some still such take than them then there these they thing think those though '
+    b'through time too two up us use very want was way we well went were what when where which who '
+    b'why will with work would year yes you your the and that this with have for not are was '
+    b' the  and  to  of  a  in  is  it  you  that  I  for  on  be  with  this  have  are '
+    b'. The . I . It . We , and , but , so ? ! ... :) :D haha lol ok okay yes no hi hello hey '
+)
+
+# An 8 KB window holds the dictionary and a whole packet, and a small window and hash table make a compressor cheap to
+# create, which costs more than compressing a short payload
+WINDOW_BITS = -13
+MEMORY_LEVEL = 5
+
+# The largest payload a compressed packet can expand to, larger payloads are invalid (a packet is at most 64 KB)
+MAX_PAYLOAD = 65536
+
+
+class Compressor:
+    '''
+    The compression of the payloads with the preset dictionary, shared by the sessions of a daemon.
+    --
+    compress() - the compressed payload, or None if the payload is too short or it would not be smaller
+    decompress() - the payload of a compressed packet, or None if it is not valid
+    --
+    A compressor primed with the dictionary is copied for every payload, which is cheaper than setting the dictionary
+    again. The decompressor is created for every payload, that is cheaper than a copy.
+    '''
+
+    def __init__(self, level=6, min_bytes=128):
+        self.level = level
+        self.min_bytes = min_bytes
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, WINDOW_BITS, MEMORY_LEVEL, zlib.Z_DEFAULT_STRATEGY,
+                                           DICTIONARY)
+        # Counters
+        self.compressed = 0
+        self.skipped = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.decompressed = 0
+        self.invalid = 0
+
+    def compress(self, payload):
+        if len(payload) < self.min_bytes:
+            return None
+        compressor = self.compressor.copy()
+        data = compressor.compress(payload) + compressor.flush()
+        if len(data) >= len(payload):
+            self.skipped += 1
+            return None
+        self.compressed += 1
+        self.bytes_in += len(payload)
+        self.bytes_out += len(data)
+        return data
+
+    def decompress(self, data):
+        decompressor = zlib.decompressobj(WINDOW_BITS, DICTIONARY)
+        try:
+            payload = decompressor.decompress(data, MAX_PAYLOAD)
+        except zlib.error:
+            self.invalid += 1
+            return None
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            # The payload is larger than a packet can be, or the data is not complete
+            self.invalid += 1
+            return None
+        self.decompressed += 1
+        return payload
+
+    def stats(self):
+        return {
+            'compressed': self.compressed,
+            'skipped': self.skipped,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'ratio': self.bytes_out / self.bytes_in if self.bytes_in else None,
+            'decompressed': self.decompressed,
+            'invalid': self.invalid
+        }
@@ -0,0 +1,308 @@
+import itertools
+import os
+import socket
+import stat
+import struct
+import tempfile
+from collections import deque
+
+'''
+The local transport between the daemon and the clients on the same host.
+--
+The daemon listens on a Unix domain socket of the SOCK_SEQPACKET type next to its UDP socket for the clients, every
+client gets its own connection. The messages keep their boundaries like datagrams, but nothing is dropped: if the
+socket buffer of the other side is full the message waits in the outbound queue of the connection until it has room.
+Only if limit bytes are waiting (the other side stopped reading) are the next messages dropped, like the messages of a
+client that do not fit in the message buffer of its session.
+A client finds the socket by local_socket_path(), if there is none (the daemon runs on another host) it uses UDP.
+The socket is in a directory that only the user can use ($XDG_RUNTIME_DIR, or simp-<uid> in the temporary directory),
+and both sides check that the other side runs as the same user, so the chats are not handed to another user.
+--
+The endpoints have the interface of the asyncio datagram transports (sendto, close, get_stats) and call
+datagram_received(data, address) of their protocol, so the daemon and the clients handle both transports the same way.
+The address of a local client is a string, the addresses of the UDP clients are tuples.
+--
+'''
+
+# The largest message of the client protocol is a chat part: 2 bytes of header and 65000 bytes of payload
+RECEIVE_SIZE = 65536
+# A connection reads at most this many messages at once, so one busy client does not hold up the others
+READ_BATCH = 64
+# The bytes that wait in the outbound queue of a connection at most
+OUTBOUND_LIMIT = 8 * 1024 * 1024
+
+
+def local_socket_path(ip_address, port):
+    # The path of the Unix domain socket of the daemon that serves the clients on (ip_address, port)
+    # It returns None if there is no directory that only the user can use, then the clients use UDP
+    directory = local_socket_dir()
+    if directory is None:
+        return None
+    return os.path.join(directory, 'simp-{}-{}.sock'.format(ip_address, port))
+
+
+def local_socket_dir():
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime and is_private_dir(runtime):
+        return runtime
+    # The directory in the shared temporary directory is created by the first daemon or client of the user, if another
+    # user created it first it is not used
+    path = os.path.join(tempfile.gettempdir(), 'simp-{}'.format(os.getuid()))
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    except OSError:
+        return None
+    return path if is_private_dir(path) else None
+
+
+def is_private_dir(path):
+    # A directory (not a link to one) of the user that the other users cannot read or write
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and not info.st_mode & 0o077
+
+
+def peer_uid(sock):
+    # The user of the process on the other side of a connected socket, None where the system does not tell it
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return None
+    _, uid, _ = struct.unpack('3i', sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i')))
+    return uid
+
+
+def is_own_peer(sock):
+    uid = peer_uid(sock)
+    return uid is None or uid == os.getuid()
+
+
+def local_transport_supported():
+    return hasattr(socket, 'AF_UNIX') and hasattr(socket, 'SOCK_SEQPACKET')
+
+
+def listen_local_socket(path, backlog=128):
+    # The socket file left by a daemon that did not close is replaced, the UDP socket of the daemon is already bound
+    # so no running daemon uses it
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        sock.bind(path)
+        sock.listen(backlog)
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+
+class LocalConnection:
+    # One connected SOCK_SEQPACKET socket, every send and receive is one message of the client protocol
+    def __init__(self, loop, sock, protocol, address, on_close=None, batch=None, limit=OUTBOUND_LIMIT):
+        self.loop = loop
+        self.sock = sock
+        self.protocol = protocol
+        self.address = address
+        self.on_close = on_close
+        self.batch = batch
+        self.sock.setblocking(False)
+        # The messages that did not fit in the socket buffer of the other side yet, in order
+        self.outbound = deque()
+        self.outbound_bytes = 0
+        self.limit = limit
+        self.writing = False
+        self.messages_received = 0
+        self.messages_sent = 0
+        self.messages_dropped = 0
+        # Set when the connection is closed after the outbound queue was sent
+        self.closing = False
+        self.closed = False
+        self.loop.add_reader(self.sock.fileno(), self.read_ready)
+
+    def read_ready(self):
+        if self.batch is not None:
+            self.batch.begin()
+        try:
+            for _ in range(READ_BATCH):
+                try:
+                    data = self.sock.recv(RECEIVE_SIZE)
+                except (BlockingIOError, InterruptedError):
+                    return
+                except OSError as error:
+                    self.close(error)
+                    return
+                if not data:
+                    # The other side closed the connection
+                    self.close(ConnectionResetError('The connection was closed'))
+                    return
+                self.messages_received += 1
+                self.protocol.datagram_received(data, self.address)
+                if self.closed or self.closing:
+                    return
+        finally:
+            if self.batch is not None:
+                self.batch.end()
+
+    def sendto(self, data, address=None):
+        # The address is ignored, the connection has only one other side
+        if self.closed or self.closing:
+            return
+        if self.outbound:
+            self.queue(data)
+            return
+        try:
+            self.sock.send(data)
+        except (BlockingIOError, InterruptedError):
+            self.queue(data)
+            self.writing = True
+            self.loop.add_writer(self.sock.fileno(), self.write_ready)
+            return
+        except OSError as error:
+            self.close(error)
+            return
+        self.messages_sent += 1
+
+    def queue(self, data):
+        if self.outbound_bytes >= self.limit:
+            # The other side does not read its messages, they do not fit in the outbound queue
+            self.messages_dropped += 1
+            return
+        self.outbound.append(bytes(data))
+        self.outbound_bytes += len(data)
+
+    def write_ready(self):
+        while self.outbound:
+            try:
+                self.sock.send(self.outbound[0])
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as error:
+                self.close(error)
+                return
+            self.outbound_bytes -= len(self.outbound.popleft())
+            self.messages_sent += 1
+        self.loop.remove_writer(self.sock.fileno())
+        self.writing = False
+        if self.closing:
+            self.close()
+
+    def get_stats(self):
+        return {
+            'messages_received': self.messages_received,
+            'messages_sent': self.messages_sent,
+            'messages_dropped': self.messages_dropped,
+            'outbound': len(self.outbound),
+            'outbound_bytes': self.outbound_bytes
+        }
+
+    def close_when_sent(self):
+        # The connection is closed after the messages in the outbound queue were sent, nothing is read from it anymore
+        if not self.outbound:
+            self.close()
+        elif not self.closing:
+            self.closing = True
+            self.loop.remove_reader(self.sock.fileno())
+
+    def close(self, error=None):
+        # With an error the connection was lost, without it it was closed by this side
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.sock.fileno())
+        if self.writing:
+            self.loop.remove_writer(self.sock.fileno())
+        self.sock.close()
+        self.outbound.clear()
+        self.outbound_bytes = 0
+        if self.on_close is not None:
+            self.on_close(self, error)
+
+
+class LocalServer:
+    '''
+    The listening Unix domain socket of the daemon, it accepts the connections of the local clients.
+    sendto(data, address) sends on the connection of the client with the address, the messages to clients that
+    already disconnected are ignored. protocol.client_disconnected(address) is called when a client disconnects.
+    close_connection(address) closes the connection of a client after the messages to it were sent.
+    With sock the server accepts on a listening socket that was created by another process (the supervisor of the
+    workers), then the socket file is not removed when the server is closed.
+    '''
+
+    def __init__(self, loop, path, protocol, batch=None, backlog=128, sock=None, limit=OUTBOUND_LIMIT):
+        self.loop = loop
+        self.path = path
+        self.protocol = protocol
+        self.batch = batch
+        self.limit = limit
+        self.connections = {}
+        self.addresses = itertools.count()
+        self.accepted = 0
+        self.rejected = 0
+        self.owner = sock is None
+        if sock is None:
+            sock = listen_local_socket(path, backlog)
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.closed = False
+        self.loop.add_reader(self.sock.fileno(), self.accept_ready)
+
+    def accept_ready(self):
+        while not self.closed:
+            try:
+                sock, _ = self.sock.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                return
+            if not is_own_peer(sock):
+                # The client runs as another user
+                self.rejected += 1
+                sock.close()
+                continue
+            self.accepted += 1
+            address = 'local:{}'.format(next(self.addresses))
+            self.connections[address] = LocalConnection(self.loop, sock, self.protocol, address, self.connection_closed,
+                                                        self.batch, self.limit)
+
+    def connection_closed(self, connection, error):
+        self.connections.pop(connection.address, None)
+        if error is not None:
+            self.protocol.client_disconnected(connection.address)
+
+    def sendto(self, data, address):
+        connection = self.connections.get(address)
+        if connection is not None:
+            connection.sendto(data)
+
+    def close_connection(self, address):
+        connection = self.connections.get(address)
+        if connection is not None:
+            connection.close_when_sent()
+
+    def get_stats(self):
+        return {
+            'accepted': self.accepted,
+            'rejected': self.rejected,
+            'connections': len(self.connections),
+            'messages_received': sum(connection.messages_received for connection in self.connections.values()),
+            'messages_sent': sum(connection.messages_sent for connection in self.connections.values()),
+            'messages_dropped': sum(connection.messages_dropped for connection in self.connections.values())
+        }
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        for connection in list(self.connections.values()):
+            connection.close()
+        if self.owner:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,260 @@
+import logging
+import os
+import struct
+import threading
+import zlib
+
+'''
+The write-ahead log of the chat messages sent to the other daemons, so the messages that were not acknowledged can be
+sent again when the chat with the same peer starts again, after a lost connection or a restart of the daemon.
+--
+The log is a directory of segment files (segment-<number>.log), the records are only appended to the last one, and a
+new segment is started when it is larger than segment_bytes. A record is:
+crc32 (4 bytes), kind (1 byte), sequence number of the message (8 bytes), length of the rest (4 bytes)
+message: the length of the peer key (2 bytes), the peer key, the message as a SIMP chat packet
+ack: nothing, the message with the sequence number was acknowledged
+The peer key is "<user of this daemon>\\0<user of the other daemon>\\0<IP address of the other daemon>".
+--
+The records are written by a background thread, so the event loop never waits for the disk. The thread takes every
+record that was added while it was writing the previous ones, writes them at once and syncs the file once (group
+commit), so a message is on the disk a few milliseconds after it was sent. The message of an ack that arrives before
+the message was written is not written at all.
+A segment is removed when every message in it and in the segments before it was acknowledged, so the acks in it are
+not needed any more.
+--
+'''
+
+log = logging.getLogger('simp_daemon')
+
+RECORD = struct.Struct('!IBQI')
+RECORD_SIZE = RECORD.size
+KEY = struct.Struct('!H')
+MESSAGE = 1
+ACK = 2
+
+
+def peer_key(user, other_user, other_ip):
+    return '\0'.join((user, other_user, other_ip))
+
+
+def encode_record(kind, sequence, body=b''):
+    header = RECORD.pack(0, kind, sequence, len(body))
+    return struct.pack('!I', zlib.crc32(body, zlib.crc32(header[4:]))) + header[4:] + body
+
+
+def read_records(data):
+    # This function yields the kind, the sequence number and the body of the records, until the first one that is not
+    # complete or not valid (the end of the data written before a crash)
+    offset = 0
+    while offset + RECORD_SIZE <= len(data):
+        crc, kind, sequence, length = RECORD.unpack_from(data, offset)
+        end = offset + RECORD_SIZE + length
+        if end > len(data) or zlib.crc32(data[offset + RECORD_SIZE:end], zlib.crc32(data[offset + 4:offset + RECORD_SIZE])) != crc:
+            return
+        yield kind, sequence, data[offset + RECORD_SIZE:end]
+        offset = end
+
+
+class MessageLog:
+    '''
+    The log of the messages that were sent but not acknowledged yet.
+    --
+    append() - logs a message (a SIMP chat packet) for a peer, returns its sequence number
+    acknowledge() - the message with the sequence number does not have to be sent again
+    pending() - the messages of a peer that were not acknowledged, by sequence number
+    --
+    The index of the messages that were not acknowledged is kept in memory, by peer key and sequence number, so they
+    are never read back from the disk, only when the daemon starts.
+    '''
+
+    def __init__(self, directory, segment_bytes=4 * 1024 * 1024, fsync=True):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync = fsync
+        # The messages that were not acknowledged: by peer key the packets by sequence number, and the peer key of
+        # every sequence number
+        self.messages = {}
+        self.peers = {}
+        self.next_sequence = 0
+        # The records that the writer did not take yet, the messages by their sequence number and the acks by
+        # ('ack', sequence number), shared with the writer thread
+        self.unwritten = {}
+        self.condition = threading.Condition()
+        self.closing = False
+        self.writer = None
+        # These are only used by the writer thread: the segment every written message is in, the number of the messages
+        # that were not acknowledged in every segment, and the segment that is written
+        self.segments = {}
+        self.live = {}
+        self.file = None
+        self.segment = 0
+        self.segment_size = 0
+        # Counters
+        self.appended = 0
+        self.acknowledged = 0
+        self.skipped = 0
+        self.commits = 0
+        self.records_written = 0
+        self.bytes_written = 0
+        self.removed_segments = 0
+
+    def segment_path(self, segment):
+        return os.path.join(self.directory, 'segment-{:08d}.log'.format(segment))
+
+    def open(self):
+        # The existing segments are read to find the messages that were not acknowledged, then the writer starts on a new
+        # segment, so a record that was not complete at a crash is never followed by new ones
+        os.makedirs(self.directory, exist_ok=True)
+        numbers = sorted(int(name[8:-4]) for name in os.listdir(self.directory)
+                         if name.startswith('segment-') and name.endswith('.log'))
+        for segment in numbers:
+            with open(self.segment_path(segment), 'rb') as file:
+                data = file.read()
+            self.live[segment] = 0
+            for kind, sequence, body in read_records(data):
+                self.next_sequence = max(self.next_sequence, sequence + 1)
+                if kind == MESSAGE:
+                    length, = KEY.unpack_from(body)
+                    key = str(body[KEY.size:KEY.size + length], 'utf-8')
+                    self.messages.setdefault(key, {})[sequence] = body[KEY.size + length:]
+                    self.peers[sequence] = key
+                    self.segments[sequence] = segment
+                    self.live[segment] += 1
+                elif kind == ACK:
+                    self.forget(sequence)
+                    segment_of = self.segments.pop(sequence, None)
+                    if segment_of is not None:
+                        self.live[segment_of] -= 1
+        self.segment = numbers[-1] + 1 if numbers else 0
+        self.file = open(self.segment_path(self.segment), 'ab')
+        self.live[self.segment] = 0
+        self.remove_segments()
+        self.writer = threading.Thread(target=self.run, name='simp-message-log', daemon=True)
+        self.writer.start()
+        return sum(len(messages) for messages in self.messages.values())
+
+    def append(self, key, packet):
+        sequence = self.next_sequence
+        self.next_sequence += 1
+        self.messages.setdefault(key, {})[sequence] = packet
+        self.peers[sequence] = key
+        self.appended += 1
+        body = KEY.pack(len(key.encode('utf-8'))) + key.encode('utf-8') + packet
+        with self.condition:
+            self.unwritten[sequence] = encode_record(MESSAGE, sequence, body)
+            self.condition.notify()
+        return sequence
+
+    def acknowledge(self, sequence):
+        if not self.forget(sequence):
+            return
+        self.acknowledged += 1
+        with self.condition:
+            if self.unwritten.pop(sequence, None) is not None:
+                # The message was not written yet, neither it nor its ack is needed
+                self.skipped += 1
+                return
+            self.unwritten[('ack', sequence)] = encode_record(ACK, sequence)
+            self.condition.notify()
+
+    def forget(self, sequence):
+        key = self.peers.pop(sequence, None)
+        if key is None:
+            return False
+        messages = self.messages[key]
+        del messages[sequence]
+        if not messages:
+            del self.messages[key]
+        return True
+
+    def pending(self, key):
+        return dict(self.messages.get(key, {}))
+
+    def run(self):
+        # The writer thread, it writes everything that was added while it was writing the previous records
+        while True:
+            with self.condition:
+                while not self.unwritten and not self.closing:
+                    self.condition.wait()
+                records = list(self.unwritten.items())
+                self.unwritten.clear()
+                closing = self.closing
+            if records:
+                try:
+                    self.write(records)
+                except OSError as error:
+                    log.error("The message log could not be written: %s", error)
+            elif closing:
+                return
+
+    def write(self, records):
+        chunks = []
+        for key, record in records:
+            if self.segment_size >= self.segment_bytes:
+                self.commit(chunks)
+                chunks = []
+                self.file.close()
+                self.segment += 1
+                self.segment_size = 0
+                self.live[self.segment] = 0
+                self.file = open(self.segment_path(self.segment), 'ab')
+            if isinstance(key, tuple):
+                segment = self.segments.pop(key[1], None)
+                if segment is not None:
+                    self.live[segment] -= 1
+            else:
+                self.segments[key] = self.segment
+                self.live[self.segment] += 1
+            chunks.append(record)
+            self.segment_size += len(record)
+        self.commit(chunks)
+        self.remove_segments()
+
+    def commit(self, chunks):
+        if not chunks:
+            return
+        data = b''.join(chunks)
+        self.file.write(data)
+        self.file.flush()
+        if self.fsync:
+            os.fsync(self.file.fileno())
+        self.commits += 1
+        self.records_written += len(chunks)
+        self.bytes_written += len(data)
+
+    def remove_segments(self):
+        # The oldest segments are removed while every message in them was acknowledged
+        for segment in sorted(self.live):
+            if segment == self.segment or self.live[segment] > 0:
+                return
+            del self.live[segment]
+            try:
+                os.unlink(self.segment_path(segment))
+            except FileNotFoundError:
+                pass
+            self.removed_segments += 1
+
+    def close(self):
+        # The records that were added are written before the writer stops
+        with self.condition:
+            self.closing = True
+            self.condition.notify()
+        if self.writer is not None:
+            self.writer.join()
+            self.writer = None
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def stats(self):
+        return {
+            'pending': len(self.peers),
+            'appended': self.appended,
+            'acknowledged': self.acknowledged,
+            'skipped': self.skipped,
+            'commits': self.commits,
+            'records_written': self.records_written,
+            'bytes_written': self.bytes_written,
+            'segments': len(self.live),
+            'removed_segments': self.removed_segments
+        }
@@ -0,0 +1,124 @@
+import asyncio
+from bisect import bisect_left
+
+# The default buckets of the histograms of durations, in seconds
+TIME_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, value) for name, value in zip(names, values)) + '}'
+
+
+class Counter:
+    # A value that only grows, separately for every combination of the label values
+    # With a callback the value is read from it when the metrics are rendered, instead of being counted here
+    type = 'counter'
+
+    def __init__(self, name, help, labels=(), callback=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.callback = callback
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        values = self.callback() if self.callback is not None else self.values
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            yield self.name + format_labels(self.labels, label_values), value
+
+
+class Gauge(Counter):
+    # A value that can go up and down, usually read from a callback when the metrics are rendered
+    type = 'gauge'
+
+    def set(self, value, *label_values):
+        self.values[label_values] = value
+
+
+class Histogram:
+    # The number of the observed values in every bucket, their sum and their count
+    type = 'histogram'
+
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # The last count is for the values that are larger than every bucket
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            yield '{}_bucket{{le="{}"}}'.format(self.name, bound), total
+        yield '{}_bucket{{le="+Inf"}}'.format(self.name), self.count
+        yield self.name + '_sum', self.sum
+        yield self.name + '_count', self.count
+
+
+class Registry:
+    '''
+    The metrics of a daemon, rendered in the Prometheus text format.
+    --
+    Updating a metric is a dictionary or a list update, nothing is formatted until the metrics are rendered.
+    --
+    '''
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=(), callback=None):
+        return self.register(Counter(name, help, labels, callback))
+
+    def gauge(self, name, help, labels=(), callback=None):
+        return self.register(Gauge(name, help, labels, callback))
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.help))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for name, value in metric.samples():
+                lines.append('{} {}'.format(name, value))
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host, port):
+        # A minimal HTTP server, every request is answered with the metrics
+        return await asyncio.start_server(self.handle_request, host, port)
+
+    async def handle_request(self, reader, writer):
+        try:
+            # The request line and the headers are read until the empty line, the path is not checked
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 5)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            body = self.render().encode()
+            writer.write(b'HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n'
+                         + 'Content-Length: {}\r\n\r\n'.format(len(body)).encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
@@ -0,0 +1,57 @@
+import time
+from collections import OrderedDict
+
+
+class PeerCache:
+    '''
+    The peers that a user of the daemon had a chat with, so a new request from them can be accepted without asking.
+    --
+    key: (the user of this daemon, the address of the other daemon, the user on the other daemon)
+    An entry expires ttl seconds after the last chat with the peer started, and at most max_entries are kept,
+    the least recently used entry is evicted first. max_entries=0 turns the cache off.
+    --
+    '''
+
+    def __init__(self, max_entries=256, ttl=3600.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # The expiry time of every entry, from the least recently used to the most recently used
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def remember(self, user, address, other_user):
+        if self.max_entries <= 0:
+            return
+        key = (user, address, other_user)
+        self.entries[key] = time.monotonic() + self.ttl
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def known(self, user, address, other_user):
+        # This function returns True if the peer is in the cache and its entry did not expire
+        key = (user, address, other_user)
+        expires = self.entries.get(key)
+        if expires is not None and expires < time.monotonic():
+            del self.entries[key]
+            expires = None
+        if expires is None:
+            self.misses += 1
+            return False
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True
+
+    def forget(self, user, address, other_user):
+        self.entries.pop((user, address, other_user), None)
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
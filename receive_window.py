@@ -0,0 +1,71 @@
+'''
+The receive side of the sliding window of a connection: the chat packets of the other daemon are handed to the client
+once and in the order they were sent, also when they are sent again or arrive out of order.
+--
+The packets of a connection are numbered from 0 (modulo 2^32). The window keeps the number of the next packet that is
+handed to the client, and the packets after it that arrived early: a bit of one integer is set for every one of them
+(bit i is the packet next + i), and the packets are held until the packets before them arrive. A packet is
+- the next one: it is handed to the client, then the held packets after it, until the first missing one
+- before the next one, or a held one: it was sent again because its ack was lost, it is only acknowledged again
+- at most size - 1 after the next one: it is held and acknowledged
+- further ahead: it is dropped without an ack, the other daemon sends it again later
+The other daemon sends its packets at most receive_window after the oldest one that was not acknowledged, so with the
+same receive_window on both daemons a packet is only dropped if the held packets fill the reassembly bytes.
+--
+'''
+
+# The numbers are compared in a half of the number space, the packets before the next one are at most this far back
+HALF = 2 ** 31
+
+
+class ReceiveWindow:
+    '''
+    next - the number of the next packet that is handed to the client
+    received - the bits of the packets after the next one that arrived, bit i is the packet next + i
+    held - the held packets by their number, and the size of their payloads
+    --
+    offset() - how far a packet is after the next one, at least HALF if it is before it
+    is_duplicate() - the packet at the offset arrived already
+    hold() - keeps a packet that arrived before the packets before it
+    advance() - the next packet was handed to the client, returns the held packets that are in order now
+    '''
+
+    __slots__ = ('size', 'next', 'received', 'held', 'held_bytes')
+
+    def __init__(self, size=256):
+        self.size = size
+        self.next = 0
+        self.received = 0
+        self.held = {}
+        self.held_bytes = 0
+
+    def offset(self, number):
+        return (number - self.next) % 2 ** 32
+
+    def is_duplicate(self, offset):
+        return offset >= HALF or self.received >> offset & 1 == 1
+
+    def hold(self, offset, packet, size):
+        self.received |= 1 << offset
+        self.held[(self.next + offset) % 2 ** 32] = (packet, size)
+        self.held_bytes += size
+
+    def advance(self):
+        # The held packets are taken while they follow each other, the first missing one is the next one then
+        ready = []
+        while True:
+            self.next = (self.next + 1) % 2 ** 32
+            self.received >>= 1
+            if not self.received & 1:
+                return ready
+            packet, size = self.held.pop(self.next)
+            self.held_bytes -= size
+            ready.append(packet)
+
+    def flush(self):
+        # The held packets in order, with the missing ones skipped, when no more packets arrive
+        ready = [self.held[number][0] for number in sorted(self.held, key=self.offset)]
+        self.held.clear()
+        self.received = 0
+        self.held_bytes = 0
+        return ready
@@ -0,0 +1,178 @@
+from collections import deque
+
+from receive_window import ReceiveWindow
+from rto import RttEstimator
+from sock import user_field
+
+'''
+The group chats (rooms) hosted by a daemon.
+--
+A client joins the room #name on a daemon by starting a chat with #name@ip, its daemon sends a SYN for #name and the
+hosting daemon answers with a SYNACK from the user #name, so for the client the room is just another peer. The hosting
+daemon acknowledges the messages of the members and sends every message to the rest of the room, prefixed with the
+username of the sender: "<user>: <message>".
+--
+Every packet of the room is sent once to every daemon that has members in it, not to every member: the daemon of the
+members sends it to all of its clients in the room, except the one that sent the message. The packets of the room
+come from the user #name, the user they are for is in the payload: the acks of the messages of a member carry its
+username, the SYNACK carries the username, and an error starts with "<user>: ".
+--
+A packet of the room is encoded once, and the same buffer is sent to every daemon (with the batched endpoints the
+datagrams to all of them go out in one sendmmsg call). The packets are numbered by the room, every daemon acknowledges
+them with the same numbers. Every daemon of the room has a slot, the daemons that did not acknowledge a packet yet are
+the bits of one integer, so the state of a packet is the same size for hundreds of daemons as for one.
+--
+'''
+
+
+def slots(mask):
+    # This function yields the slots of the bits that are set in the mask, from the lowest one
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def split_sender(message):
+    # This function returns the sender of a message of a room and the message without the sender
+    sender, _, message = bytes(message).partition(b': ')
+    return sender.decode('ascii', 'replace'), message
+
+
+class Member:
+    # A member of a room, a user of another daemon (or of this one, through its own daemon port)
+    __slots__ = ('room', 'address', 'user', 'joined', 'reassembly', 'receive_window')
+
+    def __init__(self, room, address, user, window_size=256):
+        self.room = room
+        self.address = address
+        self.user = user
+        # The member gets the messages of the room after its daemon acknowledged the SYNACK
+        self.joined = False
+        # The messages of the member that are being reassembled from their fragments, like in the sessions
+        self.reassembly = {}
+        # The packets of the member are numbered from 0 by its session, they are sent to the room once and in order
+        self.receive_window = ReceiveWindow(window_size)
+
+    def key(self):
+        # The key of the member in the member table of the daemon, the user is in the form of the header
+        return (self.address, user_field(self.user))
+
+
+class Room:
+    '''
+    The state of one room on the hosting daemon.
+    --
+    members - by the key of the member
+    daemons - by the address of a daemon with joined members, the slot of the daemon and the number of its joined members
+    addresses - the addresses of the daemons by slot, the slots of the daemons that left are reused
+    joined - the mask of the slots of the daemons with joined members
+    buffer - the messages waiting for room in the window of the room, every item is the payload, the operation and
+             the member that sent it
+    in_flight - the packets that are not acknowledged by every daemon yet, keyed by their number
+                Every value is a list of the encoded packet, the time it was (re)sent, the time it is due, the number of
+                resends, the mask of the daemons that did not acknowledge it, and the operation of the packet
+    --
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.members = {}
+        self.daemons = {}
+        self.addresses = {}
+        self.free_slots = []
+        self.joined = 0
+        self.buffer = deque()
+        self.queued_bytes = 0
+        self.in_flight = {}
+        self.next_number = 0
+        self.next_message_id = 0
+        # The timeout is estimated from the time the last daemon acknowledged a packet
+        self.estimator = RttEstimator()
+        self.retransmit_timer = None
+
+    def add(self, address, user, window_size=256):
+        member = Member(self, address, user, window_size)
+        self.members[member.key()] = member
+        return member
+
+    def join(self, member):
+        member.joined = True
+        entry = self.daemons.get(member.address)
+        if entry is not None:
+            entry[1] += 1
+            return
+        slot = self.free_slots.pop() if self.free_slots else len(self.daemons)
+        self.daemons[member.address] = [slot, 1]
+        self.addresses[slot] = member.address
+        self.joined |= 1 << slot
+
+    def remove(self, member):
+        # When the last member of a daemon leaves, the daemon does not hold back the packets in flight any more
+        del self.members[member.key()]
+        member.room = None
+        if not member.joined:
+            return
+        entry = self.daemons[member.address]
+        entry[1] -= 1
+        if entry[1] > 0:
+            return
+        slot = entry[0]
+        bit = 1 << slot
+        del self.daemons[member.address]
+        del self.addresses[slot]
+        self.free_slots.append(slot)
+        self.joined &= ~bit
+        done = [number for number, entry in self.in_flight.items() if entry[4] == bit]
+        for entry in self.in_flight.values():
+            entry[4] &= ~bit
+        for number in done:
+            del self.in_flight[number]
+
+    def members_of(self, address):
+        return [member for member in self.members.values() if member.address == address]
+
+    def acknowledge(self, address, number):
+        # This function returns the entry of the packet if the daemon was the last one to acknowledge it
+        entry = self.in_flight.get(number)
+        daemon = self.daemons.get(address)
+        if entry is None or daemon is None:
+            return None
+        bit = 1 << daemon[0]
+        if not entry[4] & bit:
+            # The ack was sent again, or the packet was sent before the daemon joined
+            return None
+        entry[4] ^= bit
+        if entry[4]:
+            return None
+        del self.in_flight[number]
+        return entry
+
+    def take_number(self):
+        number = self.next_number
+        self.next_number = (self.next_number + 1) % 2 ** 32
+        return number
+
+    def take_message_id(self):
+        message_id = self.next_message_id
+        self.next_message_id = (self.next_message_id + 1) % 2 ** 32
+        return message_id
+
+    def cancel_retransmit_timer(self):
+        if self.retransmit_timer is not None:
+            self.retransmit_timer.cancel()
+            self.retransmit_timer = None
+
+
+class JoinedRoom:
+    # A room of another daemon that clients of this daemon joined, the packets of the room are sent to all of them
+    __slots__ = ('sessions', 'reassembly', 'receive_window')
+
+    def __init__(self):
+        # The sessions of the members by their username
+        self.sessions = {}
+        # The messages of the room that are being reassembled from their fragments, like in the sessions
+        self.reassembly = {}
+        # The packets of the room in order, the window starts at the first packet that arrives (the daemon can join
+        # while the room has packets in flight)
+        self.receive_window = None
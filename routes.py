@@ -0,0 +1,99 @@
+import time
+
+'''
+The routing table of a relay daemon: the next daemon on the way to every known user.
+--
+The daemons announce their users to their upstream relay in route packets, a relay announces the users it knows to its
+own upstream as well, one hop further. The payload of a route packet is one "<user> <hops>" line for every user, the
+hops are 0 for the users of the sending daemon. A user that disconnected is announced with MAX_HOPS, it is unreachable.
+The routes learned from the SYNACKs that passed through the relay are cached the same way.
+A route expires if it is not announced again in ttl seconds.
+--
+'''
+
+# A route of this many hops is unreachable, and a SYN that was relayed this many times is not relayed again
+MAX_HOPS = 8
+
+
+def pack_routes(routes, size):
+    # This function builds the payloads of the route packets of at most size bytes from (user, hops) pairs
+    payloads = []
+    lines = []
+    length = 0
+    for user, hops in routes:
+        line = '{} {}\n'.format(user, hops)
+        if lines and length + len(line) > size:
+            payloads.append(''.join(lines))
+            lines = []
+            length = 0
+        lines.append(line)
+        length += len(line)
+    if lines:
+        payloads.append(''.join(lines))
+    return payloads
+
+
+def unpack_routes(payload):
+    # This function returns the (user, hops) pairs of a route packet, the invalid lines are skipped
+    routes = []
+    for line in payload.splitlines():
+        user, _, hops = line.rpartition(' ')
+        if user and hops.isdigit():
+            routes.append((user, int(hops)))
+    return routes
+
+
+class RouteTable:
+    '''
+    The routes by username, every route is a list of the address of the next daemon, the hops to the user from
+    there and the time the route expires.
+    --
+    learn() - stores a route announced by (or learned from) the next daemon, unless a shorter one is known
+    lookup() - the address of the next daemon for a user, None if there is no route
+    announcement() - the routes to announce to a daemon, without the ones learned from it
+    --
+    '''
+
+    def __init__(self, ttl=90.0):
+        self.ttl = ttl
+        self.routes = {}
+        self.lookups = 0
+        self.misses = 0
+
+    def learn(self, user, address, hops):
+        route = self.routes.get(user)
+        if hops + 1 >= MAX_HOPS:
+            # The user is not reachable through that daemon any more
+            if route is not None and route[0] == address:
+                del self.routes[user]
+            return
+        now = time.time()
+        if route is None or route[2] < now or route[0] == address or hops + 1 <= route[1]:
+            self.routes[user] = [address, hops + 1, now + self.ttl]
+
+    def lookup(self, user):
+        self.lookups += 1
+        route = self.routes.get(user)
+        if route is not None and route[2] < time.time():
+            del self.routes[user]
+            route = None
+        if route is None:
+            self.misses += 1
+            return None
+        return route[0]
+
+    def announcement(self, address):
+        # Split horizon: the routes through the daemon are not announced back to it
+        return [(user, route[1]) for user, route in self.routes.items() if route[0] != address]
+
+    def expire(self):
+        now = time.time()
+        for user in [user for user, route in self.routes.items() if route[2] < now]:
+            del self.routes[user]
+
+    def stats(self):
+        return {
+            'routes': len(self.routes),
+            'lookups': self.lookups,
+            'misses': self.misses
+        }
@@ -0,0 +1,62 @@
+class RttEstimator:
+    '''
+    Retransmission timeout estimation for one peer, in the Jacobson/Karels style (RFC 6298):
+    --
+    srtt   = (1 - alpha) * srtt + alpha * sample
+    rttvar = (1 - beta) * rttvar + beta * |srtt - sample|
+    rto    = srtt + max(granularity, k * rttvar)
+    --
+    Every timeout doubles the rto (exponential backoff) until a new sample arrives, once for the packets that were sent
+    with the same rto.
+    '''
+
+    def __init__(self, initial_rto=1.0, min_rto=0.02, max_rto=60.0, alpha=0.125, beta=0.25, k=4, granularity=0.001):
+        self.initial_rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+        self.alpha = alpha
+        self.beta = beta
+        self.k = k
+        self.granularity = granularity
+        # Smoothed round trip time and its variation, None until the first sample
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        # When the rto was doubled the last time
+        self.backed_off_at = 0.0
+        # Counters for the packets that had to be sent again
+        self.retransmits = 0
+        self.backoffs = 0
+
+    def sample(self, rtt):
+        # This function updates the estimation with a measured round trip time
+        # Only call it for packets that were not retransmitted (Karn's algorithm)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - self.beta) * self.rttvar + self.beta * abs(self.srtt - rtt)
+            self.srtt = (1 - self.alpha) * self.srtt + self.alpha * rtt
+        self.rto = self.clamp(self.srtt + max(self.granularity, self.k * self.rttvar))
+
+    def backoff(self, sent_at, now):
+        # This function doubles the timeout after a retransmission timer ran out
+        # A packet that was sent before the last backoff was covered by it already, so packets that run out one after
+        # the other double the timeout once and not once each
+        if sent_at < self.backed_off_at:
+            return
+        self.backed_off_at = now
+        self.backoffs += 1
+        self.rto = self.clamp(self.rto * 2)
+
+    def clamp(self, rto):
+        return min(max(rto, self.min_rto), self.max_rto)
+
+    def stats(self):
+        return {
+            'rto': self.rto,
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            'retransmits': self.retransmits,
+            'backoffs': self.backoffs
+        }
@@ -0,0 +1,171 @@
+from collections import deque
+
+from sock import user_field
+
+
+class Session:
+    '''
+    The state of one client of the daemon, and of its connection with an other daemon.
+    --
+    Client states:
+    username - waiting for the username
+    waitorstart - waiting for the answer to wait or start
+    peerip - waiting for the other daemon's IP address
+    waiting - waiting for a connection request from an other daemon
+    connreq - waiting for the answer to a connection request
+    handshake - the handshake with the other daemon is in progress
+    chat - the connection with the other daemon is established
+    --
+    Handshake states:
+    None - there is no connection with an other daemon
+    syn_sent - the SYN was sent, waiting for the SYNACK
+    synack_sent - the SYNACK was sent, waiting for the ACK
+    established - the connection with the other daemon is established
+    --
+    '''
+
+    def __init__(self, client_address):
+        # This is used to store the client's address, and username
+        self.client_address = client_address
+        self.client_username = None
+        self.client_state = 'username'
+        # The address of the other daemon, and the user on the other daemon this session is connected with
+        self.other_daemon_address = None
+        self.other_username = None
+        # The user the client asked for when it started the connection, empty if any user can answer
+        self.target_username = ''
+        self.handshake_state = None
+        # The chat packets of the connection are compressed, both daemons agreed to it in the handshake
+        self.compression = False
+        # The time the SYN (or the SYNACK) was sent, to measure how long the handshake takes
+        self.handshake_started = None
+        # This is used to store the user and the address of the daemon that sent a request, until the client answers
+        self.pending_request_data = None
+        # The time the client was asked about the request, to measure how long it takes to answer
+        self.request_asked_at = None
+        # The number that the next packet sent to the other daemon gets
+        self.next_number = 0
+        # The messages that are sent but not yet acknowledged, keyed by their number
+        # Every value is a list of the message, the time it was (re)sent, the time it is due, the number of resends and
+        # the numbers of the messages of the client that are in it
+        self.in_flight = {}
+        # The messages of the client are numbered in the order they arrive, the client is told when they are acknowledged
+        # unacked_messages is the number of the packets of every message that are not acknowledged yet, in order
+        # Every message below acked_messages was acknowledged (or dropped)
+        self.next_client_message = 0
+        self.unacked_messages = {}
+        self.acked_messages = 0
+        # The messages of the message log that are sent again have negative numbers, they are not messages of the client
+        # log_sequences is the sequence number in the log of every message that is logged
+        self.next_replayed_message = -1
+        self.log_sequences = {}
+        # This is used to store the messages that are sent by the client, but not yet sent to the other daemon
+        # The size of their payloads is counted, the daemon asks the client to pause if too much is waiting
+        self.message_buffer = deque()
+        self.message_numbers = deque()
+        self.queued_bytes = 0
+        self.paused = False
+        # The time the oldest message of the message buffer was put there, and the timer that sends it if it waits
+        # for too long to be aggregated with the next messages
+        self.buffered_at = None
+        self.aggregate_timer = None
+        # The parts of a message of the client that is sent in more datagrams than one, and their size
+        self.client_parts = []
+        self.client_parts_size = 0
+        # The id that the next message sent in fragments gets
+        self.next_message_id = 0
+        # The messages of the other daemon that are being reassembled from their fragments, keyed by their id
+        # Every value is a list of the number of fragments, the received fragments by index, their size and the timer
+        # that drops the message if the rest of the fragments do not arrive in time
+        self.reassembly = {}
+        # The packets of the other daemon are handed to the client once and in order (receive_window.py), the window is
+        # created when the connection is established
+        self.receive_window = None
+        # The timer that runs out when the first in flight message is due to be resent
+        self.retransmit_timer = None
+        # The oldest packet in flight and the number of the packets after it that were acknowledged since it was sent
+        self.fast_retransmit_number = None
+        self.later_acks = 0
+        # The time the last packet arrived from the other daemon, the timer of the next keepalive and the number of the
+        # keepalives the other daemon did not answer
+        self.last_heard = None
+        self.keepalive_timer = None
+        self.missed_keepalives = 0
+        # The timer that gives up the SYN, or sends the SYNACK again, and the number of the SYNACK resends
+        self.handshake_timer = None
+        self.handshake_retries = 0
+        # The client quit, the FIN is sent after every message of the client was acknowledged
+        self.quitting = False
+        # This is used to indicate if the client sent a fin to close the connection, and the daemon is waiting for the ack
+        self.fin_sent = False
+        self.fin_number = None
+
+    def take_number(self):
+        # This function returns the number for the next packet sent to the other daemon
+        number = self.next_number
+        self.next_number = (self.next_number + 1) % 2 ** 32
+        return number
+
+    def take_message_id(self):
+        # This function returns the id for the next message that is sent in fragments
+        message_id = self.next_message_id
+        self.next_message_id = (self.next_message_id + 1) % 2 ** 32
+        return message_id
+
+    def take_client_message(self):
+        # This function returns the number of the next message of the client
+        number = self.next_client_message
+        self.next_client_message += 1
+        return number
+
+    def take_replayed_message(self):
+        # This function returns the number of the next message that is sent again from the message log
+        number = self.next_replayed_message
+        self.next_replayed_message -= 1
+        return number
+
+    def queue(self, packet, client_message):
+        # This function puts a packet to the end of the message buffer, with the number of the client's message in it
+        self.message_buffer.append(packet)
+        self.message_numbers.append(client_message)
+        self.queued_bytes += len(packet.payload)
+
+    def dequeue(self):
+        # This function takes the first packet of the message buffer and the number of the client's message in it
+        packet = self.message_buffer.popleft()
+        self.queued_bytes -= len(packet.payload)
+        return packet, self.message_numbers.popleft()
+
+    def peer_key(self):
+        # The key of the session in the session table of the other daemons, the user is in the form of the header
+        return (self.other_daemon_address, user_field(self.other_username or ''))
+
+    def handshake_key(self):
+        # The key of the session until the SYNACK arrives, the SYNACK can come from another port of the other daemon
+        # A request through a relay asks for user@daemon, the answer comes from the user
+        # The answers of a room are for one of its members, they carry the username of the client (rooms.py)
+        address = self.other_daemon_address
+        target = self.target_username.partition('@')[0]
+        if target[:1] == '#':
+            return (address[0] if address is not None else None, user_field(target), self.client_username)
+        return (address[0] if address is not None else None, user_field(target))
+
+    def cancel_retransmit_timer(self):
+        if self.retransmit_timer is not None:
+            self.retransmit_timer.cancel()
+            self.retransmit_timer = None
+
+    def cancel_keepalive_timer(self):
+        if self.keepalive_timer is not None:
+            self.keepalive_timer.cancel()
+            self.keepalive_timer = None
+
+    def cancel_handshake_timer(self):
+        if self.handshake_timer is not None:
+            self.handshake_timer.cancel()
+            self.handshake_timer = None
+
+    def cancel_aggregate_timer(self):
+        if self.aggregate_timer is not None:
+            self.aggregate_timer.cancel()
+            self.aggregate_timer = None
@@ -1,39 +1,253 @@
+import asyncio
+import logging
+import os
 import socket
 import sys
-import threading
 import time
+from collections import deque
 
-from sock import SIMP_Socket
+from batch_io import BatchedDatagramEndpoint, IoBatch
+from compression import OPTION as COMPRESSION, Compressor
+from metrics import Registry
+from peer_cache import PeerCache
+from receive_window import HALF, ReceiveWindow
+from routes import MAX_HOPS, RouteTable, pack_routes, unpack_routes
+from rooms import JoinedRoom, Room, slots, split_sender
+from rto import RttEstimator
+from session import Session
+from timers import TimerWheel
+from local_io import LocalServer, local_socket_path, local_transport_supported
+from message_log import MessageLog, peer_key
+from sock import (COMPRESSED, FRAGMENT, FRAGMENT_SIZE, FRAME_SIZE, HEADER_SIZE, SIMP_Socket, SimpPacket, join_options,
+                  pack_messages, split_message, split_options, unpack_messages, user_field)
+
+# The per-packet messages are logged at the debug level, they are only formatted if it is enabled
+log = logging.getLogger('simp_daemon')
+
+
+class DaemonProtocol(asyncio.DatagramProtocol):
+    # This endpoint receives the packets of the other daemons and hands them over to the daemon
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def datagram_received(self, data, address):
+        self.daemon.daemon_datagram_received(data, address)
+
+
+class ClientProtocol(asyncio.DatagramProtocol):
+    # This endpoint receives the messages of the client and hands them over to the daemon
+    def __init__(self, daemon):
+        self.daemon = daemon
+
+    def datagram_received(self, data, address):
+        self.daemon.client_datagram_received(data, address)
+
+
+class LocalClientProtocol(ClientProtocol):
+    # The clients on the same host are connected on the Unix domain socket (local_io.py)
+    def client_disconnected(self, address):
+        self.daemon.local_client_disconnected(address)
 
 
 class SimpDaemon:
-    def __init__(self, ip_address):
+    '''
+    Every packet is handled by one asyncio event loop, the daemon is a state machine driven by the two endpoints.
+    Every client of the daemon has its own session, the states of the sessions are described in session.py.
+    --
+    Session tables:
+    sessions - by the address of the client (a string for the local clients), used for the messages of the clients
+    sessions_by_username - by the username of the client, used for the requests that ask for a user
+    sessions_by_peer - by the address of the other daemon and the user on it, used for the packets of the other daemons
+    handshakes - by the IP address of the other daemon and the requested user, used until the SYNACK arrives
+    --
+    With relay the daemon forwards the connections of other daemons to the users it has a route to (routes.py):
+    circuits - by the address of the previous daemon and the user of the packets, every value is a list of the address
+               of the next daemon, the key of the circuit in the other direction, the time of the last packet, the
+               number of the FIN sent through it and the timer that removes the circuit when it is idle
+    relay_handshakes - by the IP address of the next daemon and the requested user, until the SYNACK arrives
+    The packets of a circuit are forwarded as they are, the sliding window and the acks are between the two end daemons.
+    --
+    The daemon hosts the rooms (group chats) that its clients or the clients of other daemons join (rooms.py):
+    rooms - by the name of the room
+    room_members - by the address of the daemon of the member and the user of the member, like sessions_by_peer
+    joined_rooms - the rooms of other daemons that the clients joined, by the address of the daemon and the room, the
+                   sessions of these clients are not in sessions_by_peer
+    --
+    With worker (simp_workers.py) the daemon is one of the worker processes of a multi-process daemon: the daemon and
+    the client ports are shared with the other workers (SO_REUSEPORT), the packets of the connections are sent and
+    received on an own port of the worker, and the requests for the users of other workers go through the supervisor.
+    --
+    '''
+
+    def __init__(self, ip_address, daemon_port=7777, client_port=7778, window_size=8, max_retries=8,
+                 max_clients=1024, max_pending_requests=64, batched_io=True, aggregate_bytes=1472,
+                 aggregate_delay=0.01, fragment_bytes=1472, max_message_bytes=16 * 1024 * 1024,
+                 max_reassembly_bytes=64 * 1024 * 1024, reassembly_timeout=30.0, queue_high_water=1024 * 1024,
+                 queue_limit=8 * 1024 * 1024, metrics_port=None, local_socket=True, peer_cache_size=256,
+                 peer_cache_ttl=3600.0, auto_accept=True, allow_list=(), relay=False, upstream=None,
+                 route_interval=30.0, relay_idle_timeout=300.0, max_room_members=1024, message_log=None, compression=False,
+                 compression_level=6, compress_min_bytes=128, keepalive_interval=15.0, keepalive_misses=3,
+                 handshake_timeout=120.0, receive_window=256, worker=None):
         self.ip_address = ip_address
-        self.daemon_port = 7777
-        self.client_port = 7778
-        self.daemon_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        # This is used to store the client's address, and username
-        self.client_address = None
-        self.client_username = None
-        # Value is true if a client is connected
-        self.client_connected = False
-        # This stores the IP address of the other daemon that is connected
-        self.other_daemon_ip = None
-        # These are necessary for the stop and wait which is only used for the chat messages
-        self.message_sent = False
-        self.ack_received = False
-        # The value of this is true if the other daemon is connected
-        self.other_daemon_connected = False
-        # This is used to indicate if there is a pending request before the client connects
-        self.pending_request = False
-        self.pending_request_data = None
-        # This is used to indicate if the client sent a fin to close the connection, and the daemon is waiting for the ack
-        self.fin_sent = False
-        # This is used to store the messages that are sent by the client, but not yet acknowledged by the other daemon
-        self.message_buffer = []
-        # This is used to store the value of the client's response to the pending request
-        self.accepted = None
+        self.daemon_port = daemon_port
+        self.client_port = client_port
+        # The transports of the two endpoints, they are created when the daemon starts
+        # With batched_io the sockets are read and written in batches (batch_io.py), otherwise by asyncio
+        self.batched_io = batched_io
+        self.io_batch = IoBatch()
+        self.daemon_transport = None
+        self.client_transport = None
+        # The link of a worker to the supervisor of a multi-process daemon, and the daemon port shared by the workers
+        self.worker = worker
+        self.listen_transport = None
+        # The clients on the same host can connect on a Unix domain socket instead of UDP (local_io.py), the
+        # messages on it are not dropped, a full socket buffer only delays them
+        self.local_path = local_socket_path(ip_address, client_port)
+        self.local_socket = local_socket and local_transport_supported() and self.local_path is not None
+        self.local_transport = None
+        # The session tables, every lookup of an incoming datagram is a single dictionary access
+        self.sessions = {}
+        self.sessions_by_username = {}
+        self.sessions_by_peer = {}
+        self.handshakes = {}
+        # The sessions of the clients that are waiting for a request, in the order they started waiting
+        self.waiting_sessions = {}
+        # The requests that arrived before the requested user (or any user) was ready to answer, by the requested user
+        self.pending_requests = {}
+        self.max_clients = max_clients
+        self.max_pending_requests = max_pending_requests
+        # The peers that the users had a chat with are kept in the peer cache (peer_cache.py), with auto_accept their
+        # new requests are accepted without asking the client, so the chat starts one round trip after the SYN
+        # The peers of the allow list ([user@]ip[:port], without a user any user of that daemon) are always accepted
+        self.peer_cache = PeerCache(peer_cache_size, peer_cache_ttl)
+        self.auto_accept = auto_accept
+        self.allow_list = {self.parse_other_daemon(peer) for peer in allow_list}
+        # Number of the requests that were accepted without asking the client
+        self.auto_accepted = 0
+        # With relay the daemon forwards the requests for the users it does not have to the next daemon on the route
+        # The daemon announces its users (and with relay the users it has routes to) to the upstream relay
+        # ([ip][:port]) every route_interval seconds, the requests for a user without a route go to the upstream relay
+        # The circuits without packets for relay_idle_timeout seconds are removed
+        self.relay = relay
+        self.upstream = self.parse_other_daemon(upstream)[1] if upstream else None
+        self.route_interval = route_interval
+        self.relay_idle_timeout = relay_idle_timeout
+        self.routes = RouteTable(3 * route_interval)
+        self.circuits = {}
+        self.relay_handshakes = {}
+        self.route_timer = None
+        # Number of the packets forwarded on the circuits
+        self.relayed_packets = 0
+        # The rooms are created when the first member joins and removed when the last one leaves
+        self.rooms = {}
+        self.room_members = {}
+        self.joined_rooms = {}
+        self.max_room_members = max_room_members
+        # Number of the packets sent to the members of the rooms, and of the members removed because they stopped
+        # acknowledging the packets
+        self.room_packets_sent = 0
+        self.expired_members = 0
+        # With message_log (a directory) the messages sent to the other daemons are logged on the disk until they are
+        # acknowledged (message_log.py), the messages that were not acknowledged when a chat ended are sent again when
+        # the client starts a chat with the same user of the same daemon, also after a restart
+        # The workers of a multi-process daemon have their own logs in the directory
+        if message_log is not None and worker is not None:
+            message_log = os.path.join(message_log, 'worker-{}'.format(worker.index))
+        self.message_log = MessageLog(message_log) if message_log is not None else None
+        # Number of the messages sent again from the log
+        self.replayed_messages = 0
+        # With compression the daemon offers compression in the handshakes (compression.py), the chat packets of the
+        # connections where the other daemon agreed to it are compressed if they are at least compress_min_bytes long
+        self.compressor = Compressor(compression_level, compress_min_bytes) if compression else None
+        # These are necessary for the sliding window which is only used for the chat messages
+        # window_size is the maximum number of chat messages that can be sent without being acknowledged
+        self.window_size = window_size
+        # The retransmission timeout is estimated from the round trip times, separately for every other daemon
+        self.rtt_estimators = {}
+        # If a message is resent this many times without an ack the connection is closed
+        self.max_retries = max_retries
+        # Number of the connections that were closed because of too many resends
+        self.expired_sessions = 0
+        # The timers of the sessions are on one timing wheel (timers.py)
+        self.timers = TimerWheel()
+        # A request that is not answered in handshake_timeout seconds is given up (the other user can take its time to
+        # answer), a SYNACK that is not acknowledged is sent again like the chat packets
+        self.handshake_timeout = handshake_timeout
+        # The user of the connections closed by a FIN of the other daemon and the timer that forgets them after
+        # closed_wait seconds, by the key of the session
+        self.closed_connections = {}
+        self.closed_wait = 60.0
+        # Number of the requests that were not answered in time
+        self.expired_handshakes = 0
+        # When nothing arrives from the other daemon of a connection for keepalive_interval seconds a keepalive is sent
+        # to it, after keepalive_misses keepalives without an answer the other daemon is dead and the connection is
+        # closed, 0 turns the keepalives off
+        self.keepalive_interval = keepalive_interval
+        self.keepalive_misses = keepalive_misses
+        self.keepalives_sent = 0
+        self.dead_peers = 0
+        # The retransmits counted by the estimators of the other daemons that were removed
+        self.removed_retransmits = 0
+        # The chat messages of the client are aggregated into batch packets of at most aggregate_bytes (the size of
+        # the datagram that fits in one ethernet frame by default), 0 sends every message in its own packet
+        # While older packets are not acknowledged a batch that is not full waits at most aggregate_delay seconds
+        # for more messages, 0 only aggregates the messages that are already waiting for room in the window
+        self.aggregate_bytes = aggregate_bytes
+        self.aggregate_delay = aggregate_delay
+        # Number of the batch packets sent and of the messages in them
+        self.batches_sent = 0
+        self.batched_messages = 0
+        # The messages that do not fit in a packet of fragment_bytes are sent in fragments, so the datagrams are never
+        # fragmented by IP, a message can be at most max_message_bytes
+        self.fragment_bytes = fragment_bytes
+        self.max_message_bytes = max_message_bytes
+        # The fragments of the messages that are being reassembled can use at most max_reassembly_bytes together,
+        # a message is dropped if its fragments do not arrive in reassembly_timeout seconds
+        self.max_reassembly_bytes = max_reassembly_bytes
+        self.reassembly_timeout = reassembly_timeout
+        self.reassembly_bytes = 0
+        # Number of the fragments sent, the messages reassembled and the messages dropped before they were complete
+        # (because their fragments did not arrive in time, or did not agree on the number of fragments)
+        self.fragments_sent = 0
+        self.messages_reassembled = 0
+        self.reassembly_drops = 0
+        self.invalid_fragments = 0
+        # The messages to and from the clients are sent in parts of at most this size, so they fit in a datagram
+        self.client_part_bytes = 65000
+        # If more than queue_high_water bytes are waiting in the message buffer of a session the client is asked to
+        # pause, and to resume when it is down to the half of it
+        # The messages that arrive while queue_limit bytes are waiting are dropped
+        self.queue_high_water = queue_high_water
+        self.queue_limit = queue_limit
+        # Number of the times the clients were asked to pause, and of the messages dropped because of a full buffer
+        self.backpressure_events = 0
+        self.dropped_messages = 0
+        # Number of the packets of the other daemons that could not be decoded or matched to a session, and of the
+        # messages of the clients that were too large or not UTF-8
+        self.invalid_packets = 0
+        self.unmatched_packets = 0
+        self.oversized_messages = 0
+        self.invalid_client_messages = 0
+        self.reassembly_full = 0
+        # The chat packets of the other daemon are handed to the client in order, up to receive_window packets after a
+        # missing one are held until it is sent again, their payloads count in the reassembly bytes
+        # The packets sent to the other daemon are also at most receive_window after the oldest one that was not
+        # acknowledged, so the other daemon can hold them
+        # Number of the packets that arrived again, that were held and that were too far ahead to be held
+        self.receive_window = receive_window
+        # The oldest packet in flight is sent again when fast_retransmit_acks packets after it were acknowledged
+        self.fast_retransmit_acks = 3
+        self.fast_retransmits = 0
+        self.duplicate_packets = 0
+        self.held_packets = 0
+        self.window_drops = 0
+        # The metrics are served in the Prometheus text format on metrics_port, if it is set
+        # The per-packet debug messages are only logged if the debug level was enabled before the daemon was created
+        self.metrics_port = metrics_port
+        self.metrics_server = None
+        self.debug = log.isEnabledFor(logging.DEBUG)
+        self.metrics = Registry()
+        self.register_metrics()
         # These are the control types for the communication between the client and the daemon
         self.controlTypes = {
             b"\x00": "connect",
@@ -44,379 +258,1671 @@ class SimpDaemon:
             b"\x05": "waitorstart",
             b'\x06': 'connestab',
             b'\x09': 'yesno',
-            b'\x07': 'reask'
+            b'\x07': 'reask',
+            b'\x08': 'chatpart',
+            b'\x0a': 'backpressure',
+            b'\x0b': 'acked'
         }
-        self.start()
 
-    def start(self):
-        self.daemon_socket.bind((self.ip_address, self.daemon_port))
-        print(f"Daemon-to-daemon socket running on IP {self.ip_address} and port {self.daemon_port}")
-        self.client_socket.bind((self.ip_address, self.client_port))
+    async def start(self):
+        if self.message_log is not None:
+            pending = self.message_log.open()
+            print(f"Message log in {self.message_log.directory}, {pending} messages to send again")
+        if self.worker is None:
+            self.daemon_transport = await self.create_endpoint(self.bind_socket(self.daemon_port), DaemonProtocol(self))
+            print(f"Daemon-to-daemon socket running on IP {self.ip_address} and port {self.daemon_port}")
+        else:
+            # The other daemons send the SYNs to the shared port, and the rest of the packets of a connection to the
+            # port the SYN or the SYNACK came from, which is the own port of the worker that has the session
+            sock = self.bind_socket(0)
+            own_port = sock.getsockname()[1]
+            self.daemon_transport = await self.create_endpoint(sock, DaemonProtocol(self))
+            self.listen_transport = await self.create_endpoint(self.bind_socket(self.daemon_port, reuse_port=True),
+                                                               DaemonProtocol(self))
+            print(f"Worker {self.worker.index}: daemon-to-daemon socket running on IP {self.ip_address} and port "
+                  f"{self.daemon_port} (own port {own_port})")
+        self.client_transport = await self.create_endpoint(
+            self.bind_socket(self.client_port, reuse_port=self.worker is not None), ClientProtocol(self))
         print(f"Daemon-to-client socket running on IP {self.ip_address} and port {self.client_port}")
-        listen_to_client_thread = threading.Thread(target=self.listen_to_client)
-        listen_to_client_thread.start()
-        handshake_receiver_thread = threading.Thread(target=self.handshake_receiver)
-        handshake_receiver_thread.start()
-        message_forwarder_thread = threading.Thread(target=self.message_forwarder)
-        message_forwarder_thread.start()
-
-    def listen_to_client(self):
-        # This function continuously listens for messages from the client
-        # Determines the action based on the type of the message
-        while True:
-            message, address = self.client_socket.recvfrom(4096)
-            type = self.controlTypes[message[:1]]
-            message = message[2:].decode()
-            # If the control type is connect, then the client is trying to connect to the daemon
+        if self.local_socket:
+            try:
+                self.local_transport = LocalServer(asyncio.get_running_loop(), self.local_path,
+                                                   LocalClientProtocol(self), self.io_batch,
+                                                   sock=self.worker.local_sock if self.worker is not None else None,
+                                                   limit=self.queue_limit)
+                print(f"Daemon-to-client socket for the local clients running on {self.local_path}")
+            except OSError as error:
+                # The local clients use UDP as well
+                log.warning("The local socket %s could not be created: %s", self.local_path, error)
+        if self.metrics_port is not None:
+            self.metrics_server = await self.metrics.serve(self.ip_address, self.metrics_port)
+            print(f"Metrics served on http://{self.ip_address}:{self.metrics_port}/metrics")
+        if self.worker is not None:
+            self.worker.start(asyncio.get_running_loop(), self)
+        if self.relay or self.upstream is not None:
+            if self.relay:
+                print("Relaying the requests for the users of other daemons")
+            self.maintain_routes()
+
+    def register_metrics(self):
+        # The counters of the hot path are updated where the packets are handled, the rest is read when the
+        # metrics are rendered
+        metrics = self.metrics
+        sessions = self.sessions.values
+        self.packets_received = metrics.counter('simp_packets_received_total', 'Packets received from other daemons',
+                                                ('type', 'operation'))
+        self.packets_sent = metrics.counter('simp_packets_sent_total', 'Packets sent to other daemons',
+                                            ('type', 'operation'))
+        self.daemon_bytes_received = 0
+        self.daemon_bytes_sent = 0
+        metrics.counter('simp_bytes_received_total', 'Bytes received from other daemons',
+                        callback=lambda: self.daemon_bytes_received)
+        metrics.counter('simp_bytes_sent_total', 'Bytes sent to other daemons', callback=lambda: self.daemon_bytes_sent)
+        if self.compressor is not None:
+            compressor = self.compressor
+            metrics.counter('simp_compression_bytes_in_total', 'Payload bytes of the chat packets that were compressed',
+                            callback=lambda: compressor.bytes_in)
+            metrics.counter('simp_compression_bytes_out_total', 'Payload bytes of the chat packets after compression',
+                            callback=lambda: compressor.bytes_out)
+        self.client_datagrams_received = metrics.counter('simp_client_datagrams_received_total',
+                                                         'Datagrams received from clients', ('type',))
+        self.client_datagrams_sent = 0
+        metrics.counter('simp_client_datagrams_sent_total', 'Datagrams sent to clients',
+                        callback=lambda: self.client_datagrams_sent)
+        metrics.counter('simp_retransmits_total', 'Packets sent again because their ack did not arrive in time',
+                        callback=lambda: self.removed_retransmits + sum(estimator.retransmits
+                                                                        for estimator in self.rtt_estimators.values()))
+        metrics.counter('simp_expired_sessions_total', 'Connections closed because the other daemon did not answer',
+                        callback=lambda: self.expired_sessions)
+        metrics.counter('simp_keepalives_sent_total', 'Keepalives sent to the other daemons of idle connections',
+                        callback=lambda: self.keepalives_sent)
+        metrics.counter('simp_dead_peers_total', 'Connections closed because the other daemon did not answer the '
+                        'keepalives', callback=lambda: self.dead_peers)
+        metrics.counter('simp_batches_sent_total', 'Batch packets sent', callback=lambda: self.batches_sent)
+        metrics.counter('simp_batched_messages_total', 'Messages sent in batch packets',
+                        callback=lambda: self.batched_messages)
+        metrics.counter('simp_fragments_sent_total', 'Fragment packets sent', callback=lambda: self.fragments_sent)
+        metrics.counter('simp_messages_reassembled_total', 'Messages reassembled from fragments',
+                        callback=lambda: self.messages_reassembled)
+        metrics.counter('simp_backpressure_total', 'Times the clients were asked to pause',
+                        callback=lambda: self.backpressure_events)
+        metrics.counter('simp_drops_total', 'Packets and messages dropped by the daemon', ('reason',),
+                        callback=lambda: {
+                            ('invalid_packet',): self.invalid_packets,
+                            ('invalid_client_message',): self.invalid_client_messages,
+                            ('no_session',): self.unmatched_packets,
+                            ('queue_full',): self.dropped_messages,
+                            ('message_too_large',): self.oversized_messages,
+                            ('reassembly_full',): self.reassembly_full,
+                            ('reassembly_timeout',): self.reassembly_drops,
+                            ('invalid_fragment',): self.invalid_fragments,
+                            ('receive_window_full',): self.window_drops
+                        })
+        metrics.counter('simp_fast_retransmits_total', 'Packets sent again after later packets were acknowledged',
+                        callback=lambda: self.fast_retransmits)
+        metrics.counter('simp_duplicate_packets_total', 'Chat packets that arrived again, only acknowledged again',
+                        callback=lambda: self.duplicate_packets)
+        metrics.counter('simp_held_packets_total', 'Chat packets held until the missing packets before them arrived',
+                        callback=lambda: self.held_packets)
+        self.ack_rtt = metrics.histogram('simp_ack_rtt_seconds', 'Time between sending a packet and receiving its ack')
+        self.handshake_duration = metrics.histogram('simp_handshake_seconds',
+                                                    'Time between the SYN or SYNACK and the established connection')
+        self.request_answer = metrics.histogram('simp_request_answer_seconds',
+                                                'Time the clients took to answer a request, saved by the auto accept')
+        metrics.counter('simp_auto_accepted_total', 'Requests accepted without asking the client',
+                        callback=lambda: self.auto_accepted)
+        metrics.gauge('simp_peer_cache_entries', 'Peers in the peer cache', callback=lambda: len(self.peer_cache.entries))
+        metrics.counter('simp_relayed_packets_total', 'Packets forwarded on the circuits of the relay',
+                        callback=lambda: self.relayed_packets)
+        metrics.gauge('simp_circuits', 'Circuits of the relay in both directions', callback=lambda: len(self.circuits))
+        metrics.gauge('simp_routes', 'Users the relay has a route to', callback=lambda: len(self.routes.routes))
+        metrics.counter('simp_room_packets_sent_total', 'Packets sent to the members of the rooms',
+                        callback=lambda: self.room_packets_sent)
+        metrics.gauge('simp_rooms', 'Rooms hosted by the daemon', callback=lambda: len(self.rooms))
+        metrics.gauge('simp_room_members', 'Members of the rooms hosted by the daemon',
+                      callback=lambda: len(self.room_members))
+        if self.message_log is not None:
+            message_log = self.message_log
+            metrics.gauge('simp_log_pending_messages', 'Messages in the message log that were not acknowledged',
+                          callback=lambda: len(message_log.peers))
+            metrics.counter('simp_log_commits_total', 'Writes of the message log synced to the disk',
+                            callback=lambda: message_log.commits)
+            metrics.counter('simp_log_bytes_written_total', 'Bytes written to the message log',
+                            callback=lambda: message_log.bytes_written)
+            metrics.counter('simp_replayed_messages_total', 'Messages sent again from the message log',
+                            callback=lambda: self.replayed_messages)
+        metrics.gauge('simp_sessions', 'Clients of the daemon', callback=lambda: len(self.sessions))
+        metrics.gauge('simp_local_sessions', 'Clients of the daemon on the Unix domain socket',
+                      callback=lambda: sum(isinstance(address, str) for address in self.sessions))
+        metrics.gauge('simp_established_sessions', 'Connections with other daemons',
+                      callback=lambda: sum(session.handshake_state == 'established' for session in sessions()))
+        metrics.gauge('simp_in_flight_packets', 'Packets waiting for their ack',
+                      callback=lambda: sum(len(session.in_flight) for session in sessions()))
+        metrics.gauge('simp_queued_messages', 'Packets waiting for room in the sliding window',
+                      callback=lambda: sum(len(session.message_buffer) for session in sessions()))
+        metrics.gauge('simp_queued_bytes', 'Bytes waiting for room in the sliding window',
+                      callback=lambda: sum(session.queued_bytes for session in sessions()))
+        metrics.gauge('simp_reassembly_bytes', 'Bytes of the fragments waiting for reassembly',
+                      callback=lambda: self.reassembly_bytes)
+        metrics.gauge('simp_rto_seconds', 'Retransmission timeout of the other daemons', ('peer',),
+                      callback=lambda: {('{}:{}'.format(*address),): estimator.rto
+                                        for address, estimator in self.rtt_estimators.items()})
+
+    def bind_socket(self, port, reuse_port=False):
+        # With reuse_port the workers of a multi-process daemon bind the same port, the kernel hashes every datagram
+        # to one of them by its source address, so the datagrams of a client always reach the same worker
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((self.ip_address, port))
+        return sock
+
+    async def create_endpoint(self, sock, protocol):
+        loop = asyncio.get_running_loop()
+        if not self.batched_io:
+            transport, _ = await loop.create_datagram_endpoint(lambda: protocol, sock=sock)
+            return transport
+        return BatchedDatagramEndpoint(loop, sock, protocol, self.io_batch)
+
+    async def serve_forever(self):
+        await self.start()
+        # Everything happens in the callbacks of the endpoints
+        await asyncio.Event().wait()
+
+    def close(self):
+        for session in list(self.sessions.values()):
+            self.close_session(session)
+        if self.route_timer is not None:
+            self.route_timer.cancel()
+            self.route_timer = None
+        for room in self.rooms.values():
+            room.cancel_retransmit_timer()
+        self.timers.close()
+        if self.message_log is not None:
+            self.message_log.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.daemon_transport is not None:
+            self.daemon_transport.close()
+        if self.listen_transport is not None:
+            self.listen_transport.close()
+        if self.client_transport is not None:
+            self.client_transport.close()
+        if self.local_transport is not None:
+            self.local_transport.close()
+            self.local_transport = None
+
+    def client_endpoint(self, address):
+        # The local clients are answered on their connection, their address is a string
+        if isinstance(address, str):
+            return self.local_transport
+        return self.client_transport
+
+    def send_client(self, session, message):
+        self.client_datagrams_sent += 1
+        self.client_endpoint(session.client_address).sendto(message, session.client_address)
+
+    def send_chat(self, session, payload):
+        # A message of the other client is sent to the client, in parts if it does not fit in one datagram
+        # Every part but the last is a chatpart, the last one is a chat
+        size = self.client_part_bytes
+        start = 0
+        while len(payload) - start > size:
+            self.send_client(session, b'\x08\x00' + payload[start:start + size])
+            start += size
+        self.send_client(session, b'\x01\x00' + payload[start:])
+
+    def send_daemon(self, packet, address):
+        data = packet.encode()
+        self.packets_sent.inc(packet.type, packet.operation)
+        self.daemon_bytes_sent += len(data)
+        if self.debug:
+            log.debug("Sent %s %s %s number %d to %s (%d bytes)", packet.type, packet.operation, packet.sequence,
+                      packet.number, address, len(data))
+        self.daemon_transport.sendto(data, address)
+
+    def control_packet(self, session, operation, sequence, payload='', number=0):
+        return SIMP_Socket(
+            type='control',
+            operation=operation,
+            sequence=sequence,
+            user=session.client_username or '',
+            payload=payload,
+            number=number
+        )
+
+    def parse_other_daemon(self, text):
+        # The client enters the other daemon's IP address, optionally with the requested user and the port: [user@]ip[:port]
+        # Without a port the other daemon is expected on the same port as this one
+        # Without an IP address (user@) the request goes to the upstream relay, the IP address is empty
+        # ValueError is raised if the IP address is not an IPv4 address (a host name would be looked up on the event
+        # loop) or the port is not in 1-65535
+        target, _, host = text.rpartition('@')
+        ip, _, port = host.partition(':')
+        if ip:
+            try:
+                socket.inet_pton(socket.AF_INET, ip)
+            except OSError:
+                raise ValueError("Invalid IP address " + ip) from None
+        if not port:
+            return target, (ip, self.daemon_port)
+        if not port.isdigit() or not 0 < int(port) <= 65535:
+            raise ValueError("Invalid port " + port)
+        return target, (ip, int(port))
+
+    def ask_wait_or_start(self, session):
+        message = b'\x05\x01' + "Do you want to wait for connection or start one? [wait/start]: ".encode()
+        self.send_client(session, message)
+        session.client_state = 'waitorstart'
+
+    def ask_connection_request(self, session):
+        # Ask the client if they want to accept the connection
+        self.stop_waiting(session)
+        user, address, _ = session.pending_request_data
+        message = b'\x04\x01' + f"Request from user {user} address: {address[0]}:{address[1]}. Do you want to accept? [y/n]: ".encode()
+        self.send_client(session, message)
+        session.client_state = 'connreq'
+        session.request_asked_at = time.time()
+
+    def offer_request(self, session):
+        # A request of a waiting client is accepted right away if it comes from a known or an allowed peer,
+        # otherwise the client is asked about it
+        user, address, _ = session.pending_request_data
+        if self.accepts_automatically(session.client_username, user, address):
+            self.stop_waiting(session)
+            self.auto_accepted += 1
+            log.info("Request of %s from %s:%d accepted for %s", user, *address, session.client_username)
+            self.handshake_answer(session, True)
+        else:
+            self.ask_connection_request(session)
+
+    def accepts_automatically(self, username, user, address):
+        if (user, address) in self.allow_list or ('', address) in self.allow_list:
+            return True
+        return self.auto_accept and self.peer_cache.known(username, address, user)
+
+    def wait_for_request(self, session):
+        # The client waits for a request, if one arrived while the client was choosing it is asked about it right away
+        session.client_state = 'waiting'
+        if session.pending_request_data is None:
+            session.pending_request_data = self.take_pending_request(session)
+        if session.pending_request_data is not None:
+            self.offer_request(session)
+        else:
+            self.waiting_sessions[session.client_address] = session
+            self.waiting_changed()
+
+    def stop_waiting(self, session):
+        if self.waiting_sessions.pop(session.client_address, None) is not None:
+            self.waiting_changed()
+
+    def waiting_changed(self):
+        # The supervisor of the workers passes the requests for any user to the workers that have waiting clients
+        if self.worker is not None:
+            self.worker.send('waiting', len(self.waiting_sessions))
+
+    def take_pending_request(self, session):
+        # The requests for this user are answered first, then the requests for any user
+        for target in (session.client_username, ''):
+            requests = self.pending_requests.get(target)
+            if requests:
+                request = requests.popleft()
+                if not requests:
+                    del self.pending_requests[target]
+                return request
+        return None
+
+    def client_datagram_received(self, data, address):
+        # This function handles the messages from the clients
+        # Determines the action based on the type of the message and the state of the client's session
+        type = self.controlTypes.get(bytes(data[:1]))
+        self.client_datagrams_received.inc(type or 'unknown')
+        # The chat messages are forwarded as bytes, they are not decoded
+        try:
+            message = '' if type in ('chat', 'chatpart') else str(data[2:], 'utf-8')
+        except UnicodeDecodeError:
+            self.invalid_client_messages += 1
+            return
+        session = self.sessions.get(address)
+        if session is None:
+            # If the control type is connect, then a new client is trying to connect to the daemon
             if type == "connect":
-                # If there is a client already connected, then send an error message
-                if self.client_connected:
-                    message = b'\x02\x00' + "The daemon already connected to a client".encode()
-                    self.client_socket.sendto(message, address)
-                # If there is no client connected, then send a connection established message
-                message = b'\x00\x00'
-                self.client_socket.sendto(message, address)
-                self.client_address = address
-                self.client_connected = True
-                # If the connection is established, then ask for the username
-                message = b'\x00\x01' + "Please enter a username: ".encode()
-                self.client_socket.sendto(message, self.client_address)
-                username, address = self.client_socket.recvfrom(4096)
-                username = username[2:].decode()
-                self.client_username = username
-                # If there is no pending request, then ask the client if they want to wait for a connection or start one
-                if not self.pending_request:
-                    message = b'\x05\x01' + "Do you want to wait for connection or start one? [wait/start]: ".encode()
-                    self.client_socket.sendto(message, self.client_address)
-                    wait_or_start, address = self.client_socket.recvfrom(4096)
-                    wait_or_start = wait_or_start[2:].decode()
-                    # If the clients starts a connection, then ask for the other daemon's IP address and start the handshake
-                    if wait_or_start == "start":
-                        # ask for other daemon ip
-                        message = b'\x05\x01' + "Enter the other daemon's IP address: ".encode()
-                        self.client_socket.sendto(message, self.client_address)
-                        # receive other daemon ip
-                        other_daemon_ip, address = self.client_socket.recvfrom(4096)
-                        other_daemon_ip = other_daemon_ip[2:].decode()
-                        self.other_daemon_ip = other_daemon_ip
-                        # Get the other daemon's IP address and start the handshake
-                        handshake_sender_thread = threading.Thread(target=self.handshake_sender)
-                        handshake_sender_thread.start()
-                    # If the client wait for a connection there is nothing to do on the daemon side
-            elif type == "chat":
-                # If the client is connected and wants to send a message, it will be put to the message buffer
-                # An other thread continuously checks the message buffer and sends the messages to the other daemon
-                message = SIMP_Socket(
-                    type='chat',
-                    operation='message',
-                    sequence='request',
-                    user=self.client_username,
-                    payload=message
-                )
-                self.message_buffer.append(message)
-            elif type == "quit":
-                # If the client wants to quit, then send a fin to the other daemon
-                FIN = SIMP_Socket(
-                    type='control',
-                    operation='fin',
-                    sequence='request',
-                    user=self.client_username,
-                    payload=''
-                )
-                self.send_packet_daemon(FIN.encode())
-                # Indicate that the daemon is waiting for the ack
-                self.fin_sent = True
-            elif type == "yesno":
-                # This is a control type that is used to ask the client if they want to accept the connection
-                if self.pending_request:
-                    if message == "y":
-                        # This is used to indicate that the client accepted the connection
-                        self.accepted = True
-                        pass
-                    else:
-                        # This is used to indicate that the client declined the connection
-                        self.accepted = False
-                        pass
-            elif type == "reask":
-                # In the case of a declined connection the daemon will ask the client again if they want to wait or start
-                # This is the same as the first time the client connects
-                message = b'\x05\x01' + "Do you want to wait for connection or start one? [wait/start]: ".encode()
-                self.client_socket.sendto(message, self.client_address)
-                # receive wait or start
-                wait_or_start, address = self.client_socket.recvfrom(4096)
-                wait_or_start = wait_or_start[2:].decode()
-                if wait_or_start == "start":
-                    # ask for other daemon ip
-                    message = b'\x05\x01' + "Enter the other daemon's IP address: ".encode()
-                    self.client_socket.sendto(message, self.client_address)
-                    # receive other daemon ip
-                    other_daemon_ip, address = self.client_socket.recvfrom(4096)
-                    other_daemon_ip = other_daemon_ip[2:].decode()
-                    self.other_daemon_ip = other_daemon_ip
-                    # start handshake
-                    handshake_sender_thread = threading.Thread(target=self.handshake_sender)
-                    handshake_sender_thread.start()
+                if len(self.sessions) >= self.max_clients:
+                    message = b'\x02\x00' + "The daemon has no room for more clients".encode()
+                    self.client_datagrams_sent += 1
+                    self.client_endpoint(address).sendto(message, address)
+                    return
+                # Send a connection established message and ask for the username
+                session = Session(address)
+                self.sessions[address] = session
+                self.send_client(session, b'\x00\x00')
+                self.send_client(session, b'\x00\x01' + "Please enter a username: ".encode())
+            return
+        if type == "connect" and session.client_state == 'username':
+            if message in self.sessions_by_username:
+                self.send_client(session, b'\x02\x00' + "The username is already used on this daemon".encode())
+                self.close_session(session)
+                return
+            if not message.isascii() or not 0 < len(message) <= 32:
+                # The username is sent in the SIMP header
+                self.send_client(session, b'\x02\x00' + "The username must be 1 to 32 ASCII characters".encode())
+                self.close_session(session)
+                return
+            if message.startswith('#'):
+                # The names starting with # are the names of the rooms
+                self.send_client(session, b'\x02\x00' + "The username cannot start with #".encode())
+                self.close_session(session)
+                return
+            session.client_username = message
+            self.sessions_by_username[message] = session
+            if self.worker is not None:
+                # The supervisor checks that no other worker has a client with this username
+                self.worker.send('user', message)
+            if self.upstream is not None:
+                self.announce_routes([(message, 0)])
+            # If there is a pending request the client is asked about it,
+            # otherwise ask the client if they want to wait for a connection or start one
+            session.pending_request_data = self.take_pending_request(session)
+            if session.pending_request_data is not None:
+                self.ask_connection_request(session)
+            else:
+                self.ask_wait_or_start(session)
+        elif type == "waitorstart" and session.client_state == 'waitorstart':
+            # If the clients starts a connection, then ask for the other daemon's IP address
+            if message == "start":
+                self.send_client(session, b'\x05\x01' + "Enter the other daemon's IP address: ".encode())
+                session.client_state = 'peerip'
+            else:
+                # If the client wait for a connection there is nothing to do on the daemon side
+                self.wait_for_request(session)
+        elif type == "waitorstart" and session.client_state == 'peerip':
+            # Get the other daemon's IP address and start the handshake
+            try:
+                target, address = self.parse_other_daemon(message)
+            except ValueError as error:
+                self.send_client(session, b'\x02\x00' + str(error).encode())
+                self.close_session(session)
+                return
+            if not address[0]:
+                if self.upstream is None:
+                    self.send_client(session, b'\x02\x00' + "There is no relay to send the request to".encode())
+                    self.close_session(session)
+                    return
+                address = self.upstream
+            self.handshake_sender(session, target, address)
+        elif type == "yesno" and session.client_state == 'connreq':
+            self.handshake_answer(session, message == "y")
+        elif type == "reask":
+            # In the case of a declined connection the daemon will ask the client again if they want to wait or start
+            # This is the same as the first time the client connects
+            if session.client_state in ('waiting', 'connreq'):
+                self.stop_waiting(session)
+                self.ask_wait_or_start(session)
+        elif type == "chatpart" and session.client_state == 'chat':
+            # A message that does not fit in one datagram arrives in parts, the last part is a chat message
+            # If the message is too large the rest of its parts are ignored (client_parts is None)
+            if session.client_parts is not None:
+                session.client_parts.append(bytes(data[2:]))
+                session.client_parts_size += len(data) - 2
+                if session.client_parts_size > self.max_message_bytes:
+                    session.client_parts = None
+        elif type == "chat" and session.client_state == 'chat':
+            # If the client is connected and wants to send a message, it will be put to the message buffer
+            # The window sends it to the other daemon as soon as there is room for it
+            payload = bytes(data[2:])
+            parts = session.client_parts
+            session.client_parts = []
+            session.client_parts_size = 0
+            if parts:
+                payload = b''.join(parts) + payload
+            if parts is None or len(payload) > self.max_message_bytes:
+                log.warning("Message of %s is larger than %d bytes, dropped", session.client_username,
+                            self.max_message_bytes)
+                self.oversized_messages += 1
+                self.drop_client_message(session)
+            else:
+                self.queue_message(session, payload)
+        elif type == "quit" and session.client_state != 'chat':
+            # If the client quits before the chat started, the session is closed right away
+            self.send_client(session, b'\x03\x00')
+            self.close_session(session)
+        elif type == "quit" and session.client_state == 'chat':
+            # If the client wants to quit, then send a fin to the other daemon after its messages were acknowledged
+            if not session.quitting:
+                session.quitting = True
+                self.pump_window(session, flush=True)
+        else:
+            # Ignore the control types that are not expected in the current state
+            pass
+
+    def local_client_disconnected(self, address):
+        # A local client closed its connection without quitting, the daemon handles it as if it quit
+        if address in self.sessions:
+            self.client_datagram_received(b'\x03\x00', address)
+
+    def daemon_datagram_received(self, data, address):
+        # This function handles the packets from the other daemons
+        # Determines the session from the address and the user of the packet, then the action from the operation
+        # Only the header is unpacked, the user and the payload are decoded if they are needed
+        self.daemon_bytes_received += len(data)
+        try:
+            rec = SimpPacket(data)
+        except Exception:
+            self.invalid_packets += 1
+            return
+        try:
+            self.daemon_packet_received(rec, data, address)
+        except UnicodeDecodeError:
+            # The payload of a control packet is not ASCII, the packet is dropped
+            self.invalid_packets += 1
+
+    def daemon_packet_received(self, rec, data, address):
+        self.packets_received.inc(rec.type, rec.operation)
+        if self.debug:
+            log.debug("Received %s %s %s number %d from %s (%d bytes)", rec.type, rec.operation, rec.sequence,
+                      rec.number, address, len(data))
+        if rec.operation == "syn":
+            self.syn_received(rec, address)
+            return
+        if self.circuits:
+            # The packets of the connections relayed by this daemon are forwarded without a session
+            circuit = self.circuits.get((address, rec.user_field))
+            if circuit is not None:
+                self.relay_packet(rec, circuit, data)
+                return
+        if self.room_members:
+            member = self.room_members.get((address, rec.user_field))
+            if member is not None:
+                self.room_packet(member, rec)
+                return
+        if rec.operation == "route":
+            if self.relay:
+                self.routes_received(rec, address)
+            return
+        if rec.operation in ("synack", "error") or (rec.operation == "fin" and rec.sequence == "response"):
+            if self.relay_handshakes:
+                key = (address[0], rec.user_field)
+                relayed = self.relay_handshakes.get(key)
+                if relayed is None:
+                    key = (address[0], user_field(''))
+                    relayed = self.relay_handshakes.get(key)
+                if relayed is not None:
+                    self.relay_answer(rec, address, key, relayed, data)
+                    return
+            # The answers to a SYN arrive before the user on the other daemon is known
+            # They can come from another port of the other daemon (a worker of a multi-process daemon)
+            if rec.user_field[:1] == b'#':
+                # The answer of a room is for the member in its payload
+                session = self.handshakes.get((address[0], rec.user_field, rec.payload.partition(': ')[0]))
+            else:
+                session = self.handshakes.get((address[0], rec.user_field)) or self.handshakes.get((address[0], user_field('')))
+        else:
+            session = self.sessions_by_peer.get((address, rec.user_field))
+        if session is None:
+            joined = self.joined_rooms.get((address, rec.user_field)) if self.joined_rooms else None
+            if joined is not None:
+                self.joined_room_packet(joined, rec, address)
+                return
+            if rec.operation == "keepalive" and rec.sequence == "request":
+                self.unknown_keepalive(rec, address)
+            elif rec.operation == "fin" and rec.sequence == "request":
+                closed = self.closed_connections.get((address, rec.user_field))
+                if closed is not None:
+                    # The ack of the FIN was lost, the other daemon sent it again
+                    ACK = SIMP_Socket(type='control', operation='ack', sequence='response', user=closed[0],
+                                      number=rec.number)
+                    self.send_daemon(ACK, address)
+                    return
+            elif rec.operation == "synack":
+                established = self.sessions_by_peer.get((address, rec.user_field))
+                if established is not None and established.handshake_state == 'established':
+                    # The ACK of the handshake was lost, the other daemon sent the SYNACK again
+                    self.send_daemon(self.control_packet(established, 'ack', 'request'), address)
+                    return
+            self.unmatched_packets += 1
+            return
+        session.last_heard = time.time()
+        if rec.flags & COMPRESSED and not self.decompress_packet(session, rec):
+            return
+        if rec.operation == "synack" and session.handshake_state == 'syn_sent':
+            self.synack_received(session, rec, address)
+        elif rec.operation == "ack":
+            self.ack_received(session, rec)
+        elif rec.operation in ("message", "batch", "fragment") and session.handshake_state == 'established':
+            self.chat_packet_received(session, rec, address)
+        elif rec.operation == "fin":
+            self.fin_received(session, rec)
+        elif rec.operation == "keepalive":
+            if rec.sequence == "request":
+                self.send_daemon(self.control_packet(session, 'keepalive', 'response', number=rec.number), address)
             else:
-                # Ignore the control types that are not used by the client
-                pass
-
-    def listen_to_daemon(self):
-        # This function continuously listens for messages from the other daemon
-        # Determines the action based on the type of the message
-        while True:
-            data, address = self.daemon_socket.recvfrom(4096)
-            rec = SIMP_Socket()
-            rec.decode(data)
-            print("---------------------------------")
-            print("Packet received from other daemon")
-            rec.printData()
-            print("---------------------------------")
-            # If the other daemon sends a message, then send it to the client
-            # Send an ack to the other daemon, that indicates that the message was received
-            if rec.operation == "message":
-                message = b'\x01\x00' + rec.payload.encode()
-                self.client_socket.sendto(message, self.client_address)
-                ack = SIMP_Socket(
-                    type='control',
-                    operation='ack',
-                    sequence='response',
-                    user=self.client_username,
-                    payload=''
-                )
-                self.daemon_socket.sendto(ack.encode(), (self.other_daemon_ip, self.daemon_port))
-            elif rec.operation == "fin":
-                # If the other daemon sends a fin send an ack to the other daemon and close the connection
-                ACK = SIMP_Socket(
-                    type='control',
-                    operation='ack',
-                    sequence='response',
-                    user=self.client_username,
-                    payload=''
-                )
-                ACK_binary = ACK.encode()
-                self.daemon_socket.sendto(ACK_binary, (self.other_daemon_ip, self.daemon_port))
-                message = b'\x03\x00' + rec.payload.encode()
-                self.client_socket.sendto(message, self.client_address)
-                # The connection to the client and the other daemon is closed, everything is reset
-                self.client_connected = False
-                self.client_address = None
-                self.other_daemon_ip = None
-                handshake_receiver_thread = threading.Thread(target=self.handshake_receiver)
-                handshake_receiver_thread.start()
-            elif rec.operation == "ack":
-                # If the ack is received there can be two cases
-                # Either it is an ack for the fin
-                if self.fin_sent:
-                    # In this case it is indicated that the connection can be closed
-                    # Everything is reset
-                    message = b'\x03\x00'
-                    self.client_socket.sendto(message, self.client_address)
-                    self.client_connected = False
-                    self.client_address = None
-                    self.other_daemon_ip = None
-                    self.other_daemon_connected = False
-                    self.fin_sent = False
-                    handshake_receiver_thread = threading.Thread(target=self.handshake_receiver)
-                    handshake_receiver_thread.start()
-                    break
-                # Or it is an ack for a message
-                # In this case the message is removed from the message buffer
-                if self.message_sent:
-                    self.ack_received = True
-                    self.message_sent = False
-            elif rec.operation == "syn" and self.other_daemon_connected:
-                # If the client is in a chat with another client, send the third person a message that the client is busy
-                ERR = SIMP_Socket(
-                    type='control',
-                    operation='error',
-                    sequence='response',
-                    user=self.client_username,
-                    payload="User is busy in another chat"
-                )
-                self.daemon_socket.sendto(ERR.encode(), address)
-
-    def message_forwarder(self):
-        while True:
-            # If the message buffer is not empty, then send the first message to the other daemon
-            if len(self.message_buffer) > 0:
-                message = self.message_buffer.pop(0)
-                self.daemon_socket.sendto(message.encode(), (self.other_daemon_ip, self.daemon_port))
-                # This indicates that the message was sent, and the daemon is waiting for the ack
-                self.message_sent = True
-                print("---------------------------------")
-                print("Message sent to other daemon")
-                message.printData()
-                # A timer is started
-                timer = 0
-                # It checks for 5 seconds if the ack was received
-                while not self.ack_received and timer < 5:
-                    time.sleep(0.01)
-                    timer += 0.01
-                # If the timer ran out, then the message is put back to the message buffer to be sent again
-                if timer >= 5:
-                    # put back message to buffer first place
-                    self.message_buffer.insert(0, message)
-                    print("Message not acknowledged, resending")
-                    print("---------------------------------")
-                    self.ack_received = False
-                    continue
-                print("Message acknowledged")
-                print("---------------------------------")
-                # reset ack received
-                self.ack_received = False
-
-    def send_packet_daemon(self, data):
-        # This function is used to send a packet to the other daemon
-        # We can only send a packet if every message before was acknowledged
-        if not self.message_buffer:
-            self.daemon_socket.sendto(data, (self.other_daemon_ip, self.daemon_port))
-
-    def handshake_sender(self):
+                # The answer of a fast peer arrives sooner than the timer can run late, so the peer would look idle for
+                # the whole interval when the timer runs
+                session.missed_keepalives = 0
+        elif rec.operation == "error" and session.handshake_state == 'syn_sent':
+            # If an error is received, then the other client is already connected to another daemon
+            log.info("Error received from %s: %s", address, rec.payload)
+            error = rec.payload.partition(': ')[2] if rec.user_field[:1] == b'#' else rec.payload
+            self.send_client(session, b'\x02\x00' + error.encode())
+            self.close_session(session)
+
+    def chat_packet_received(self, session, rec, address):
+        # The packets are handed to the client in the order of their numbers, every packet is acknowledged with its
+        # number, so the other daemon knows which packet was received
+        if self.receive_in_order(session, session.receive_window, rec):
+            self.send_daemon(self.control_packet(session, 'ack', 'response', number=rec.number), address)
+
+    def receive_in_order(self, session, window, rec, deliver=None):
+        # The packet is delivered once and after the packets before it (receive_window.py), the sessions, the members
+        # of the rooms and the joined rooms use the same window (with deliver, like in deliver_packet)
+        # It returns False if the packet is dropped without an ack
+        offset = window.offset(rec.number)
+        if window.is_duplicate(offset):
+            # The packet was sent again because its ack was lost, it is only acknowledged again
+            self.duplicate_packets += 1
+        elif offset > 0:
+            # A packet before it is missing, it is held until that one is sent again
+            # The payload is copied, the received buffer is reused after the callback
+            size = len(rec.payload_bytes)
+            if offset >= window.size or self.reassembly_bytes + size > self.max_reassembly_bytes:
+                self.window_drops += 1
+                return False
+            window.hold(offset, (rec.operation, bytes(rec.payload_bytes)), size)
+            self.reassembly_bytes += size
+            self.held_packets += 1
+        elif not self.deliver_packet(session, rec.operation, rec.payload_bytes, deliver):
+            # A fragment is only acknowledged if it was stored, otherwise the other daemon sends it again later
+            return False
+        else:
+            for operation, payload in window.advance():
+                self.reassembly_bytes -= len(payload)
+                self.deliver_packet(session, operation, payload, deliver)
+        return True
+
+    def deliver_packet(self, session, operation, payload, deliver=None):
+        # The message of a message packet is sent to the client, the messages of a batch in order, and a fragment is
+        # stored until its message is complete (with deliver, the messages are passed to it)
+        # It returns False if the packet could not be used
+        deliver = deliver or self.send_chat
+        if operation == "message":
+            deliver(session, payload)
+        elif operation == "batch":
+            try:
+                messages = unpack_messages(payload)
+            except Exception:
+                return False
+            for message in messages:
+                deliver(session, message)
+        elif operation == "fragment":
+            return self.fragment_received(session, payload, deliver)
+        else:
+            return False
+        return True
+
+    def unknown_keepalive(self, rec, address):
+        # The daemon does not know the connection (it was restarted, or it closed the connection and the FIN was
+        # lost), the other daemon is told to close it right away
+        # The keepalive carries the user of this daemon that the connection was with
+        user = rec.payload
+        if not user or len(user) > 32:
+            return
+        FIN = SIMP_Socket(type='control', operation='fin', sequence='request', user=user,
+                          payload="The other daemon does not know the connection")
+        self.send_daemon(FIN, address)
+
+    def schedule_keepalive(self, session, delay):
+        session.keepalive_timer = self.timers.call_later(delay, self.keepalive, session)
+
+    def keepalive(self, session):
+        # A keepalive is sent if nothing arrived from the other daemon for keepalive_interval, the connection is closed
+        # after keepalive_misses of them were not answered
+        session.keepalive_timer = None
+        idle = time.time() - session.last_heard
+        if idle < self.keepalive_interval:
+            session.missed_keepalives = 0
+            self.schedule_keepalive(session, self.keepalive_interval - idle)
+            return
+        if session.missed_keepalives >= self.keepalive_misses:
+            log.warning("%s:%d did not answer %d keepalives, closing the connection of %s",
+                        *session.other_daemon_address, session.missed_keepalives, session.client_username)
+            self.dead_peers += 1
+            self.expire_session(session)
+            return
+        session.missed_keepalives += 1
+        self.keepalives_sent += 1
+        KEEPALIVE = self.control_packet(session, 'keepalive', 'request', payload=session.other_username,
+                                        number=session.missed_keepalives)
+        self.send_daemon(KEEPALIVE, session.other_daemon_address)
+        self.schedule_keepalive(session, self.keepalive_interval)
+
+    def decompress_packet(self, session, rec):
+        # The payload of a compressed packet is replaced with the decompressed one, the packet is dropped (and sent
+        # again by the other daemon) if it is not valid
+        payload = self.compressor.decompress(rec.payload_bytes) if session.compression else None
+        if payload is None:
+            self.invalid_packets += 1
+            return False
+        rec.replace_payload(payload)
+        return True
+
+    def handshake_sender(self, session, target, address):
         # The handshake is started by sending a syn to the other daemon
-        SYN = SIMP_Socket(
+        # The payload of the syn is the requested user, the answers are matched to the session by it
+        session.other_daemon_address = address
+        session.target_username = target
+        if session.handshake_key() in self.handshakes or session.handshake_key() in self.relay_handshakes:
+            self.send_client(session, b'\x02\x00' + "A request to this user is already in progress".encode())
+            session.other_daemon_address = None
+            self.close_session(session)
+            return
+        self.handshakes[session.handshake_key()] = session
+        # The options of the daemon are offered after the requested user
+        payload = join_options(target, {COMPRESSION}) if self.compressor is not None else target
+        self.send_daemon(self.control_packet(session, 'syn', 'request', payload=payload), address)
+        session.handshake_state = 'syn_sent'
+        session.handshake_started = time.time()
+        session.client_state = 'handshake'
+        if self.handshake_timeout > 0:
+            session.handshake_timer = self.timers.call_later(self.handshake_timeout, self.handshake_expired, session)
+
+    def handshake_expired(self, session):
+        # The other daemon did not answer the SYN in time
+        session.handshake_timer = None
+        log.info("Request of %s to %s:%d was not answered in %.0fs", session.client_username,
+                 *session.other_daemon_address, self.handshake_timeout)
+        self.expired_handshakes += 1
+        self.send_client(session, b'\x02\x00' + "The other daemon did not answer the request".encode())
+        self.close_session(session)
+
+    def syn_received(self, rec, address, forwarded=False):
+        # forwarded is True for the requests that were passed to this worker by the supervisor
+        if self.debug:
+            log.debug("SYN received from %s", address)
+        # The request is the user and the daemon that sent it, and whether the daemon offered compression
+        target, options = split_options(rec.payload)
+        request = (rec.user, address, COMPRESSION in options)
+        if self.circuits:
+            # A new request of the user ends the connection that was relayed for it before
+            self.drop_circuit((address, rec.user_field))
+        if self.relay and target and ('@' in target or target[0] != '#' and target not in self.sessions_by_username):
+            # A request for a user of another daemon is forwarded to the next daemon on the route
+            if self.relay_request(rec, target, address):
+                return
+        elif '@' in target:
+            self.send_error(target.partition('@')[0], address, "The daemon is not a relay")
+            return
+        if (address, rec.user_field) in self.sessions_by_peer:
+            session = None
+        elif target[:1] == '#':
+            if self.worker is not None and not forwarded and target not in self.rooms:
+                # The supervisor passes the join to the worker that hosts the room
+                self.worker.send('syn', target, bytes(rec.buffer), address)
+            else:
+                self.join_room(rec, target, address)
+            return
+        elif target:
+            session = self.sessions_by_username.get(target)
+            if session is None:
+                # The requested user is not connected yet, the request waits for them
+                self.queue_request(target, request, rec, forwarded)
+                return
+            if session.pending_request_data is not None or session.client_state not in ('username', 'waitorstart', 'waiting'):
+                session = None
+        elif self.waiting_sessions:
+            # Any user can answer, the client that waits for the longest time is asked
+            session = next(iter(self.waiting_sessions.values()))
+        else:
+            # If no client is waiting the request waits for a client
+            self.queue_request(target, request, rec, forwarded)
+            return
+        if session is None:
+            # If the client is in a chat with another client, send the third person a message that the client is busy
+            self.send_busy(target, address)
+            return
+        session.pending_request_data = request
+        # If the client is still choosing, it is asked about the request after it chose to wait
+        if session.client_state == 'waiting':
+            self.offer_request(session)
+
+    def queue_request(self, target, request, rec, forwarded=False):
+        if self.worker is not None and not forwarded:
+            # The supervisor passes the request to the worker of the requested user (or of a waiting client), or keeps
+            # it until the user connects
+            self.worker.send('syn', target, bytes(rec.buffer), request[1])
+            return
+        requests = self.pending_requests.setdefault(target, deque())
+        if len(requests) >= self.max_pending_requests or request in requests:
+            self.send_busy(target, request[1])
+            return
+        requests.append(request)
+
+    def send_busy(self, target, address):
+        self.send_error(target, address, "User is busy in another chat")
+
+    def send_error(self, target, address, text):
+        ERR = SIMP_Socket(
             type='control',
-            operation='syn',
-            sequence='request',
-            user=self.client_username,
-            payload=''
+            operation='error',
+            sequence='response',
+            user=target,
+            payload=text
         )
-        SYN_binary = SYN.encode()
-        # SENDING SYN
-        self.daemon_socket.sendto(SYN_binary, (self.other_daemon_ip, self.daemon_port))
-
-    def handshake_receiver(self):
-        print("Waiting for handshake")
-        # WAITING FOR SYN
-        while True:
-            data, address = self.daemon_socket.recvfrom(4096)
-            rec = SIMP_Socket()
-            rec.decode(data)
-            if rec.type == "control" and rec.operation == "syn":
-                print("syn received")
-                self.pending_request = True
-                self.pending_request_data = (rec.user, address)
-                # If a SYN is received but no client is connected wait for the client to connect
-                # then ask the client if they want to accept the connection
-                while not self.client_connected:
-                    time.sleep(0.01)
-                    pass
-                if self.client_connected:
-                    # Handling that the client is already connected to another daemon is done in at a different place
-                    # ask client if they want to accept the connection
-                    message = b'\x04\x01' + f"Request from user {self.pending_request_data[0]} address: {self.pending_request_data[1][0]}:{self.pending_request_data[1][1]}. Do you want to accept? [y/n]: ".encode()
-                    self.client_socket.sendto(message, self.client_address)
-                    self.other_daemon_ip = address[0]
-                    # receive accept or decline
-                    while self.accepted is None:
-                        time.sleep(0.01)
-                        pass
-                    # When a client is connected ask them if they want to accept the connection
-                    if self.accepted:
-                        # If the client accepts the connection, then send a synack to the other daemon
-                        self.accepted = None
-                        pass
-                    else:
-                        # If the client declines the connection, then send a FIN to the other daemon
-                        FIN = SIMP_Socket(
-                            type='control',
-                            operation='fin',
-                            sequence='response',
-                            user=self.client_username,
-                            payload='Error: The other client declined your request'
-                        )
-                        FIN_binary = FIN.encode()
-                        # Reset the waiting for handshake
-                        print("Fin sent")
-                        self.daemon_socket.sendto(FIN_binary, (self.other_daemon_ip, self.daemon_port))
-                        handshake_receiver_thread = threading.Thread(target=self.handshake_receiver)
-                        handshake_receiver_thread.start()
-                        self.accepted = None
-                        self.pending_request = False
+        self.send_daemon(ERR, address)
+
+    def relay_request(self, rec, target, address):
+        # This function returns False if the request has no route, then it waits for the user on this daemon
+        if '@' in target:
+            # user@ip[:port] asks for the user of that daemon
+            try:
+                target, next_hop = self.parse_other_daemon(target)
+            except ValueError as error:
+                self.send_error(target.rpartition('@')[0], address, str(error))
+                return True
+            if not next_hop[0]:
+                # user@ without an IP address goes on to the upstream relay, like the requests of the clients
+                next_hop = self.upstream
+                if next_hop is None:
+                    self.send_error(target, address, "There is no route to the user")
+                    return True
+        else:
+            next_hop = self.routes.lookup(target) or self.upstream
+            if next_hop is None or next_hop == address:
+                return False
+        if next_hop == address or rec.number + 1 >= MAX_HOPS:
+            # The request would go back where it came from, or it is going around in a loop
+            self.send_error(target, address, "There is no route to the user")
+            return True
+        if target[:1] == '#':
+            # The packets of a room are for every member on the daemon of the member, they cannot share a circuit
+            self.send_error(target, address, rec.user + ": Rooms cannot be joined through a relay")
+            return True
+        key = (address, rec.user_field)
+        handshake_key = (next_hop[0], user_field(target))
+        if key in self.sessions_by_peer or handshake_key in self.handshakes or handshake_key in self.relay_handshakes:
+            # The user of the other daemon is in a chat with a user of this daemon, or the user is being requested
+            self.send_busy(target, address)
+            return True
+        # The circuit is complete when the SYNACK comes back, the rest of the connection goes to the port it came from
+        now = time.time()
+        self.circuits[key] = [next_hop, None, now, None, self.timers.call_later(self.relay_idle_timeout,
+                                                                                self.circuit_idle, key)]
+        self.relay_handshakes[handshake_key] = key
+        # The number of the SYN counts the relays it passed
+        # The options of the daemon that sent the request are for the daemon of the user, they are passed on
+        SYN = SIMP_Socket(type='control', operation='syn', sequence='request', user=rec.user,
+                          payload=join_options(target, split_options(rec.payload)[1]), number=rec.number + 1)
+        self.send_daemon(SYN, next_hop)
+        log.info("Request of %s from %s:%d for %s relayed to %s:%d", rec.user, *address, target or 'any user',
+                 *next_hop)
+        return True
+
+    def relay_answer(self, rec, address, handshake_key, key, data):
+        # The answer to a relayed request is forwarded to the daemon that sent the request
+        del self.relay_handshakes[handshake_key]
+        circuit = self.circuits.get(key)
+        if circuit is None:
+            self.unmatched_packets += 1
+            return
+        if rec.operation == "synack":
+            other_key = (address, rec.user_field)
+            circuit[0] = address
+            circuit[1] = other_key
+            self.circuits[other_key] = [key[0], key, time.time(), None,
+                                        self.timers.call_later(self.relay_idle_timeout, self.circuit_idle, other_key)]
+            # The route to the user that answered is cached
+            self.routes.learn(rec.user, address, 0)
+        else:
+            # The request was declined or the user is busy
+            self.drop_circuit(key)
+        self.forward(data, key[0])
+
+    def relay_packet(self, rec, circuit, data):
+        circuit[2] = time.time()
+        if rec.operation == "fin" and rec.sequence == "request":
+            circuit[3] = rec.number
+        elif rec.operation == "ack" and circuit[1] is not None:
+            # The ack of the FIN of the other side ends the connection, the circuit is removed in both directions
+            other = self.circuits.get(circuit[1])
+            if other is not None and other[3] == rec.number:
+                self.drop_circuit(circuit[1])
+        self.forward(data, circuit[0])
+
+    def forward(self, data, address):
+        self.relayed_packets += 1
+        self.daemon_bytes_sent += len(data)
+        self.daemon_transport.sendto(data, address)
+
+    def drop_circuit(self, key):
+        circuit = self.circuits.pop(key, None)
+        if circuit is None:
+            return
+        circuit[4].cancel()
+        if circuit[1] is not None:
+            other = self.circuits.pop(circuit[1], None)
+            if other is not None:
+                other[4].cancel()
+
+    def circuit_idle(self, key):
+        # The circuit is removed in both directions if no packet was forwarded on it for relay_idle_timeout
+        circuit = self.circuits[key]
+        idle = time.time() - circuit[2]
+        if idle >= self.relay_idle_timeout:
+            self.drop_circuit(key)
+        else:
+            circuit[4] = self.timers.call_later(self.relay_idle_timeout - idle, self.circuit_idle, key)
+
+    def routes_received(self, rec, address):
+        # The other daemon announced the users it can reach
+        for user, hops in unpack_routes(rec.payload):
+            if user not in self.sessions_by_username:
+                self.routes.learn(user, address, hops)
+
+    def announce_routes(self, routes):
+        # The users are announced to the upstream relay in route packets that fit in a datagram
+        for payload in pack_routes(routes, self.fragment_bytes - HEADER_SIZE):
+            ROUTE = SIMP_Socket(type='control', operation='route', sequence='request', user='', payload=payload)
+            self.send_daemon(ROUTE, self.upstream)
+
+    def maintain_routes(self):
+        # The users are announced again before their routes expire, and the expired routes are removed
+        loop = asyncio.get_running_loop()
+        self.route_timer = loop.call_later(self.route_interval, self.maintain_routes)
+        self.routes.expire()
+        for handshake_key, key in list(self.relay_handshakes.items()):
+            if key not in self.circuits:
+                del self.relay_handshakes[handshake_key]
+        if self.upstream is not None:
+            routes = [(user, 0) for user in self.sessions_by_username]
+            if self.relay:
+                routes += self.routes.announcement(self.upstream)
+            self.announce_routes(routes)
+
+    def join_room(self, rec, name, address):
+        # A room is joined without asking anybody, the room is created by its first member
+        key = (address, rec.user_field)
+        member = self.room_members.get(key)
+        if member is not None:
+            # The daemon of the member joins again, the old membership is over
+            self.leave_room(member)
+        room = self.rooms.get(name)
+        if room is None:
+            room = self.rooms[name] = Room(name)
+            if self.worker is not None:
+                self.worker.send('user', name)
+        if len(room.members) >= self.max_room_members:
+            self.send_error(name, address, rec.user + ": The room is full")
+            if not room.members:
+                del self.rooms[name]
+            return
+        member = room.add(address, rec.user, self.receive_window)
+        self.room_members[key] = member
+        # The SYNACK carries the user that joined, the daemon of the member can have more requests for the room
+        self.send_synack(name, address, rec.user)
+        log.info("%s from %s:%d joins room %s (%d members)", rec.user, *address, name, len(room.members))
+
+    def joined_room_packet(self, joined, rec, address):
+        # A packet of a room that clients of this daemon joined
+        if rec.operation == "ack":
+            # The ack of a message of one of the members
+            session = joined.sessions.get(rec.payload)
+            if session is not None:
+                self.ack_received(session, rec)
+            return
+        if rec.operation not in ("message", "batch", "fragment"):
+            return
+        if joined.receive_window is None:
+            # The daemon joined the room while it had packets in flight, the window starts at the first packet
+            joined.receive_window = ReceiveWindow(self.receive_window)
+            joined.receive_window.next = rec.number
+        if not self.receive_in_order(joined, joined.receive_window, rec, self.deliver_room):
+            return
+        # One ack for every member on this daemon, from any of them
+        session = next(iter(joined.sessions.values()))
+        self.send_daemon(self.control_packet(session, 'ack', 'response', number=rec.number), address)
+
+    def deliver_room(self, joined, message):
+        # A message of the room is sent to every member on this daemon, except the one that sent it
+        sender, _ = split_sender(message)
+        for username, session in joined.sessions.items():
+            if username != sender and session.handshake_state == 'established':
+                self.send_chat(session, message)
+
+    def leave_room(self, member, expired=False):
+        room = member.room
+        del self.room_members[member.key()]
+        for message_id in list(member.reassembly):
+            self.drop_reassembly(member, message_id, expired=False)
+        self.reassembly_bytes -= member.receive_window.held_bytes
+        member.receive_window.flush()
+        room.remove(member)
+        if expired:
+            self.expired_members += 1
+            log.warning("%s from %s:%d removed from room %s, not acknowledging", member.user, *member.address,
+                        room.name)
+        if not room.members:
+            room.cancel_retransmit_timer()
+            del self.rooms[room.name]
+            if self.worker is not None:
+                self.worker.send('user_gone', room.name)
+        else:
+            # The packets it did not acknowledge do not hold back the window any more
+            self.pump_room(room)
+
+    def room_packet(self, member, rec):
+        # A packet of the daemon of a member, the messages of the member are acknowledged and sent to the rest of the
+        # room, the acks are for the packets of the room
+        if rec.operation == "ack":
+            if rec.sequence == "request":
+                # The ack of the SYNACK, the member gets the messages from now on
+                if not member.joined:
+                    member.room.join(member)
+            else:
+                self.room_acknowledged(member, rec.number)
+            return
+        if not member.joined:
+            # The ack of the SYNACK was lost, the daemon of the member only sends after it
+            member.room.join(member)
+        if rec.operation == "fin":
+            # The FIN is sent after every packet of the member was acknowledged, nothing is missing before it
+            self.flush_receive_window(member, self.room_message)
+        elif rec.operation not in ("message", "batch", "fragment"):
+            return
+        elif not self.receive_in_order(member, member.receive_window, rec, self.room_message):
+            # A packet that was sent again because its ack was lost is only acknowledged again, it is not sent to the
+            # room twice
+            return
+        # The ack carries the member, the daemon of the member has one session for every member
+        ACK = SIMP_Socket(type='control', operation='ack', sequence='response', user=member.room.name,
+                          payload=member.user, number=rec.number)
+        self.send_daemon(ACK, member.address)
+        if rec.operation == "fin":
+            self.leave_room(member)
+
+    def room_message(self, member, payload):
+        # The message is sent to the rest of the room with the name of the sender, in fragments if it is too large
+        room = member.room
+        if room.queued_bytes >= self.queue_limit:
+            # The slowest member of the room does not keep up
+            self.dropped_messages += 1
+            return
+        message = member.user.encode('ascii') + b': ' + payload
+        size = self.fragment_bytes - HEADER_SIZE
+        if len(message) <= size:
+            room.buffer.append((message, 'message', member))
+            room.queued_bytes += len(message)
+        else:
+            for fragment in split_message(room.take_message_id(), message, size - FRAGMENT_SIZE):
+                room.buffer.append((fragment, 'fragment', member))
+                room.queued_bytes += len(fragment)
+                self.fragments_sent += 1
+        self.pump_room(room)
+
+    def pump_room(self, room):
+        # The sliding window of the room, a packet is in flight until every member acknowledged it
+        now = time.time()
+        buffer = room.buffer
+        while buffer and len(room.in_flight) < self.window_size:
+            payload, operation, sender = buffer.popleft()
+            room.queued_bytes -= len(payload)
+            if operation == 'message' and self.aggregate_bytes > 0:
+                # The waiting messages of the same member are sent in one batch
+                payloads = [payload]
+                size = HEADER_SIZE + FRAME_SIZE + len(payload)
+                while buffer and buffer[0][1] == 'message' and buffer[0][2] is sender:
+                    size += FRAME_SIZE + len(buffer[0][0])
+                    if size > self.aggregate_bytes:
                         break
-                    # If they accept the connection, then send a synack to the other daemon
-                    self.pending_request = False
-                    # SENDING SYNACK
-                    SYN = SIMP_Socket(
-                        type='control',
-                        operation='syn',
-                        sequence='response',
-                        user=self.client_username,
-                        payload=''
-                    )
-                    ACK = SIMP_Socket(
-                        type='control',
-                        operation='ack',
-                        sequence='response',
-                        user=self.client_username,
-                        payload=''
-                    )
-                    SYN_binary = SYN.encode()
-                    ACK_binary = ACK.encode()
-                    # Achieve SYNACK by ORing the binary of SYN and ACK
-                    SYN_ACK_binary = bytearray(b1 | b2 for b1, b2 in zip(ACK_binary, SYN_binary))
-                    self.daemon_socket.sendto(bytes(SYN_ACK_binary), (self.other_daemon_ip, self.daemon_port))
-                    print("synack sent")
-            if rec.type == "control" and rec.operation == "ack":
-                # If the ack is received, then the connection is established
-                self.other_daemon_connected = True
-                print("ACK received")
-                # send connection established to client
-                message = b'\x06\x00' + "Connection established".encode()
-                self.client_socket.sendto(message, self.client_address)
-                listen_to_daemon_thread = threading.Thread(target=self.listen_to_daemon)
-                listen_to_daemon_thread.start()
+                    payloads.append(buffer.popleft()[0])
+                    room.queued_bytes -= len(payloads[-1])
+                if len(payloads) > 1:
+                    operation = 'batch'
+                    payload = pack_messages(payloads)
+                    self.batches_sent += 1
+                    self.batched_messages += len(payloads)
+            # The daemon of the sender gets the message too (it does not send it to the sender), so every daemon gets
+            # every number of the room and its window has no gaps
+            mask = room.joined
+            if not mask:
+                continue
+            packet = SIMP_Socket(type='chat', operation=operation, sequence='request', user=room.name,
+                                 payload=payload, number=room.take_number())
+            # The packet is encoded once for all the members
+            data = packet.encode()
+            self.send_room(room, data, mask, operation)
+            room.in_flight[packet.number] = [data, now, now + room.estimator.rto, 0, mask, operation]
+        self.schedule_room_timer(room)
+
+    def send_room(self, room, data, mask, operation):
+        addresses = room.addresses
+        sendto = self.daemon_transport.sendto
+        count = 0
+        for slot in slots(mask):
+            sendto(data, addresses[slot])
+            count += 1
+        self.room_packets_sent += count
+        self.packets_sent.inc('chat', operation, amount=count)
+        self.daemon_bytes_sent += len(data) * count
+
+    def room_acknowledged(self, member, number):
+        room = member.room
+        entry = room.acknowledge(member.address, number)
+        if entry is None:
+            return
+        # Every daemon acknowledged the packet, the time of the last ack is used for the timeout of the room
+        if entry[3] == 0:
+            rtt = time.time() - entry[1]
+            room.estimator.sample(rtt)
+            self.ack_rtt.observe(rtt)
+        self.pump_room(room)
+
+    def schedule_room_timer(self, room):
+        room.cancel_retransmit_timer()
+        if room.in_flight:
+            due = min(entry[2] for entry in room.in_flight.values())
+            room.retransmit_timer = self.timers.call_later(max(0, due - time.time()), self.retransmit_room, room)
+
+    def retransmit_room(self, room):
+        # A packet is sent again to the daemons that did not acknowledge it in time
+        # The timeout of the room is doubled once when the timer runs out, however many packets are due, like with the
+        # sessions
+        room.retransmit_timer = None
+        estimator = room.estimator
+        now = time.time()
+        due = [(number, entry) for number, entry in room.in_flight.items() if entry[2] <= now]
+        if due:
+            estimator.backoff(max(entry[1] for _, entry in due), now)
+        for number, entry in due:
+            if room.in_flight.get(number) is not entry:
+                continue
+            data, sent_at, _, retries, pending, operation = entry
+            if retries >= self.max_retries:
+                # The members of the daemons that did not acknowledge it are removed from the room
+                for slot in slots(pending):
+                    for member in room.members_of(room.addresses[slot]):
+                        self.leave_room(member, expired=True)
+                if not room.members:
+                    return
+                continue
+            estimator.retransmits += 1
+            self.send_room(room, data, pending, operation)
+            entry[1] = now
+            entry[2] = now + estimator.rto
+            entry[3] = retries + 1
+        self.schedule_room_timer(room)
+
+    def handshake_answer(self, session, accepted):
+        user, address, compression = session.pending_request_data
+        session.pending_request_data = None
+        if session.request_asked_at is not None:
+            self.request_answer.observe(time.time() - session.request_asked_at)
+            session.request_asked_at = None
+        if accepted and (address, user_field(user)) not in self.sessions_by_peer:
+            # If they accept the connection, then send a synack to the other daemon
+            session.other_daemon_address = address
+            session.other_username = user
+            self.sessions_by_peer[session.peer_key()] = session
+            # The packets are compressed if both daemons can do it, the SYNACK tells the other daemon
+            session.compression = compression and self.compressor is not None
+            self.send_session_synack(session)
+            session.handshake_state = 'synack_sent'
+            session.client_state = 'handshake'
+            session.handshake_started = time.time()
+            session.handshake_retries = 0
+            self.schedule_synack(session)
+        else:
+            # If the client declines the connection, then send a FIN to the other daemon
+            # The peer is not accepted automatically any more
+            self.peer_cache.forget(session.client_username, address, user)
+            FIN = self.control_packet(session, 'fin', 'response', payload='Error: The other client declined your request')
+            self.send_daemon(FIN, address)
+            # The client sends a reask, and it is asked again if they want to wait or start
+            session.client_state = 'waiting'
+
+    def send_session_synack(self, session):
+        # The SYNACK carries the options of the connection
+        options = {COMPRESSION} if session.compression else set()
+        self.send_synack(session.client_username, session.other_daemon_address, join_options('', options))
+
+    def schedule_synack(self, session):
+        estimator = self.rtt_estimator(session)
+        delay = estimator.clamp(estimator.rto * 2 ** session.handshake_retries)
+        session.handshake_timer = self.timers.call_later(delay, self.resend_synack, session)
+
+    def resend_synack(self, session):
+        # The ACK of the SYNACK did not arrive in time, the SYNACK is sent again with a doubled timeout
+        session.handshake_timer = None
+        if session.handshake_retries >= self.max_retries:
+            log.warning("SYNACK of %s not acknowledged after %d resends", session.client_username,
+                        session.handshake_retries)
+            self.expire_session(session)
+            return
+        session.handshake_retries += 1
+        self.send_session_synack(session)
+        self.schedule_synack(session)
+
+    def send_synack(self, user, address, payload=''):
+        SYN = SIMP_Socket(type='control', operation='syn', sequence='response', user=user, payload=payload)
+        ACK = SIMP_Socket(type='control', operation='ack', sequence='response', user=user, payload=payload)
+        # Achieve SYNACK by ORing the binary of SYN and ACK
+        SYN_ACK_binary = bytearray(b1 | b2 for b1, b2 in zip(ACK.encode(), SYN.encode()))
+        self.daemon_transport.sendto(bytes(SYN_ACK_binary), address)
+        self.packets_sent.inc('control', 'synack')
+        self.daemon_bytes_sent += len(SYN_ACK_binary)
+
+    def synack_received(self, session, rec, address):
+        # If a synack is received, then the connection is established
+        # From now on the session is found by the user on the other daemon
+        del self.handshakes[session.handshake_key()]
+        session.other_username = rec.user
+        # The rest of the connection goes to the port the SYNACK came from
+        session.other_daemon_address = address
+        if session.other_username[:1] == '#':
+            # The packets of a room are for every member on this daemon
+            self.joined_rooms.setdefault(session.peer_key(), JoinedRoom()).sessions[session.client_username] = session
+        else:
+            self.sessions_by_peer[session.peer_key()] = session
+            session.compression = self.compressor is not None and COMPRESSION in split_options(rec.payload)[1]
+        # SENDING ACK
+        self.send_daemon(self.control_packet(session, 'ack', 'request'), address)
+        self.connection_established(session)
+
+    def connection_established(self, session):
+        if session.handshake_started is not None:
+            self.handshake_duration.observe(time.time() - session.handshake_started)
+        session.handshake_state = 'established'
+        session.client_state = 'chat'
+        session.cancel_handshake_timer()
+        session.receive_window = ReceiveWindow(self.receive_window)
+        session.last_heard = time.time()
+        if self.keepalive_interval > 0 and session.other_username[:1] != '#':
+            # The rooms remove the members that stop acknowledging the packets of the room, they have no keepalives
+            self.schedule_keepalive(session, self.keepalive_interval)
+        # The next request of the other user can be accepted without asking the client
+        self.peer_cache.remember(session.client_username, session.other_daemon_address, session.other_username)
+        # send connection established to client
+        address = session.other_daemon_address
+        self.send_client(session, b'\x06\x00' + f"Connection established with {session.other_username} ({address[0]}:{address[1]})".encode())
+        if self.message_log is not None and not session.other_username.startswith('#'):
+            self.replay_messages(session)
+
+    def log_key(self, session):
+        # The messages are sent again to the same user of the same daemon, on any port of it
+        return peer_key(session.client_username, session.other_username, session.other_daemon_address[0])
+
+    def replay_messages(self, session):
+        # The messages of the log that the user did not get in the last chat are sent before the new ones
+        pending = self.message_log.pending(self.log_key(session))
+        if not pending:
+            return
+        log.info("Sending %d messages of %s to %s again from the log", len(pending), session.client_username,
+                 session.other_username)
+        self.replayed_messages += len(pending)
+        for sequence, packet in pending.items():
+            self.queue_message(session, packet[HEADER_SIZE:], sequence)
+
+    def ack_received(self, session, rec):
+        if session.handshake_state == 'synack_sent':
+            # If the ack is received, then the connection is established
+            self.connection_established(session)
+            return
+        if session.handshake_state != 'established' or rec.sequence != 'response':
+            # The ack of the handshake is a request, the ones of the packets are responses, a handshake ack that arrives
+            # again (after a SYNACK was sent again) has the number 0 and does not acknowledge packet 0
+            return
+        # If the ack is received there can be two cases
+        # Either it is an ack for a message
+        # In this case the message is removed from the in flight messages, which makes room in the window
+        if rec.number in session.in_flight:
+            message, sent_at, due, retries, client_messages = session.in_flight.pop(rec.number)
+            # Resent messages are not used for the estimation, because it is unknown which send was acked
+            if retries == 0:
+                rtt = time.time() - sent_at
+                self.rtt_estimator(session).sample(rtt)
+                self.ack_rtt.observe(rtt)
+            # Or it is an ack for the fin
+            if session.fin_sent and rec.number == session.fin_number:
+                # In this case it is indicated that the connection can be closed
+                self.send_client(session, b'\x03\x00')
+                self.close_session(session)
+                return
+            self.messages_acknowledged(session, client_messages)
+            self.fast_retransmit(session, rec.number)
+            self.pump_window(session, flush=session.quitting)
+
+    def fin_received(self, session, rec):
+        if session.handshake_state == 'syn_sent':
+            log.info("Request of %s was declined by %s", session.client_username, session.other_daemon_address)
+            # If a fin is received, the other client declined the connection
+            # send error to client
+            self.send_client(session, b'\x02\x00' + rec.payload.encode())
+            self.close_session(session)
+        elif session.handshake_state == 'established':
+            # If the other daemon sends a fin send an ack to the other daemon and close the connection
+            # The held packets are sent to the client first, the missing ones before them are not sent any more
+            self.flush_receive_window(session)
+            self.send_daemon(self.control_packet(session, 'ack', 'response', number=rec.number), session.other_daemon_address)
+            # The FIN is acknowledged again if its ack is lost, until the other daemon gives up sending it
+            key = session.peer_key()
+            if key in self.closed_connections:
+                self.closed_connections[key][1].cancel()
+            self.closed_connections[key] = (session.client_username,
+                                            self.timers.call_later(self.closed_wait, self.closed_connections.pop, key))
+            self.send_client(session, b'\x03\x00' + rec.payload.encode())
+            self.close_session(session)
+
+    def flush_receive_window(self, session, deliver=None):
+        window = session.receive_window
+        if window is None or not window.held:
+            return
+        self.reassembly_bytes -= window.held_bytes
+        for operation, payload in window.flush():
+            self.deliver_packet(session, operation, payload, deliver)
+
+    def messages_acknowledged(self, session, client_messages):
+        # The client is told when every message up to a number is acknowledged by the other daemon
+        # A message is acknowledged when the packets of all of its fragments are acknowledged
+        unacked = session.unacked_messages
+        for number in client_messages:
+            if unacked[number] == 1:
+                del unacked[number]
+                if session.log_sequences:
+                    sequence = session.log_sequences.pop(number, None)
+                    if sequence is not None:
+                        self.message_log.acknowledge(sequence)
+            else:
+                unacked[number] -= 1
+        # The messages sent again from the log are before the messages of the client, they have negative numbers
+        acked = next(iter(unacked), session.next_client_message)
+        if acked > session.acked_messages:
+            session.acked_messages = acked
+            self.send_client(session, b'\x0b\x00' + str(acked).encode())
+
+    def drop_client_message(self, session):
+        # The message of the client is not sent, the client is told its number
+        number = session.take_client_message()
+        self.send_client(session, b'\x0a\x00dropped ' + str(number).encode())
+
+    def queue_message(self, session, payload, log_sequence=None):
+        # The message is put to the message buffer, split to fragments if it does not fit in one packet
+        # With log_sequence the message is sent again from the message log, otherwise it is a message of the client
+        if log_sequence is not None:
+            number = session.take_replayed_message()
+        elif session.queued_bytes >= self.queue_limit:
+            # The other daemon does not keep up with the client, the message does not fit in the buffer
+            self.dropped_messages += 1
+            self.drop_client_message(session)
+            return
+        else:
+            number = session.take_client_message()
+            if self.message_log is not None and not session.other_username.startswith('#'):
+                # The messages to the rooms are not logged, a member that left does not get them again
+                packet = SIMP_Socket(type='chat', operation='message', sequence='request',
+                                     user=session.client_username, payload=bytes(payload))
+                log_sequence = self.message_log.append(self.log_key(session), packet.encode())
+        if log_sequence is not None:
+            session.log_sequences[number] = log_sequence
+        size = self.fragment_bytes - HEADER_SIZE
+        if len(payload) <= size:
+            payloads = [payload]
+            operation = 'message'
+        else:
+            payloads = split_message(session.take_message_id(), payload, size - FRAGMENT_SIZE)
+            operation = 'fragment'
+            self.fragments_sent += len(payloads)
+        if not session.message_buffer:
+            session.buffered_at = time.time()
+        session.unacked_messages[number] = len(payloads)
+        for payload in payloads:
+            session.queue(SIMP_Socket(
+                type='chat',
+                operation=operation,
+                sequence='request',
+                user=session.client_username,
+                payload=payload
+            ), number)
+        self.pump_window(session)
+        if not session.paused and session.queued_bytes > self.queue_high_water:
+            # The client is asked to stop sending until the buffer is drained
+            session.paused = True
+            self.backpressure_events += 1
+            self.send_client(session, b'\x0a\x00pause')
+
+    def fragment_received(self, session, payload, deliver=None):
+        # This function stores a fragment of a message, and sends the message to the client when it is complete
+        # (with deliver, the fragments of the members of a room are passed to it)
+        # It returns False if the fragment could not be stored
+        if len(payload) < FRAGMENT_SIZE:
+            return False
+        message_id, index, count = FRAGMENT.unpack_from(payload)
+        if index >= count:
+            return False
+        entry = session.reassembly.get(message_id)
+        if entry is None:
+            timer = self.timers.call_later(self.reassembly_timeout, self.drop_reassembly, session, message_id)
+            entry = session.reassembly[message_id] = [count, {}, 0, timer]
+        elif count != entry[0]:
+            # The fragments of the message do not agree on its size, the message is dropped
+            self.drop_reassembly(session, message_id, expired=False)
+            self.invalid_fragments += 1
+            return False
+        fragments = entry[1]
+        if index in fragments:
+            # The fragment was sent again because its ack was lost
+            return True
+        size = len(payload) - FRAGMENT_SIZE
+        if self.reassembly_bytes + size > self.max_reassembly_bytes:
+            self.reassembly_full += 1
+            return False
+        # The fragment is copied, the received buffer is reused after the callback
+        fragments[index] = bytes(payload[FRAGMENT_SIZE:])
+        entry[2] += size
+        self.reassembly_bytes += size
+        if len(fragments) == entry[0]:
+            self.drop_reassembly(session, message_id, expired=False)
+            self.messages_reassembled += 1
+            (deliver or self.send_chat)(session, b''.join(fragments[index] for index in range(entry[0])))
+        return True
+
+    def drop_reassembly(self, session, message_id, expired=True):
+        # The message is removed from the reassembly buffer, when it is complete or its fragments did not arrive in time
+        count, fragments, size, timer = session.reassembly.pop(message_id)
+        timer.cancel()
+        self.reassembly_bytes -= size
+        if expired:
+            self.reassembly_drops += 1
+            log.warning("Message %d was not reassembled in time, %d of %d fragments arrived", message_id, len(fragments),
+                        count)
+
+    def pump_window(self, session, flush=False):
+        # This function sends the messages from the message buffer to the other daemon using a sliding window
+        # Up to window_size packets can be sent without waiting for their acks
+        # Every packet is acknowledged on its own, so only the packets that were lost are sent again
+        estimator = self.rtt_estimator(session)
+        while len(session.message_buffer) > 0 and len(session.in_flight) < self.window_size:
+            if session.in_flight and (session.next_number - next(iter(session.in_flight))) % 2 ** 32 >= self.receive_window:
+                # The other daemon holds at most receive_window packets after a missing one, the window waits until the
+                # oldest packet is acknowledged
                 break
-            if rec.type == "control" and rec.operation == "fin":
-                print("FIN received, connection was declined")
-                # If a fin is received, the other client declined the connection
-                # send error to client
-                message = b'\x02\x00' + rec.payload.encode()
-                self.client_socket.sendto(message, self.client_address)
-                # Reset the waiting for handshake
-                self.client_connected = False
-                self.client_address = None
-                self.other_daemon_ip = None
-                handshake_receiver_thread = threading.Thread(target=self.handshake_receiver)
-                handshake_receiver_thread.start()
+            message, client_messages = self.take_packet(session, flush)
+            if message is None:
+                # The batch waits for more messages, until the older packets are acknowledged or the delay is over
+                if session.aggregate_timer is None:
+                    delay = max(0, session.buffered_at + self.aggregate_delay - time.time())
+                    session.aggregate_timer = self.timers.call_later(delay, self.flush_aggregate, session)
                 break
-            if rec.type == "control" and rec.operation == "synack":
-                # If a synack is received, then the connection is established
-                # SENDING ACK
-                ACK = SIMP_Socket(
-                    type='control',
-                    operation='ack',
-                    sequence='request',
-                    user=self.client_username,
-                    payload=''
-                )
-                ACK_binary = ACK.encode()
-                self.daemon_socket.sendto(ACK_binary, (self.other_daemon_ip, self.daemon_port))
-                self.other_daemon_connected = True
-                print("sending ack")
-                # send connection established to client
-                message = b'\x06\x00' + "Connection established".encode()
-                self.client_socket.sendto(message, self.client_address)
-                listen_to_daemon_thread = threading.Thread(target=self.listen_to_daemon)
-                listen_to_daemon_thread.start()
+            message.number = session.take_number()
+            if session.compression:
+                self.compress_packet(message)
+            self.send_daemon(message, session.other_daemon_address)
+            # The message is waiting for the ack, the resend timer runs out after the current timeout
+            now = time.time()
+            session.in_flight[message.number] = [message, now, now + estimator.rto, 0, client_messages]
+        if not session.message_buffer:
+            session.cancel_aggregate_timer()
+            if session.quitting and not session.in_flight and not session.fin_sent:
+                self.send_fin(session)
+        if session.paused and session.queued_bytes <= self.queue_high_water // 2:
+            session.paused = False
+            self.send_client(session, b'\x0a\x00resume')
+        self.schedule_retransmit_timer(session)
+
+    def send_fin(self, session):
+        # The FIN is the last packet of the connection, it is in flight like a message, so it is sent again until it is
+        # acknowledged
+        FIN = self.control_packet(session, 'fin', 'request', number=session.take_number())
+        # Indicate that the daemon is waiting for the ack
+        session.fin_sent = True
+        session.fin_number = FIN.number
+        self.send_daemon(FIN, session.other_daemon_address)
+        now = time.time()
+        session.in_flight[FIN.number] = [FIN, now, now + self.rtt_estimator(session).rto, 0, ()]
+
+    def take_packet(self, session, flush):
+        # This function takes the next packet from the message buffer, a single message or a batch of messages, and
+        # the numbers of the client's messages in it
+        # It returns None if the batch should wait for more messages (in the way of Nagle's algorithm)
+        buffer = session.message_buffer
+        # The fragments are as large as a packet can be, they are never aggregated
+        if self.aggregate_bytes <= 0 or buffer[0].operation != 'message' or len(buffer) == 1 and not session.in_flight:
+            message, number = session.dequeue()
+            return message, (number,)
+        size = HEADER_SIZE
+        count = 0
+        for message in buffer:
+            if message.operation != 'message':
                 break
-            if rec.type == "control" and rec.operation == "error":
-                # If an error is received, then the other client is already connected to another daemon
-                # send error to client
-                message = b'\x02\x00' + rec.payload.encode()
-                self.client_socket.sendto(message, self.client_address)
-                # Reset everything
-                self.client_connected = False
-                self.client_address = None
-                self.other_daemon_ip = None
-                handshake_receiver_thread = threading.Thread(target=self.handshake_receiver)
-                handshake_receiver_thread.start()
+            size += FRAME_SIZE + len(message.payload)
+            if count > 0 and size > self.aggregate_bytes:
                 break
+            count += 1
+        # A batch that is not full is only sent when nothing is in flight, or when it waited for long enough
+        if count == len(buffer) and not flush and session.in_flight:
+            if time.time() - session.buffered_at < self.aggregate_delay:
+                return None, None
+        messages, numbers = zip(*(session.dequeue() for _ in range(count)))
+        if count == 1:
+            return messages[0], numbers
+        self.batches_sent += 1
+        self.batched_messages += count
+        return SIMP_Socket(
+            type='chat',
+            operation='batch',
+            sequence='request',
+            user=session.client_username,
+            payload=pack_messages([message.payload for message in messages])
+        ), numbers
+
+    def compress_packet(self, message):
+        # A batch is compressed as a whole, so the short messages in it are compressed as well
+        payload = self.compressor.compress(message.payload_binary())
+        if payload is not None:
+            message.payload = payload
+            message.flags = COMPRESSED
+
+    def flush_aggregate(self, session):
+        # The batch waited for aggregate_delay, it is sent as soon as there is room in the window
+        session.aggregate_timer = None
+        session.buffered_at = time.time() - self.aggregate_delay
+        self.pump_window(session, flush=True)
+
+    def schedule_retransmit_timer(self, session):
+        # The timer is set to the first in flight message that is due
+        session.cancel_retransmit_timer()
+        if session.in_flight:
+            due = min(entry[2] for entry in session.in_flight.values())
+            session.retransmit_timer = self.timers.call_later(max(0, due - time.time()), self.retransmit, session)
+
+    def retransmit(self, session):
+        # If a message was not acknowledged in time it is sent again with a doubled timeout
+        # The timeout is doubled once when the timer runs out, however many packets are due (a lost burst is one loss),
+        # and it stays doubled until a packet that was not sent again is acknowledged (Karn's algorithm)
+        session.retransmit_timer = None
+        estimator = self.rtt_estimator(session)
+        now = time.time()
+        expired = [(number, entry) for number, entry in session.in_flight.items() if entry[2] <= now]
+        if expired:
+            estimator.backoff(max(entry[1] for _, entry in expired), now)
+        for number, entry in expired:
+            message, sent_at, due, retries, client_messages = entry
+            if retries >= self.max_retries:
+                log.warning("Message %d not acknowledged after %d resends, closing connection", number, retries)
+                self.expire_session(session)
+                return
+            estimator.retransmits += 1
+            self.send_daemon(message, session.other_daemon_address)
+            entry[1] = now
+            entry[2] = now + estimator.rto
+            entry[3] = retries + 1
+            if self.debug:
+                log.debug("Message %d not acknowledged, resending (timeout %.3fs)", number, estimator.rto)
+        self.schedule_retransmit_timer(session)
+
+    def fast_retransmit(self, session, number):
+        # The other daemon holds the packets after a missing one, so the oldest packet in flight is sent again as soon
+        # as fast_retransmit_acks packets after it were acknowledged, without waiting for its timeout (and without
+        # doubling it, the acks show that the path works)
+        oldest = next(iter(session.in_flight), None)
+        if oldest is None or (number - oldest) % 2 ** 32 >= HALF:
+            return
+        if session.fast_retransmit_number != oldest:
+            session.fast_retransmit_number = oldest
+            session.later_acks = 0
+        session.later_acks += 1
+        if session.later_acks < self.fast_retransmit_acks:
+            return
+        session.later_acks = 0
+        entry = session.in_flight[oldest]
+        if entry[3] >= self.max_retries:
+            return
+        now = time.time()
+        self.fast_retransmits += 1
+        self.rtt_estimator(session).retransmits += 1
+        self.send_daemon(entry[0], session.other_daemon_address)
+        entry[1] = now
+        entry[2] = now + self.rtt_estimator(session).rto
+        entry[3] += 1
+
+    def rtt_estimator(self, session):
+        # This function returns the timeout estimation of the other daemon of the session
+        address = session.other_daemon_address
+        if address not in self.rtt_estimators:
+            self.rtt_estimators[address] = RttEstimator()
+        return self.rtt_estimators[address]
+
+    def forwarded_syn(self, data, address):
+        # A request that arrived on another worker for a user of this one
+        try:
+            rec = SimpPacket(data)
+        except Exception:
+            return
+        self.syn_received(rec, address, forwarded=True)
+
+    def username_taken(self, username):
+        # Another worker has a client with the same username, this client is disconnected
+        session = self.sessions_by_username.get(username)
+        if session is not None:
+            self.send_client(session, b'\x02\x00' + "The username is already used on this daemon".encode())
+            self.close_session(session)
+
+    def expire_session(self, session):
+        # This function closes the connection when the other daemon stopped acknowledging the messages
+        self.expired_sessions += 1
+        self.send_client(session, b'\x02\x00' + "The other daemon is not responding".encode())
+        self.close_session(session)
+        # The timeout estimation of the other daemon is removed if no other connection uses it
+        address = session.other_daemon_address
+        if all(other.other_daemon_address != address for other in self.sessions.values()):
+            estimator = self.rtt_estimators.pop(address, None)
+            if estimator is not None:
+                self.removed_retransmits += estimator.retransmits
+
+    def close_session(self, session):
+        # The connection to the client and the other daemon is closed, the session is removed from every table
+        session.cancel_retransmit_timer()
+        session.cancel_aggregate_timer()
+        session.cancel_keepalive_timer()
+        session.cancel_handshake_timer()
+        for message_id in list(session.reassembly):
+            self.drop_reassembly(session, message_id, expired=False)
+        if session.receive_window is not None:
+            self.reassembly_bytes -= session.receive_window.held_bytes
+            session.receive_window.flush()
+        self.sessions.pop(session.client_address, None)
+        if isinstance(session.client_address, str) and self.local_transport is not None:
+            # The connection of a local client is closed after the last message to it was sent, the client connects
+            # again for a new session
+            self.local_transport.close_connection(session.client_address)
+        self.stop_waiting(session)
+        if self.sessions_by_username.get(session.client_username) is session:
+            del self.sessions_by_username[session.client_username]
+            if self.worker is not None:
+                self.worker.send('user_gone', session.client_username)
+            if self.upstream is not None:
+                self.announce_routes([(session.client_username, MAX_HOPS)])
+        if self.sessions_by_peer.get(session.peer_key()) is session:
+            del self.sessions_by_peer[session.peer_key()]
+        joined = self.joined_rooms.get(session.peer_key())
+        if joined is not None and joined.sessions.get(session.client_username) is session:
+            del joined.sessions[session.client_username]
+            if not joined.sessions:
+                for message_id in list(joined.reassembly):
+                    self.drop_reassembly(joined, message_id, expired=False)
+                if joined.receive_window is not None:
+                    self.reassembly_bytes -= joined.receive_window.held_bytes
+                    joined.receive_window.flush()
+                del self.joined_rooms[session.peer_key()]
+        if self.handshakes.get(session.handshake_key()) is session:
+            del self.handshakes[session.handshake_key()]
+
+    def get_stats(self):
+        # This function returns the current timeouts and the resend counters of every other daemon
+        return {
+            'peers': {'{}:{}'.format(*address): estimator.stats() for address, estimator in self.rtt_estimators.items()},
+            'worker': self.worker.index if self.worker is not None else None,
+            'sessions': len(self.sessions),
+            'local_sessions': sum(isinstance(address, str) for address in self.sessions),
+            'in_flight': sum(len(session.in_flight) for session in self.sessions.values()),
+            'queued_messages': sum(len(session.message_buffer) for session in self.sessions.values()),
+            'queued_bytes': sum(session.queued_bytes for session in self.sessions.values()),
+            'max_queued_bytes': max((session.queued_bytes for session in self.sessions.values()), default=0),
+            'backpressure_events': self.backpressure_events,
+            'dropped_messages': self.dropped_messages,
+            'expired_sessions': self.expired_sessions,
+            'keepalives_sent': self.keepalives_sent,
+            'dead_peers': self.dead_peers,
+            'expired_handshakes': self.expired_handshakes,
+            'timers': self.timers.stats(),
+            'auto_accepted': self.auto_accepted,
+            'peer_cache': self.peer_cache.stats(),
+            'message_log': self.message_log.stats() if self.message_log is not None else None,
+            'replayed_messages': self.replayed_messages,
+            'compression': self.compressor.stats() if self.compressor is not None else None,
+            'bytes_sent': self.daemon_bytes_sent,
+            'bytes_received': self.daemon_bytes_received,
+            'relayed_packets': self.relayed_packets,
+            'rooms': len(self.rooms),
+            'room_members': len(self.room_members),
+            'room_packets_sent': self.room_packets_sent,
+            'expired_members': self.expired_members,
+            'circuits': len(self.circuits),
+            'routes': self.routes.stats(),
+            'batches_sent': self.batches_sent,
+            'batched_messages': self.batched_messages,
+            'fragments_sent': self.fragments_sent,
+            'messages_reassembled': self.messages_reassembled,
+            'reassembly_drops': self.reassembly_drops,
+            'invalid_fragments': self.invalid_fragments,
+            'reassembly_bytes': self.reassembly_bytes,
+            'fast_retransmits': self.fast_retransmits,
+            'duplicate_packets': self.duplicate_packets,
+            'held_packets': self.held_packets,
+            'window_drops': self.window_drops,
+            'io': {
+                'daemon': self.daemon_transport.get_stats() if self.batched_io else None,
+                'listen': self.listen_transport.get_stats() if self.batched_io and self.listen_transport else None,
+                'client': self.client_transport.get_stats() if self.batched_io else None,
+                'local': self.local_transport.get_stats() if self.local_transport is not None else None
+            }
+        }
 
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python3 simp_daemon.py <ip_address>")
+    # --relay forwards the requests for the users of other daemons, --upstream=<ip[:port]> announces the users to a relay
+    # --message-log=<directory> keeps the messages that were not acknowledged on the disk
+    # --compress compresses the chat packets of the connections with the daemons that can decompress them
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith('--')]
+    flags = dict(argument[2:].partition('=')[::2] for argument in sys.argv[1:] if argument.startswith('--'))
+    if len(arguments) not in (1, 3, 4) or not set(flags) <= {'relay', 'upstream', 'message-log', 'compress'}:
+        print("Usage: python3 simp_daemon.py <ip_address> [<daemon_port> <client_port> [<metrics_port>]] [--relay] "
+              "[--upstream=<ip[:port]>] [--message-log=<directory>] [--compress]")
+        print("Set SIMP_LOG=DEBUG to log every packet")
         sys.exit(1)
 
-    daemon_ip = sys.argv[1]
-    daemon = SimpDaemon(daemon_ip)
+    # The logging is configured before the daemon is created, the daemon checks the level once
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    log.setLevel(os.environ.get('SIMP_LOG', 'INFO').upper())
+    daemon_ip = arguments[0]
+    ports = dict(zip(('daemon_port', 'client_port', 'metrics_port'), map(int, arguments[1:])))
+    daemon = SimpDaemon(daemon_ip, relay='relay' in flags, upstream=flags.get('upstream'),
+                        message_log=flags.get('message-log'), compression='compress' in flags, **ports)
+    asyncio.run(daemon.serve_forever())
@@ -0,0 +1,430 @@
+import asyncio
+import inspect
+import os
+import socket
+import threading
+
+from local_io import LocalConnection, is_own_peer, local_socket_path, local_transport_supported
+
+# The types of the messages between the client and the daemon, the first byte of every message
+CONNECT = b'\x00'
+CHAT = b'\x01'
+ERROR = b'\x02'
+QUIT = b'\x03'
+CONNREQ = b'\x04'
+WAITORSTART = b'\x05'
+CONNESTAB = b'\x06'
+REASK = b'\x07'
+CHATPART = b'\x08'
+YESNO = b'\x09'
+BACKPRESSURE = b'\x0a'
+ACKED = b'\x0b'
+
+# The messages are sent and received in parts of at most this size, so they fit in a datagram
+PART_SIZE = 65000
+
+
+class SimpError(Exception):
+    # An error sent by the daemon, or a message that could not be delivered
+    pass
+
+
+class DaemonDatagramProtocol(asyncio.DatagramProtocol):
+    # This endpoint receives the messages of the daemon and hands them over to the client
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, address):
+        self.client.datagram_received(data)
+
+    def error_received(self, exc):
+        # The daemon is not running on the address
+        self.client.control.put_nowait((ERROR, str(exc)))
+
+    def connection_closed(self, connection, error):
+        # The local connection to the daemon was lost, this is the same as an error of the daemon
+        if error is not None:
+            self.client.datagram_received(ERROR + b'\x00' + b'The daemon closed the connection')
+
+
+class AsyncSimpClient:
+    '''
+    A client of a SIMP daemon for programs, on asyncio.
+    --
+    connect(username) - connects to the daemon, then the state is choosing (or connreq if a request is waiting)
+    start_chat(target) - sends a request to [user@]ip[:port] and returns when it is accepted
+    wait_for_chat(accept) - waits for a request, accept(request) decides about it, returns True if it was accepted
+                            (a request of a peer known by the daemon is accepted without calling accept)
+    send(message) - sends a message and returns when the other daemon acknowledged it
+    receive() or async for - the messages of the other client, until the chat ends
+    receive_batch() - every message of the other client that arrived (at least one), an empty list when the chat ended
+    close() - ends the chat and disconnects from the daemon
+    --
+    States:
+    closed - not connected to the daemon, or the chat ended
+    choosing - the daemon asks if the client waits for a request or starts one
+    waiting - waiting for a request
+    connreq - a request is waiting for an answer, its text is in request
+    handshake - the request was sent, waiting for the other client to accept it
+    chat - the chat is established
+    --
+    Every method has to be called from the event loop of the client, SimpClient can be used from any thread.
+    If the daemon runs on the same host the client is connected to it on its Unix domain socket (is_local is True),
+    otherwise it uses UDP. local=False always uses UDP.
+    '''
+
+    def __init__(self, daemon_ip, daemon_port=7778, timeout=10.0, local=True):
+        self.daemon_address = (daemon_ip, daemon_port)
+        self.local = local and local_transport_supported()
+        self.is_local = False
+        # How long to wait for the answers of the daemon
+        self.timeout = timeout
+        self.transport = None
+        self.username = None
+        self.state = 'closed'
+        self.request = None
+        # The text of the daemon about the other client of the chat
+        self.peer = None
+        # The error that ended the chat, if it did not end with a quit
+        self.error = None
+        # The messages of the daemon that are not chat messages, and the chat messages of the other client
+        self.control = asyncio.Queue()
+        self.incoming = asyncio.Queue()
+        self.ended = False
+        self.parts = []
+        # Cleared while the daemon asks the client to pause
+        self.can_send = asyncio.Event()
+        self.can_send.set()
+        # The messages of the chat are numbered in the order they are sent, the daemon acknowledges them by number
+        self.sent = 0
+        self.pending = {}
+
+    async def connect(self, username):
+        loop = asyncio.get_running_loop()
+        protocol = DaemonDatagramProtocol(self)
+        sock = self.open_local_socket() if self.local else None
+        if sock is not None:
+            self.transport = LocalConnection(loop, sock, protocol, sock.getpeername(), protocol.connection_closed)
+            self.is_local = True
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # The parts of a large message arrive right after each other, the receive buffer has room for them
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4 * 1024 * 1024)
+            sock.connect(self.daemon_address)
+            self.transport, _ = await loop.create_datagram_endpoint(lambda: protocol, sock=sock)
+        self.send_raw(CONNECT + b'\x01')
+        # The daemon answers with connection established, then asks for the username
+        await self.expect(CONNECT)
+        await self.expect(CONNECT)
+        self.username = username
+        self.send_raw(CONNECT + b'\x01' + username.encode())
+        await self.next_prompt()
+
+    async def start_chat(self, target):
+        if self.state != 'choosing':
+            raise SimpError('A chat can not be started in the state ' + self.state)
+        self.send_raw(WAITORSTART + b'\x00start')
+        await self.expect(WAITORSTART)
+        self.send_raw(WAITORSTART + b'\x00' + target.encode())
+        self.state = 'handshake'
+        # The other client may answer any time later
+        _, text = await self.expect(CONNESTAB, timeout=None)
+        self.chat_started(text)
+
+    async def wait_for_chat(self, accept=None):
+        # accept is called with the text of the request, it can return a bool or an awaitable of it
+        # Without accept every request is accepted
+        if self.state == 'choosing':
+            self.send_raw(WAITORSTART + b'\x00wait')
+            self.state = 'waiting'
+        if self.state == 'waiting':
+            type, text = await self.expect(CONNREQ, CONNESTAB, timeout=None)
+            if type == CONNESTAB:
+                # The daemon accepted the request of a known peer without asking
+                self.chat_started(text)
+                return True
+            self.request = text
+            self.state = 'connreq'
+        if self.state != 'connreq':
+            raise SimpError('A request can not be waited for in the state ' + self.state)
+        answer = True if accept is None else accept(self.request)
+        if inspect.isawaitable(answer):
+            answer = await answer
+        self.request = None
+        if answer:
+            self.send_raw(YESNO + b'\x01y')
+            _, text = await self.expect(CONNESTAB)
+            self.chat_started(text)
+            return True
+        # After a declined request the daemon asks again if the client waits or starts
+        self.send_raw(YESNO + b'\x01n')
+        self.send_raw(REASK)
+        await self.next_prompt()
+        return False
+
+    async def send(self, message, timeout=None):
+        if self.state != 'chat':
+            raise SimpError('The chat is not established')
+        if isinstance(message, str):
+            message = message.encode()
+        if not self.can_send.is_set():
+            await self.can_send.wait()
+            if self.state != 'chat':
+                raise SimpError('The chat ended')
+        number = self.sent
+        self.sent += 1
+        acknowledged = asyncio.get_running_loop().create_future()
+        self.pending[number] = acknowledged
+        start = 0
+        while len(message) - start > PART_SIZE:
+            self.send_raw(CHATPART + b'\x01' + message[start:start + PART_SIZE])
+            start += PART_SIZE
+        self.send_raw(CHAT + b'\x01' + message[start:])
+        await asyncio.wait_for(acknowledged, timeout)
+
+    async def receive(self):
+        # This function returns the next message of the other client, or None if the chat ended
+        if self.ended and self.incoming.empty():
+            return None
+        return await self.incoming.get()
+
+    async def receive_batch(self, limit=1024):
+        # This function waits for the next message of the other client, and returns it with the messages that arrived
+        # after it, so a burst of messages can be handled at once
+        message = await self.receive()
+        messages = []
+        while message is not None:
+            messages.append(message)
+            if len(messages) >= limit or self.incoming.empty():
+                break
+            # After the end of the chat the next call returns an empty list
+            message = self.incoming.get_nowait()
+        return messages
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.receive()
+        if message is None:
+            raise StopAsyncIteration
+        return message
+
+    async def close(self):
+        if self.transport is None:
+            return
+        if self.state != 'closed':
+            self.send_raw(QUIT + b'\x00')
+            try:
+                await self.expect(QUIT)
+            except (SimpError, asyncio.TimeoutError):
+                pass
+        self.end_chat(None)
+        self.transport.close()
+        self.transport = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def open_local_socket(self):
+        # This function connects to the Unix domain socket of the daemon, if the daemon runs on the same host
+        # It returns None if there is no such socket, or the daemon that created it is not running any more, or it was
+        # not created by a daemon of the same user
+        path = local_socket_path(*self.daemon_address)
+        if path is None:
+            return None
+        try:
+            if os.lstat(path).st_uid != os.getuid():
+                return None
+        except OSError:
+            return None
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            sock.connect(path)
+            if not is_own_peer(sock):
+                sock.close()
+                return None
+        except OSError:
+            sock.close()
+            return None
+        return sock
+
+    def send_raw(self, data):
+        self.transport.sendto(data)
+
+    async def expect(self, *types, timeout=0):
+        # This function waits for a message of one of the types from the daemon, the other messages are skipped
+        # An error of the daemon is raised, the daemon closed the session
+        if timeout == 0:
+            timeout = self.timeout
+        while True:
+            type, text = await asyncio.wait_for(self.control.get(), timeout)
+            if type in types:
+                return type, text
+            if type == ERROR:
+                self.state = 'closed'
+                raise SimpError(text)
+
+    async def next_prompt(self):
+        # After the username and after a declined request the daemon asks if the client waits or starts,
+        # or tells about a request that is already waiting
+        type, text = await self.expect(WAITORSTART, CONNREQ)
+        if type == CONNREQ:
+            self.state = 'connreq'
+            self.request = text
+        else:
+            self.state = 'choosing'
+
+    def chat_started(self, text):
+        self.state = 'chat'
+        self.peer = text
+        self.sent = 0
+
+    def end_chat(self, error):
+        # The pending messages fail and the iteration of the incoming messages stops
+        self.state = 'closed'
+        if error is not None and self.error is None:
+            self.error = error
+        if not self.ended:
+            self.ended = True
+            self.incoming.put_nowait(None)
+        for acknowledged in self.pending.values():
+            if not acknowledged.done():
+                acknowledged.set_exception(error or SimpError('The chat ended before the message was acknowledged'))
+        self.pending.clear()
+        self.can_send.set()
+
+    def datagram_received(self, data):
+        type = data[:1]
+        if type == CHATPART:
+            self.parts.append(data[2:])
+        elif type == CHAT:
+            payload = b''.join(self.parts) + data[2:] if self.parts else data[2:]
+            self.parts = []
+            self.incoming.put_nowait(payload.decode(errors='replace'))
+        elif type == ACKED:
+            # Every message below the number is acknowledged
+            acked = int(data[2:])
+            while self.pending:
+                number = next(iter(self.pending))
+                if number >= acked:
+                    break
+                acknowledged = self.pending.pop(number)
+                if not acknowledged.done():
+                    acknowledged.set_result(None)
+        elif type == BACKPRESSURE:
+            text = data[2:].decode()
+            if text == 'pause':
+                self.can_send.clear()
+            elif text == 'resume':
+                self.can_send.set()
+            elif text.startswith('dropped'):
+                acknowledged = self.pending.pop(int(text.split()[1]), None)
+                if acknowledged is not None and not acknowledged.done():
+                    acknowledged.set_exception(SimpError('The message was dropped by the daemon'))
+        else:
+            text = data[2:].decode(errors='replace')
+            if type in (QUIT, ERROR) and self.state == 'chat':
+                self.end_chat(SimpError(text) if type == ERROR else None)
+            self.control.put_nowait((type, text))
+
+
+class SimpClient:
+    '''
+    The same client for threads, the asyncio client runs on an event loop in a background thread.
+    Every method can be called from any thread, it blocks until the method of the asyncio client returns.
+    --
+    for message in client - the messages of the other client, until the chat ends
+    send_nowait(message) - sends a message without blocking, returns a concurrent.futures.Future that is done when the
+                           other daemon acknowledged it, or has the SimpError if it was not
+    --
+    '''
+
+    def __init__(self, daemon_ip, daemon_port=7778, timeout=10.0, local=True):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name='simp-client', daemon=True)
+        self.thread.start()
+        self.client = self.call(self.create(daemon_ip, daemon_port, timeout, local))
+        self.close_lock = threading.Lock()
+
+    async def create(self, daemon_ip, daemon_port, timeout, local):
+        # The asyncio client is created on its own loop
+        return AsyncSimpClient(daemon_ip, daemon_port, timeout, local)
+
+    def call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    @property
+    def state(self):
+        return self.client.state
+
+    @property
+    def request(self):
+        return self.client.request
+
+    @property
+    def error(self):
+        return self.client.error
+
+    @property
+    def peer(self):
+        return self.client.peer
+
+    @property
+    def is_local(self):
+        return self.client.is_local
+
+    def connect(self, username):
+        self.call(self.client.connect(username))
+
+    def start_chat(self, target):
+        self.call(self.client.start_chat(target))
+
+    def wait_for_chat(self, accept=None):
+        # accept is called in a thread of the executor of the loop, so it can block (e.g. on input())
+        if accept is not None:
+            blocking_accept = accept
+
+            def accept(request):
+                return self.loop.run_in_executor(None, blocking_accept, request)
+        return self.call(self.client.wait_for_chat(accept))
+
+    def send(self, message, timeout=None):
+        self.call(self.client.send(message, timeout))
+
+    def send_nowait(self, message):
+        # The messages are sent in the order of the calls, also while the daemon asks the client to pause
+        return asyncio.run_coroutine_threadsafe(self.client.send(message), self.loop)
+
+    def receive(self):
+        return self.call(self.client.receive())
+
+    def receive_batch(self, limit=1024):
+        return self.call(self.client.receive_batch(limit))
+
+    def __iter__(self):
+        while True:
+            message = self.receive()
+            if message is None:
+                return
+            yield message
+
+    def close(self):
+        with self.close_lock:
+            if self.loop.is_closed():
+                return
+            try:
+                self.call(self.client.close())
+            finally:
+                self.loop.call_soon_threadsafe(self.loop.stop)
+                self.thread.join()
+                self.loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
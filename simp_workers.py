@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+from collections import deque
+
+from local_io import listen_local_socket, local_socket_path, local_transport_supported
+from simp_daemon import SimpDaemon, log
+
+'''
+A multi-process daemon: the supervisor starts a SimpDaemon in every worker process, so the packets are handled on
+several cores.
+--
+The workers bind the same daemon and client ports with SO_REUSEPORT. The kernel hashes every datagram to one of them by
+its source address, so all the messages of a client reach the same worker, the one that has its session.
+Every worker also has an own port for the other daemons: the SYNs arrive on the shared port, but the rest of the packets
+of a connection are sent to the port the SYN or the SYNACK came from, so they reach the worker of the session too.
+The local clients are accepted by the workers from one shared Unix domain socket, created by the supervisor.
+--
+The supervisor keeps the tables that are needed by every worker:
+users - the worker of every connected username (and of every room), a username can be used on one worker only
+waiting - the number of the waiting clients on every worker
+pending_requests - the requests for users that are not connected yet (or for any user while no client is waiting)
+A SYN for a user of another worker is sent to the supervisor, which passes it to the right worker.
+--
+Messages on the pipe between the supervisor and a worker (tuples, the first item is the kind):
+worker -> supervisor: user <name>, user_gone <name>, waiting <count>, syn <target> <data> <address>, stats <stats>
+supervisor -> worker: syn <data> <address>, busy <target> <address>, user_taken <name>, stats
+--
+'''
+
+
+class WorkerLink:
+    # The end of the pipe to the supervisor in a worker, the daemon sends and receives the messages through it
+    def __init__(self, index, connection, local_sock=None):
+        self.index = index
+        self.connection = connection
+        self.local_sock = local_sock
+        self.daemon = None
+        # Set when the supervisor closed the pipe, the worker stops
+        self.closed = asyncio.Event()
+
+    def start(self, loop, daemon):
+        self.daemon = daemon
+        loop.add_reader(self.connection.fileno(), self.read_ready)
+
+    def send(self, *message):
+        try:
+            self.connection.send(message)
+        except OSError:
+            self.closed.set()
+
+    def read_ready(self):
+        try:
+            while self.connection.poll():
+                self.message_received(self.connection.recv())
+        except (EOFError, OSError):
+            asyncio.get_running_loop().remove_reader(self.connection.fileno())
+            self.closed.set()
+
+    def message_received(self, message):
+        kind = message[0]
+        if kind == 'syn':
+            self.daemon.forwarded_syn(*message[1:])
+        elif kind == 'busy':
+            self.daemon.send_busy(*message[1:])
+        elif kind == 'user_taken':
+            self.daemon.username_taken(message[1])
+        elif kind == 'stats':
+            self.send('stats', self.daemon.get_stats())
+
+
+def run_worker(index, connection, ip_address, daemon_port, client_port, metrics_port, local_sock, options):
+    # The entry point of a worker process, the supervisor handles Ctrl-C and stops the workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_worker(index, connection, ip_address, daemon_port, client_port, metrics_port, local_sock,
+                             options))
+
+
+async def serve_worker(index, connection, ip_address, daemon_port, client_port, metrics_port, local_sock, options):
+    link = WorkerLink(index, connection, local_sock)
+    daemon = SimpDaemon(ip_address, daemon_port, client_port, metrics_port=metrics_port,
+                        local_socket=local_sock is not None, worker=link, **options)
+    await daemon.start()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, link.closed.set)
+    await link.closed.wait()
+    daemon.close()
+
+
+def merge_stats(worker_stats):
+    # The counters of the workers are added up, the statistics of every worker are kept under workers
+    total = {'workers': worker_stats, 'peers': {}}
+    for stats in worker_stats:
+        for key, value in stats.items():
+            if key == 'max_queued_bytes':
+                total[key] = max(total.get(key, 0), value)
+            elif isinstance(value, (int, float)) and not isinstance(value, bool) and key != 'worker':
+                total[key] = total.get(key, 0) + value
+        for address, peer in stats['peers'].items():
+            merged = total['peers'].get(address)
+            if merged is None:
+                total['peers'][address] = dict(peer)
+            else:
+                merged['retransmits'] += peer['retransmits']
+                merged['backoffs'] += peer['backoffs']
+    return total
+
+
+class WorkerPool:
+    '''
+    The supervisor of the workers, it starts them, passes the requests between them and collects their statistics.
+    --
+    start() - starts the worker processes, before any event loop is running in this process
+    serve() - handles the messages of the workers until close()
+    get_stats() - the statistics of the workers added up, and of every worker under workers
+    --
+    '''
+
+    def __init__(self, ip_address, workers=None, daemon_port=7777, client_port=7778, metrics_port=None,
+                 max_pending_requests=64, **options):
+        self.ip_address = ip_address
+        self.workers = workers or os.cpu_count() or 1
+        self.daemon_port = daemon_port
+        self.client_port = client_port
+        # The metrics of the workers are served on metrics_port, metrics_port + 1, ...
+        self.metrics_port = metrics_port
+        self.max_pending_requests = max_pending_requests
+        self.options = dict(options, max_pending_requests=max_pending_requests)
+        self.processes = []
+        self.connections = []
+        self.local_sock = None
+        self.local_path = local_socket_path(ip_address, client_port)
+        self.users = {}
+        self.waiting = {}
+        self.pending_requests = {}
+        # The statistics of the workers that were requested but did not arrive yet
+        self.stats_replies = None
+        self.stopped = None
+
+    def check_ports(self):
+        # SO_REUSEPORT lets the workers share the ports, but it would also let them share the ports with another daemon
+        # that runs already, so the ports are bound without it first, that fails if they are used
+        for port in (self.daemon_port, self.client_port):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                sock.bind((self.ip_address, port))
+            finally:
+                sock.close()
+
+    def start(self):
+        # The workers are forked, so they get the listening local socket and their end of the pipes
+        context = multiprocessing.get_context('fork')
+        self.check_ports()
+        if self.options.pop('local_socket', True) and local_transport_supported() and self.local_path is not None:
+            self.local_sock = listen_local_socket(self.local_path)
+        for index in range(self.workers):
+            connection, worker_connection = context.Pipe()
+            metrics_port = self.metrics_port + index if self.metrics_port is not None else None
+            process = context.Process(target=run_worker, name='simp-worker-{}'.format(index), args=(
+                index, worker_connection, self.ip_address, self.daemon_port, self.client_port, metrics_port,
+                self.local_sock, self.options), daemon=True)
+            process.start()
+            worker_connection.close()
+            self.processes.append(process)
+            self.connections.append(connection)
+            self.waiting[index] = 0
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        for index, connection in enumerate(self.connections):
+            loop.add_reader(connection.fileno(), self.read_ready, index)
+        await self.stopped.wait()
+
+    def read_ready(self, index):
+        connection = self.connections[index]
+        try:
+            while connection.poll():
+                self.message_received(index, connection.recv())
+        except (EOFError, OSError):
+            # The worker exited, its users are forgotten
+            log.warning("Worker %d exited", index)
+            asyncio.get_running_loop().remove_reader(connection.fileno())
+            for name in [name for name, worker in self.users.items() if worker == index]:
+                del self.users[name]
+            self.waiting[index] = 0
+            reply = self.stats_replies.get(index) if self.stats_replies is not None else None
+            if reply is not None and not reply.done():
+                reply.set_result(None)
+
+    def send(self, index, *message):
+        try:
+            self.connections[index].send(message)
+        except OSError:
+            pass
+
+    def message_received(self, index, message):
+        kind = message[0]
+        if kind == 'user':
+            name = message[1]
+            owner = self.users.get(name)
+            if owner is not None and owner != index:
+                self.send(index, 'user_taken', name)
+                return
+            self.users[name] = index
+            for data, address in self.pending_requests.pop(name, ()):
+                self.send(index, 'syn', data, address)
+        elif kind == 'user_gone':
+            if self.users.get(message[1]) == index:
+                del self.users[message[1]]
+        elif kind == 'waiting':
+            self.waiting[index] = message[1]
+            # A request for any user is passed to the worker that has a waiting client now
+            requests = self.pending_requests.get('')
+            if message[1] > 0 and requests:
+                self.send(index, 'syn', *requests.popleft())
+                if not requests:
+                    del self.pending_requests['']
+        elif kind == 'syn':
+            self.request_received(index, *message[1:])
+        elif kind == 'stats':
+            if self.stats_replies is not None and index in self.stats_replies:
+                self.stats_replies[index].set_result(message[1])
+
+    def request_received(self, index, target, data, address):
+        if target:
+            worker = self.users.get(target)
+            if worker is None and target[0] == '#':
+                # A room is hosted by the worker that got its first member
+                worker = self.users[target] = index
+        else:
+            worker = next((worker for worker, count in self.waiting.items() if count > 0), None)
+        if worker is not None:
+            self.send(worker, 'syn', data, address)
+            return
+        # Nobody can answer it now, the request waits for the user (or for any waiting client)
+        requests = self.pending_requests.setdefault(target, deque())
+        if len(requests) >= self.max_pending_requests or (data, address) in requests:
+            self.send(index, 'busy', target, address)
+            return
+        requests.append((data, address))
+
+    async def get_stats(self, timeout=5.0):
+        loop = asyncio.get_running_loop()
+        self.stats_replies = {index: loop.create_future() for index, process in enumerate(self.processes)
+                              if process.is_alive()}
+        for index in self.stats_replies:
+            self.send(index, 'stats')
+        try:
+            done, _ = await asyncio.wait(self.stats_replies.values(), timeout=timeout)
+            return merge_stats([future.result() for future in self.stats_replies.values()
+                                if future in done and future.result() is not None])
+        finally:
+            self.stats_replies = None
+
+    def close(self):
+        for process in self.processes:
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            process.join(5)
+        for connection in self.connections:
+            connection.close()
+        if self.local_sock is not None:
+            self.local_sock.close()
+            try:
+                os.unlink(self.local_path)
+            except FileNotFoundError:
+                pass
+        if self.stopped is not None:
+            self.stopped.set()
+
+
+async def main(pool):
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stop.set)
+    serving = asyncio.ensure_future(pool.serve())
+    await stop.wait()
+    stats = await pool.get_stats()
+    print("Sessions {} in flight {} retransmits {} expired {}".format(
+        stats.get('sessions', 0), stats.get('in_flight', 0),
+        sum(peer['retransmits'] for peer in stats['peers'].values()), stats.get('expired_sessions', 0)))
+    pool.close()
+    await serving
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (3, 5, 6):
+        print("Usage: python3 simp_workers.py <ip_address> <workers> [<daemon_port> <client_port> [<metrics_port>]]")
+        print("Set SIMP_LOG=DEBUG to log every packet")
+        sys.exit(1)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+    log.setLevel(os.environ.get('SIMP_LOG', 'INFO').upper())
+    ports = dict(zip(('daemon_port', 'client_port', 'metrics_port'), map(int, sys.argv[3:])))
+    pool = WorkerPool(sys.argv[1], int(sys.argv[2]), **ports)
+    pool.start()
+    asyncio.run(main(pool))
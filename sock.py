@@ -1,108 +1,186 @@
 import struct
 
+# The fixed part of every packet: type, operation, sequence, user, length, number
+# The layout is compiled once, encoding and decoding the header is a single pack/unpack call
+HEADER = struct.Struct('!BBB32sII')
+HEADER_SIZE = HEADER.size
+
+# Lookup tables between the readable values and the bytes of the header
+TYPES = {'control': 0x01, 'chat': 0x02}
+TYPE_NAMES = {code: name for name, code in TYPES.items()}
+OPERATIONS = {
+    # The route packets carry the users a daemon can reach to its relay (routes.py)
+    # The keepalives check that the other daemon of an idle connection is still there
+    'control': {'error': 0x01, 'syn': 0x02, 'ack': 0x04, 'fin': 0x08, 'route': 0x10, 'keepalive': 0x20},
+    'chat': {'message': 0x01, 'batch': 0x02, 'fragment': 0x03}
+}
+OPERATION_NAMES = {
+    0x01: {0x01: 'error', 0x02: 'syn', 0x04: 'ack', 0x08: 'fin',
+           # The "0x06" is the result of a bitwise or between 0x02 and 0x04
+           0x06: 'synack', 0x10: 'route', 0x20: 'keepalive'},
+    0x02: {0x01: 'message', 0x02: 'batch', 0x03: 'fragment'}
+}
+SEQUENCES = {'request': 0x00, 'response': 0x01}
+SEQUENCE_NAMES = {code: name for name, code in SEQUENCES.items()}
+# The first three bytes of the header for every valid (type, operation, sequence), so encoding needs one lookup
+HEADER_CODES = {
+    (type, operation, sequence): (type_code, operation_code, sequence_code)
+    for type, type_code in TYPES.items()
+    for operation, operation_code in OPERATIONS[type].items()
+    for sequence, sequence_code in SEQUENCES.items()
+}
+# The flags are the high bit of the operation byte, the rest of the byte is the operation
+# A chat packet with COMPRESSED has a compressed payload (compression.py), it is a message, a batch or a fragment after
+# it is decompressed
+FLAGS = 0x80
+COMPRESSED = 0x80
+# The readable type, operation, sequence and flags of the first three bytes of every valid header, with and without the
+# flags, so decoding needs one lookup
+HEADER_NAMES = {
+    (type_code, operation_code | flags, sequence_code): (TYPE_NAMES[type_code], operation, sequence, flags)
+    for type_code, operations in OPERATION_NAMES.items()
+    for operation_code, operation in operations.items()
+    for sequence_code, sequence in SEQUENCE_NAMES.items()
+    for flags in (0, COMPRESSED)
+}
+# Every message in the payload of a batch packet is framed with its 2 byte length
+FRAME = struct.Struct('!H')
+FRAME_SIZE = FRAME.size
+MAX_FRAME = 0xFFFF
+# The payload of a fragment packet starts with the id of the message, the index of the fragment and the number of
+# fragments of the message
+FRAGMENT = struct.Struct('!IHH')
+FRAGMENT_SIZE = FRAGMENT.size
+MAX_FRAGMENTS = 0xFFFF
+
+
+def pack_messages(messages):
+    # This function builds the payload of a batch packet from the payloads of several chat messages
+    return b''.join(FRAME.pack(len(message)) + message for message in messages)
+
+
+def unpack_messages(payload):
+    # This function splits the payload of a batch packet to the payloads of the chat messages, in order
+    messages = []
+    offset = 0
+    while offset + FRAME_SIZE <= len(payload):
+        length, = FRAME.unpack_from(payload, offset)
+        offset += FRAME_SIZE
+        if offset + length > len(payload):
+            raise Exception('Invalid batch')
+        messages.append(payload[offset:offset + length])
+        offset += length
+    return messages
+
+
+def split_message(message_id, payload, fragment_size):
+    # This function splits a payload that does not fit in one packet to the payloads of fragment packets
+    view = memoryview(payload)
+    count = (len(view) + fragment_size - 1) // fragment_size
+    if count > MAX_FRAGMENTS:
+        raise Exception('Message too large')
+    return [
+        FRAGMENT.pack(message_id, index, count) + view[index * fragment_size:(index + 1) * fragment_size]
+        for index in range(count)
+    ]
+
+
+def split_options(payload):
+    # The payload of a SYN is the requested user (of a SYNACK empty or the user of a room), the options of the daemon
+    # that sent it are in the next lines, this function returns the first line and the set of the options
+    first, *options = payload.split('\n')
+    return first, set(options)
+
+
+def join_options(first, options):
+    return '\n'.join([first, *sorted(options)])
+
+
+def header_names(type_code, operation_code, sequence_code):
+    # The readable values of a header that is not in HEADER_NAMES, an unknown operation is read as 'unknown'
+    names = HEADER_NAMES.get((type_code, operation_code, sequence_code))
+    if names is not None:
+        return names
+    type = TYPE_NAMES.get(type_code)
+    if type is None:
+        raise Exception('Invalid type')
+    sequence = SEQUENCE_NAMES.get(sequence_code)
+    if sequence is None:
+        raise Exception('Invalid sequence')
+    return type, OPERATION_NAMES[type_code].get(operation_code & ~FLAGS, 'unknown'), sequence, operation_code & FLAGS
+
+
+def user_field(user):
+    # The username as it is in the header, the lookups of the daemon use it without decoding the packets
+    return user.encode('ascii')[:32].ljust(32, b'\x00')
+
+
 class SIMP_Socket:
-    def __init__(self, type=None, operation=None, sequence=None, user=None, length=None, payload=None):
+    # The packet that is built by the daemon to be sent, from readable values
+    __slots__ = ('type', 'operation', 'sequence', 'user', 'length', 'payload', 'number', 'flags')
+
+    def __init__(self, type=None, operation=None, sequence=None, user=None, length=None, payload=None, number=0,
+                 flags=0):
         self.type = type
         self.operation = operation
         self.sequence = sequence
         self.user = user
         self.length = length
         self.payload = payload
-
-    def encode(self):
-        # Convert type to binary
-        if self.type == 'control':
-            type_binary = struct.pack('B', 0x01)
-        elif self.type == 'chat':
-            type_binary = struct.pack('B', 0x02)
-        else:
+        # Per-packet sequence number, used by the sliding window to match acks to the packets they acknowledge
+        self.number = number
+        # The flags are ORed into the operation byte
+        self.flags = flags
+
+    def encode_header(self):
+        # Convert the readable values to the bytes of the header
+        codes = HEADER_CODES.get((self.type, self.operation, self.sequence))
+        if codes is not None:
+            return codes[0], codes[1] | self.flags, codes[2]
+        type_code = TYPES.get(self.type)
+        if type_code is None:
             raise Exception('Invalid type')
-
-        # Convert operation to binary
-        if self.type == 'control':
-            if self.operation == 'error':
-                operation_binary = struct.pack('B', 0x01)
-            elif self.operation == 'syn':
-                operation_binary = struct.pack('B', 0x02)
-            elif self.operation == 'ack':
-                operation_binary = struct.pack('B', 0x04)
-            elif self.operation == 'fin':
-                operation_binary = struct.pack('B', 0x08)
-            else:
+        operation_code = OPERATIONS[self.type].get(self.operation)
+        if operation_code is None:
+            # Every chat packet is a message, whatever the operation is set to
+            if self.type != 'chat':
                 raise Exception('Invalid operation')
-        elif self.type == 'chat':
-            operation_binary = struct.pack('B', 0x01)
-        else:
-            raise Exception('Invalid operation')
-
-        # Convert sequence to binary
-        if self.sequence == 'request':
-            sequence_binary = struct.pack('B', 0x00)
-        elif self.sequence == 'response':
-            sequence_binary = struct.pack('B', 0x01)
-        else:
+            operation_code = 0x01
+        sequence_code = SEQUENCES.get(self.sequence)
+        if sequence_code is None:
             raise Exception('Invalid sequence')
+        return type_code, operation_code | self.flags, sequence_code
 
-        # Convert username to 32 bytes, padded with null bytes, only pad up to 32 bytes
-        user_binary = self.user.encode('ascii')
-        user_binary = user_binary.ljust(32, b'\x00')
+    def payload_binary(self):
+        # The payload is readable text, except for the batch packets that carry the framed messages as bytes
+        if isinstance(self.payload, bytes):
+            return self.payload
+        return self.payload.encode('ascii')
 
-        # Convert payload to binary
-        payload_binary = self.payload.encode('ascii')
-
-        # Calculate length of payload
-        self.length = len(payload_binary)
-
-        # Convert length to bytes
-        length_bytes = self.length.to_bytes(4, 'big')  # 'big' or 'little' depending on your needs
-
-        return type_binary + operation_binary + sequence_binary + user_binary + length_bytes + payload_binary
+    def encode(self):
+        payload = self.payload_binary()
+        self.length = len(payload)
+        # The usual packets are looked up here, the others are checked by encode_header()
+        codes = HEADER_CODES.get((self.type, self.operation, self.sequence)) or self.encode_header()
+        # The username is padded with null bytes up to 32 bytes by the struct layout
+        return HEADER.pack(codes[0], codes[1] | self.flags, codes[2], self.user.encode('ascii'), self.length,
+                           self.number) + payload
 
     def decode(self, bytestream):
-        # Convert type to string
-        if bytestream[0] == 0x01:
-            self.type = 'control'
-        elif bytestream[0] == 0x02:
-            self.type = 'chat'
-        else:
-            raise Exception('Invalid type')
+        # The header is read straight from the received buffer
+        type_code, operation_code, sequence_code, user, self.length, self.number = HEADER.unpack_from(bytestream)
 
-        # Convert operation to string
-        if self.type == 'control':
-            if bytestream[1] == 0x01:
-                self.operation = 'error'
-            elif bytestream[1] == 0x02:
-                self.operation = 'syn'
-            elif bytestream[1] == 0x04:
-                self.operation = 'ack'
-            elif bytestream[1] == 0x08:
-                self.operation = 'fin'
-            elif bytestream[1] == 0x06:
-                # The "0x06" is the result of a bitwise or between 0x02 and 0x04
-                self.operation = 'synack'
-            else:
-                self.operation = 'unknown'
-        elif self.type == 'chat':
-            self.operation = 'message'
-        else:
-            raise Exception('Invalid operation')
-
-        # Convert sequence to string
-        if bytestream[2] == 0x00:
-            self.sequence = 'request'
-        elif bytestream[2] == 0x01:
-            self.sequence = 'response'
-        else:
-            raise Exception('Invalid sequence')
+        # Convert type, operation and sequence to strings
+        names = HEADER_NAMES.get((type_code, operation_code, sequence_code))
+        if names is None:
+            names = header_names(type_code, operation_code, sequence_code)
+        self.type, self.operation, self.sequence, self.flags = names
 
         # Convert username to string, remove null bytes
-        self.user = bytestream[3:35].decode('ascii').strip('\x00')
-
-        # Convert length to int
-        self.length = int.from_bytes(bytestream[35:39], 'big')
+        self.user = user.rstrip(b'\x00').decode('ascii')
 
-        # Convert payload to string
-        self.payload = bytestream[39:].decode('ascii')
+        # Convert payload to string, it is decoded from a view of the buffer without copying it first
+        self.payload = str(memoryview(bytestream)[HEADER_SIZE:], 'ascii')
 
     def printData(self):
         print('Type: {}'.format(self.type))
@@ -110,4 +188,64 @@ class SIMP_Socket:
         print('Sequence: {}'.format(self.sequence))
         print('User: {}'.format(self.user))
         print('Length: {}'.format(self.length))
+        print('Number: {}'.format(self.number))
         print('Payload: {}'.format(self.payload))
+
+
+class SimpPacket:
+    '''
+    A received packet that keeps the raw buffer.
+    The header fields are unpacked once, the user and the payload are only decoded when they are accessed.
+    The daemon routes the packets by the header bytes (operation, number and user_field) alone.
+    '''
+    __slots__ = ('buffer', 'type', 'operation', 'sequence', 'user_field', 'length', 'number', 'flags', '_user',
+                 '_payload')
+
+    def __init__(self, bytestream):
+        type_code, operation_code, sequence_code, self.user_field, self.length, self.number = HEADER.unpack_from(bytestream)
+        self.buffer = bytestream
+        names = HEADER_NAMES.get((type_code, operation_code, sequence_code))
+        if names is None:
+            names = header_names(type_code, operation_code, sequence_code)
+        self.type, self.operation, self.sequence, self.flags = names
+        if not self.user_field.isascii():
+            # The user is decoded later, outside of the decoding of the packet
+            raise Exception('Invalid user')
+        self._user = None
+        self._payload = None
+
+    @property
+    def user(self):
+        if self._user is None:
+            self._user = self.user_field.rstrip(b'\x00').decode('ascii')
+        return self._user
+
+    @property
+    def payload_bytes(self):
+        # The payload as a view of the received buffer, it can be forwarded without decoding or copying it
+        return memoryview(self.buffer)[HEADER_SIZE:]
+
+    def replace_payload(self, payload):
+        # The payload of a compressed packet is replaced with the decompressed one, the rest of the daemon reads the
+        # packet as if it arrived that way
+        self.buffer = bytes(memoryview(self.buffer)[:HEADER_SIZE]) + payload
+        self.length = len(payload)
+        self.flags = 0
+        self._payload = None
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            self._payload = str(self.payload_bytes, 'ascii')
+        return self._payload
+
+    def printData(self):
+        print('Type: {}'.format(self.type))
+        print('Operation: {}'.format(self.operation))
+        print('Sequence: {}'.format(self.sequence))
+        print('User: {}'.format(self.user))
+        print('Length: {}'.format(self.length))
+        print('Number: {}'.format(self.number))
+        print('Flags: {}'.format(self.flags))
+        # The payload of the chat packets is not always text (batches, fragments), it is printed as bytes
+        print('Payload: {}'.format(bytes(self.payload_bytes) if self.type == 'chat' else self.payload))
@@ -0,0 +1,160 @@
+import asyncio
+import math
+
+'''
+The timers of the daemon that are set for every session, on one timing wheel: the resends of the sliding windows and
+the rooms, the aggregation delays, the handshakes, the keepalives, the reassembly of the fragments and the idle circuits.
+--
+The wheel is a ring of slots, every slot is resolution seconds long. A timer goes to the slot of the tick it is due at
+(modulo the number of slots), so setting and cancelling a timer is a dictionary insert and delete, whatever the number of
+the timers is. Most timers are cancelled before they run out (a resend timer is set again on every ack), with the heap of
+the event loop every cancelled timer stays in the heap until it would have run out.
+The wheel is driven by one callback of the event loop, which runs the timers of the slots it passed that are due; the
+timers that are due in a later turn of the wheel stay in their slot. The callback is scheduled for the first slot with a
+timer in it, so an idle wheel does not wake up the event loop, and it is only moved when a timer is set for an earlier
+tick.
+--
+A timer runs at most resolution seconds late, never early.
+An exception of a callback is passed to the exception handler of the event loop, like the exceptions of the callbacks
+of the event loop, the other timers are not delayed by it.
+--
+'''
+
+
+class Timer:
+    # A timer on the wheel, cancel() removes it
+    __slots__ = ('wheel', 'tick', 'callback', 'args')
+
+    def __init__(self, wheel, tick, callback, args):
+        self.wheel = wheel
+        self.tick = tick
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        if self.wheel is not None:
+            self.wheel.remove(self)
+            self.wheel = None
+
+
+class TimerWheel:
+    '''
+    slots - the timers by the tick they are due at modulo the number of slots, in the order they were set
+    tick - the last tick the wheel ran the timers of
+    --
+    call_later() - sets a timer, like the call_later() of the event loop, returns the Timer
+    '''
+
+    def __init__(self, resolution=0.001, size=1024):
+        self.resolution = resolution
+        self.size = size
+        self.slots = [{} for _ in range(size)]
+        self.count = 0
+        self.tick = 0
+        # The callback of the event loop and the tick it is scheduled for
+        self.handle = None
+        self.wakeup = None
+        self.running = False
+        self.loop = None
+        # Counters
+        self.scheduled = 0
+        self.cancelled = 0
+        self.fired = 0
+
+    def now(self):
+        return int(self.loop.time() / self.resolution)
+
+    def call_later(self, delay, callback, *args):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        if self.count == 0:
+            # The wheel was stopped, it starts from now
+            self.tick = self.now()
+        # The timer is due at the first tick that is at least delay seconds from now, and after the current tick, the
+        # slot of that can be passed already
+        tick = max(math.ceil((self.loop.time() + delay) / self.resolution), self.now() + 1)
+        timer = Timer(self, tick, callback, args)
+        self.slots[tick % self.size][timer] = None
+        self.count += 1
+        self.scheduled += 1
+        if not self.running and (self.handle is None or tick < self.wakeup):
+            self.wake_at(tick)
+        return timer
+
+    def wake_at(self, tick):
+        # The callback runs just after the start of the tick, so the tick is already reached by then
+        if self.handle is not None:
+            self.handle.cancel()
+        self.wakeup = tick
+        self.handle = self.loop.call_at((tick + 0.01) * self.resolution, self.run)
+
+    def remove(self, timer):
+        del self.slots[timer.tick % self.size][timer]
+        self.count -= 1
+        self.cancelled += 1
+
+    def run(self):
+        # The slots between the last tick and now are checked, all of them once if the loop was late a whole turn
+        self.handle = None
+        self.running = True
+        now = self.now()
+        try:
+            for tick in range(self.tick + 1, min(now, self.tick + self.size) + 1):
+                slot = self.slots[tick % self.size]
+                if slot:
+                    for timer in [timer for timer in slot if timer.tick <= now]:
+                        if timer.wheel is None:
+                            # The callback of an earlier timer cancelled it
+                            continue
+                        del slot[timer]
+                        timer.wheel = None
+                        self.count -= 1
+                        self.fired += 1
+                        self.call(timer)
+                # The slot is drained, the wheel does not go back to it
+                self.tick = tick
+            self.tick = now
+        finally:
+            self.running = False
+            # The callbacks could set new timers, the callback is scheduled after all of them were run
+            if self.count > 0:
+                self.wake_at(self.next_tick())
+
+    def call(self, timer):
+        # An exception of a callback is reported like the event loop does, the other timers still run
+        try:
+            timer.callback(*timer.args)
+        except Exception as error:
+            self.loop.call_exception_handler({
+                'message': 'Exception in the callback of a timer',
+                'exception': error,
+                'timer': timer
+            })
+
+    def next_tick(self):
+        # The first tick a timer is due at, the slots are checked from the next tick until the earliest timer found so
+        # far, a slot can have the timers of later turns only
+        first = None
+        for tick in range(self.tick + 1, self.tick + self.size + 1):
+            if first is not None and tick >= first:
+                break
+            slot = self.slots[tick % self.size]
+            if slot:
+                earliest = min(timer.tick for timer in slot)
+                if first is None or earliest < first:
+                    first = earliest
+        return first
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+            self.wakeup = None
+
+    def stats(self):
+        return {
+            'timers': self.count,
+            'scheduled': self.scheduled,
+            'cancelled': self.cancelled,
+            'fired': self.fired
+        }